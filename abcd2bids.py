@@ -20,14 +20,19 @@ Updated 2020-01-15
 
 import argparse
 import configparser
+from contextlib import contextmanager
 from cryptography.fernet import Fernet
 import datetime
+import fcntl
+import fnmatch
 from getpass import getpass
-import glob
+import importlib.util
+import json
 import os
 import pandas as pd
 import shutil
 import signal
+import socket
 import subprocess
 import sys
 
@@ -44,6 +49,7 @@ except (OSError, AssertionError):
 
 # Constants: Default paths to scripts to call from this wrapper, and default
 # paths to folders in which to manipulate data
+BIDS_INDEX = os.path.join(PWD, "src", "bids_index.py")
 CONFIG_FILE = os.path.join(os.path.expanduser("~"), ".abcd2bids", "config.ini")
 CORRECT_JSONS = os.path.join(PWD, "src", "correct_jsons.py")
 DOWNLOAD_FOLDER = os.path.join(PWD, "raw")
@@ -58,6 +64,10 @@ TEMP_FILES_DIR = os.path.join(PWD, "temp")
 UNPACK_AND_SETUP = os.path.join(PWD, "src", "unpack_and_setup.sh")
 UNPACKED_FOLDER = os.path.join(PWD, "data")
 MODALITIES = ['anat', 'func', 'dwi']
+SCRATCH_POLL_SECONDS = 30
+SCRATCH_REGISTRY = "scratch_registry.json"
+SCRATCH_WORKSPACE_PATTERN = "sub-*_ses-*"
+HELD_REGISTRY_LOCKS = set()
 SESSIONS = ['baseline_year_1_arm_1', '2_year_follow_up_y_arm_1']
 
 
@@ -70,7 +80,7 @@ def main():
     cli_args = get_cli_args()
     starting_timestamp = get_and_print_timestamp_when(sys.argv[0], "started")
 
-    # Set cleanup function to delete all temporary files if script crashes
+    # Set cleanup function to delete finished temp files if script crashes
     if cli_args.remove:
         set_to_cleanup_on_crash(cli_args.temp)
 
@@ -92,7 +102,7 @@ def main():
     print(starting_timestamp)
     get_and_print_timestamp_when(sys.argv[0], "finished")
 
-    # Finally, delete temporary files and end script with success exit code
+    # Finally, delete finished temp files and end script with success exit code
     cleanup(cli_args.temp, 0)
 
 
@@ -131,14 +141,17 @@ def get_cli_args():
               "be a valid path to an existing folder.")
     )
 
-    # Required: Get path to MRE / MCR root to run compiled MATLAB script
+    # Optional: Get path to MRE / MCR root to run compiled MATLAB script
     parser.add_argument(
         "mre_dir",
         type=str,
-        help=("Required: Path to directory containing MATLAB Runtime "
-              "Environment (MRE) version 9.1 or newer. This is used to run "
-              "a compiled MATLAB script. This positional argument must be a "
-              "valid path to an existing folder.")
+        nargs="?",
+        default=None,
+        help=("Path to directory containing MATLAB Runtime Environment (MRE) "
+              "version 9.1 or newer. This is used to run a compiled MATLAB "
+              "script, and is only needed if --eta-engine is matlab or "
+              "compare. If given, this positional argument must be a valid "
+              "path to an existing folder.")
     )
 
     # Optional: Get path to already-existing config file with NDA credentials
@@ -263,9 +276,251 @@ def get_cli_args():
         default=TEMP_FILES_DIR,
         help=("Path to the directory to be created and filled with "
               "temporary files during unpacking and setup. By default, the "
-              "folder will be created at {} and deleted once the script "
-              "finishes. A folder will be created at the given path if one "
-              "doesn't already exist.".format(TEMP_FILES_DIR))
+              "folder will be created at {}. Each session's temporary "
+              "files are deleted once that session is finished, and "
+              "unfinished sessions' files are kept to resume from. A folder "
+              "will be created at the given path if one doesn't already "
+              "exist.".format(TEMP_FILES_DIR))
+    )
+
+    # Optional: Cache converted DICOM series to reuse when rerunning sessions
+    parser.add_argument(
+        "--conversion-cache",
+        dest="conversion_cache",
+        default=None,
+        help=("Path to a folder in which to keep each DICOM series after "
+              "converting it to NIfTI. When a session is unpacked again, "
+              "series whose DICOMs and dcm2niix version have not changed are "
+              "copied from this folder instead of being converted again. A "
+              "folder will be created at the given path if one does not "
+              "already exist. By default, no cache is used.")
+    )
+    parser.add_argument(
+        "--conversion-cache-size",
+        type=float,
+        dest="conversion_cache_size",
+        default=100,
+        help=("Maximum size of the --conversion-cache folder in gigabytes. "
+              "Once the cache is bigger than this, its least recently used "
+              "series are deleted. The default is 100.")
+    )
+
+    # Optional: Convert several DICOM series of each session at once
+    parser.add_argument(
+        "--conversion-jobs",
+        type=int,
+        dest="conversion_jobs",
+        default=1,
+        help=("Number of DICOM series in each session to convert to NIfTI at "
+              "the same time. The default is 1.")
+    )
+    parser.add_argument(
+        "--benchmark-conversion",
+        action="store_true",
+        dest="benchmark_conversion",
+        help=("Also convert each session one series at a time, and with "
+              "one dcm2niix call over all of its DICOMs like before, then "
+              "print how long those took compared to using "
+              "--conversion-jobs, and whether all of them made identical "
+              "outputs.")
+    )
+
+    # Optional: Name converted files without running dcm2bids
+    parser.add_argument(
+        "--conversion-naming",
+        choices=["dcm2bids", "internal"],
+        dest="conversion_naming",
+        default="dcm2bids",
+        help=("How to give converted files their BIDS names. 'dcm2bids' "
+              "runs dcm2bids on the dcm2niix outputs. 'internal' matches "
+              "each series against abcd_dcm2bids.conf the same way dcm2bids "
+              "does, then converts it straight to its BIDS name, skipping "
+              "series that dcm2bids would not use. The default is dcm2bids.")
+    )
+
+    # Optional: Choose how converted NIfTIs are compressed
+    parser.add_argument(
+        "--nifti-compression",
+        choices=["pigz", "gzip", "none"],
+        dest="nifti_compression",
+        default=None,
+        help=("How to write converted NIfTIs. 'pigz' gzips them using every "
+              "CPU core, which needs pigz to be on the PATH. 'gzip' gzips "
+              "them on one core. 'none' writes uncompressed .nii files, "
+              "which are faster to write and read but bigger. By default, "
+              "the dcm2niixOptions in abcd_dcm2bids.conf decide.")
+    )
+    parser.add_argument(
+        "--nifti-compression-level",
+        type=int,
+        choices=range(1, 10),
+        metavar="{1-9}",
+        dest="nifti_compression_level",
+        default=None,
+        help=("gzip compression level for converted NIfTIs, from 1 (fastest "
+              "but biggest) to 9 (slowest but smallest). The default is 6.")
+    )
+
+    # Optional: Choose how to calculate eta squared when selecting SEFMs
+    parser.add_argument(
+        "--eta-engine",
+        choices=["numpy", "matlab", "compare"],
+        dest="eta_engine",
+        default="numpy",
+        help=("How to calculate the eta squared values used to pick the best "
+              "pair of spin echo field maps. 'numpy' calculates them in "
+              "Python. 'matlab' runs the compiled MATLAB function, which "
+              "needs mre_dir. 'compare' does both, then reports whether they "
+              "agree and how long each took. The default is numpy.")
+    )
+
+    parser.add_argument(
+        "--mcr-cache",
+        dest="mcr_cache",
+        default=None,
+        help=("Path to a folder to keep the MATLAB Runtime cache in, shared "
+              "by every call of the compiled MATLAB eta_squared function, so "
+              "that it is only extracted once instead of once per call. Only "
+              "used if --eta-engine is matlab or compare. By default, each "
+              "call makes and then deletes its own cache.")
+    )
+
+    # Optional: Run several SEFM registrations at once
+    parser.add_argument(
+        "--flirt-jobs",
+        type=int,
+        dest="flirt_jobs",
+        default=1,
+        help=("Number of FLIRT registrations of spin echo field maps to run "
+              "at the same time for each session. The default is 1.")
+    )
+    parser.add_argument(
+        "--flirt-threads",
+        type=int,
+        dest="flirt_threads",
+        default=1,
+        help=("Number of threads each FLIRT process may use. The default is "
+              "1, so at most --flirt-jobs cores are used.")
+    )
+    parser.add_argument(
+        "--benchmark-flirt",
+        action="store_true",
+        dest="benchmark_flirt",
+        help=("Also run each session's FLIRT registrations one at a time, "
+              "then print how long that took compared to using --flirt-jobs, "
+              "and whether both made identical images.")
+    )
+
+    # Optional: Cache SEFM rankings to reuse when rerunning sessions
+    parser.add_argument(
+        "--sefm-cache",
+        dest="sefm_cache",
+        default=None,
+        help=("Path to a folder in which to keep the eta values and best "
+              "pair of spin echo field maps chosen for each session. When a "
+              "session whose field maps, FSL version, and --eta-engine have "
+              "not changed is unpacked again, its field maps are not "
+              "registered or ranked again. A folder will be created at the "
+              "given path if one does not already exist. By default, no "
+              "cache is used.")
+    )
+    parser.add_argument(
+        "--invalidate-sefm-cache",
+        action="store_true",
+        dest="invalidate_sefm_cache",
+        help=("Rank every session's spin echo field maps again even if they "
+              "are in the --sefm-cache folder, replacing the cached rankings.")
+    )
+
+    # Optional: Align spin echo field maps in memory instead of with FLIRT
+    parser.add_argument(
+        "--sefm-registration",
+        choices=("flirt", "numpy"),
+        default="flirt",
+        dest="sefm_registration",
+        help=("How to align each spin echo field map to the first one with "
+              "the same phase encoding direction before ranking them: with "
+              "FSL's FLIRT, or in memory with NumPy and SciPy. The default "
+              "is flirt.")
+    )
+    parser.add_argument(
+        "--validate-sefm-registration",
+        action="store_true",
+        dest="validate_sefm_registration",
+        help=("Align each session's spin echo field maps both with FLIRT and "
+              "in memory, then print how far apart their transforms are, how "
+              "long each took, and whether both lead to the same pair.")
+    )
+
+    # Optional: Rank spin echo field maps approximately before full scoring
+    parser.add_argument(
+        "--sefm-ranking",
+        choices=("full", "fast"),
+        default="full",
+        dest="sefm_ranking",
+        help=("How to rank each session's spin echo field map pairs. 'full' "
+              "calculates every eta squared value at full resolution. 'fast' "
+              "approximates them inside a rough brain mask on a downsampled "
+              "grid, and only calculates them at full resolution for the "
+              "pairs within --sefm-ranking-margin of the best pair. The "
+              "default is full.")
+    )
+    parser.add_argument(
+        "--sefm-ranking-margin",
+        type=float,
+        default=0.002,
+        dest="sefm_ranking_margin",
+        help=("With --sefm-ranking fast, pairs whose lowest approximate eta "
+              "squared value is at most this much lower than the best "
+              "pair's are ranked again at full resolution. The default is "
+              "0.002.")
+    )
+    parser.add_argument(
+        "--benchmark-sefm-ranking",
+        action="store_true",
+        dest="benchmark_sefm_ranking",
+        help=("Rank each session's spin echo field maps with both fast and "
+              "full ranking, then print how often they chose the same pair "
+              "and how much time fast ranking saved across every session.")
+    )
+
+    # Optional: Correct several subjects' sidecar JSONs at once
+    parser.add_argument(
+        "--correct-jsons-jobs",
+        type=int,
+        dest="correct_jsons_jobs",
+        default=1,
+        help=("Number of subjects whose sidecar JSONs to correct at the same "
+              "time in the correct_jsons step. The default is 1.")
+    )
+
+    # Optional: Index large 4D NIfTIs so single volumes can be read quickly
+    parser.add_argument(
+        "--gzip-index-min-size",
+        type=float,
+        dest="gzip_index_min_size",
+        default=None,
+        help=("Build a random-access index for every 4D .nii.gz file at "
+              "least this many gigabytes big, saved next to it as a .gzidx "
+              "file, so readers which load that index can seek straight to "
+              "any volume. nibabel.load does not use it; read the files "
+              "with src/gzip_index.py's load_nifti, open_nifti, or "
+              "read_volume instead. This needs the indexed_gzip Python "
+              "package. By default, no indexes are built.")
+    )
+
+    # Optional: Limit the total size of the temp folder during unpacking
+    parser.add_argument(
+        "--scratch-quota",
+        type=float,
+        dest="scratch_quota",
+        default=None,
+        help=("Maximum total size, in gigabytes, of the session folders in "
+              "the --temp directory. Before each session is unpacked, the "
+              "least recently used leftover session folders are deleted "
+              "until the temp directory is under this quota. If a session "
+              "alone exceeds the quota, the wrapper stops; rerun it once "
+              "more space is free. By default, there is no quota.")
     )
 
     # Optional: Get NDA username and password
@@ -312,7 +567,18 @@ def validate_cli_args(args, parser):
     """
     # Validate FSL and MRE directories
     validate_dir_path(args.fsl_dir, parser)
-    validate_dir_path(args.mre_dir, parser)
+    if args.mre_dir:
+        validate_dir_path(args.mre_dir, parser)
+    elif args.eta_engine != "numpy":
+        parser.error("--eta-engine {} needs mre_dir.".format(args.eta_engine))
+    for cli_arg in ("mcr_cache", "sefm_cache"):
+        if getattr(args, cli_arg):
+            setattr(args, cli_arg, os.path.abspath(getattr(args, cli_arg)))
+            try:
+                os.makedirs(getattr(args, cli_arg), exist_ok=True)
+            except OSError:
+                parser.error("Could not create folder at "
+                             + getattr(args, cli_arg))
 
     # Validate and create config file's parent directory
     try:
@@ -327,10 +593,34 @@ def validate_cli_args(args, parser):
             setattr(args, cli_arg, os.path.abspath(getattr(args, cli_arg)))
     except OSError:
         parser.error("Failed to convert {} to absolute path.".format(cli_arg))
+    if args.conversion_cache:
+        args.conversion_cache = os.path.abspath(args.conversion_cache)
+        try:
+            os.makedirs(args.conversion_cache, exist_ok=True)
+        except OSError:
+            parser.error("Could not create folder at " + args.conversion_cache)
     try_to_create_and_prep_directory_at(args.download, DOWNLOAD_FOLDER, parser)
     try_to_create_and_prep_directory_at(args.output, UNPACKED_FOLDER, parser)
     try_to_create_and_prep_directory_at(args.temp, TEMP_FILES_DIR, parser)
 
+    if args.conversion_jobs < 1:
+        parser.error("--conversion-jobs must be at least 1.")
+    if args.flirt_jobs < 1 or args.flirt_threads < 1:
+        parser.error("--flirt-jobs and --flirt-threads must be at least 1.")
+    if args.correct_jsons_jobs < 1:
+        parser.error("--correct-jsons-jobs must be at least 1.")
+    if args.sefm_ranking_margin < 0:
+        parser.error("--sefm-ranking-margin cannot be negative.")
+    if args.scratch_quota is not None and args.scratch_quota <= 0:
+        parser.error("--scratch-quota must be a positive number of GB.")
+    if args.gzip_index_min_size is not None:
+        if args.gzip_index_min_size < 0:
+            parser.error("--gzip-index-min-size cannot be negative.")
+        if importlib.util.find_spec("indexed_gzip") is None:
+            parser.error("--gzip-index-min-size needs the indexed_gzip "
+                         "package. Install it with 'pip install "
+                         "indexed_gzip'.")
+
     # Ensure that the output folder path is formatted correctly:
     if args.output[-1] != "/":
         args.output += "/"
@@ -407,9 +697,9 @@ def try_to_create_and_prep_directory_at(folder_path, default_path, parser):
 
 def set_to_cleanup_on_crash(temp_dir):
     """
-    Make it so that if the script crashes, all of the temporary files that it
-    generated are deleted. signal.signal() checks if the script has crashed,
-    and cleanup() deletes all of the temporary files.
+    Make it so that if the script crashes, the temporary files of the
+    sessions it finished are deleted. signal.signal() checks if the script has
+    crashed, and cleanup() deletes those temporary files.
     :return: N/A
     """
     # Use local function as an intermediate because the signal module does
@@ -419,28 +709,39 @@ def set_to_cleanup_on_crash(temp_dir):
     def call_cleanup_function(_signum, _frame):
         cleanup(temp_dir, 1)
 
-    # If this wrapper crashes, delete all temporary files
+    # If this wrapper crashes, delete its finished sessions' temporary files
     signal.signal(signal.SIGINT, call_cleanup_function)
     signal.signal(signal.SIGTERM, call_cleanup_function)
 
 
 def cleanup(temp_dir, exit_code):
     """
-    Function to delete all temp files created while running this script. This
+    Function to delete the temp files created by this run of the script. This
     function will always run right before the wrapper terminates, whether or
-    not the wrapper ran successfully.
+    not the wrapper ran successfully. Only the session folders which this run
+    registered and finished copying to the output folder are deleted; all
+    other folders in temp_dir are kept, so that unfinished sessions can be
+    resumed later and other runs sharing temp_dir are not disturbed.
     :param temp_dir: Path to folder containing temporary files to delete.
     :param exit_code: Code for this wrapper to return on exit. If cleanup() is
     called when wrapper finishes successfully, then 0; otherwise 1.
     :return: N/A
     """
-    # Delete all temp folder subdirectories, but not the README in temp folder
-    for temp_dir_subdir in os.scandir(temp_dir):
-        if temp_dir_subdir.is_dir():
-            shutil.rmtree(temp_dir_subdir.path)
+    with lock_scratch_registry(temp_dir):
+        registry = read_scratch_registry(temp_dir)
+        for workspace, entry in list(registry.items()):
+            workspace_path = os.path.join(temp_dir, workspace)
+            if (entry.get("host") == socket.gethostname()
+                    and entry.get("pid") == os.getpid()
+                    and os.path.exists(os.path.join(
+                        workspace_path, "checkpoints", "publish"
+                    ))):
+                shutil.rmtree(workspace_path, ignore_errors=True)
+                registry.pop(workspace)
+        write_scratch_registry(temp_dir, registry)
 
     # Inform user that temporary files were deleted, then terminate wrapper
-    print("\nTemporary files in {} deleted. ABCD to BIDS wrapper "
+    print("\nFinished temporary files in {} deleted. ABCD to BIDS wrapper "
           "terminated.".format(temp_dir))
     sys.exit(exit_code)
 
@@ -696,6 +997,60 @@ def unpack_and_setup(args):
             if subject.is_dir():
                 subject_dir_paths[subject.name] = subject.path
 
+    # Index the whole output folder once now if it has no complete index, so
+    # that publishing each session only has to index that session
+    subprocess.check_call((BIDS_INDEX, "update", args.output,
+                           "--if-incomplete"))
+
+    # Delete session folders left in the temp directory by crashed runs,
+    # except for the ones that this run can resume from
+    recover_orphaned_workspaces(args.temp, subject_dir_paths.keys())
+    quota = (None if args.scratch_quota is None
+             else int(args.scratch_quota * 1024 ** 3))
+    peak_usage = 0
+
+    # Settings for unpack_and_setup.sh which are passed as env variables
+    unpack_env = os.environ.copy()
+    if args.conversion_cache:
+        unpack_env["CONVERSION_CACHE_DIR"] = args.conversion_cache
+        unpack_env["CONVERSION_CACHE_SIZE"] = str(args.conversion_cache_size)
+    unpack_env["CONVERSION_JOBS"] = str(args.conversion_jobs)
+    unpack_env["CONVERSION_NAMING"] = args.conversion_naming
+    if args.benchmark_conversion:
+        unpack_env["CONVERSION_BENCHMARK"] = "1"
+    if args.nifti_compression:
+        unpack_env["NIFTI_COMPRESSION"] = args.nifti_compression
+    if args.nifti_compression_level:
+        unpack_env["NIFTI_COMPRESSION_LEVEL"] = str(
+            args.nifti_compression_level
+        )
+    if args.gzip_index_min_size is not None:
+        unpack_env["GZIP_INDEX_MIN_SIZE"] = str(args.gzip_index_min_size)
+    unpack_env["ETA_ENGINE"] = args.eta_engine
+    if args.mcr_cache:
+        unpack_env["MCR_CACHE_DIR"] = args.mcr_cache
+    unpack_env["FLIRT_JOBS"] = str(args.flirt_jobs)
+    unpack_env["FLIRT_THREADS"] = str(args.flirt_threads)
+    if args.benchmark_flirt:
+        unpack_env["FLIRT_BENCHMARK"] = "1"
+    if args.sefm_cache:
+        unpack_env["SEFM_CACHE_DIR"] = args.sefm_cache
+    if args.invalidate_sefm_cache:
+        unpack_env["SEFM_CACHE_INVALIDATE"] = "1"
+    unpack_env["SEFM_REGISTRATION"] = args.sefm_registration
+    if args.validate_sefm_registration:
+        unpack_env["SEFM_REGISTRATION_VALIDATE"] = "1"
+    unpack_env["SEFM_RANKING"] = args.sefm_ranking
+    unpack_env["SEFM_RANKING_MARGIN"] = str(args.sefm_ranking_margin)
+    if args.benchmark_sefm_ranking:
+        unpack_env["SEFM_RANKING_BENCHMARK"] = "1"
+        ranking_results = os.path.join(
+            args.temp, "sefm_ranking_benchmark_{}.jsonl".format(os.getpid())
+        )
+        if os.path.exists(ranking_results):
+            os.remove(ranking_results)
+        unpack_env["SEFM_RANKING_RESULTS"] = ranking_results
+
     # Loop through each subject and setup all sessions for that subject
     for subject, subject_dir in subject_dir_paths.items():
         for session_dir in os.scandir(subject_dir):
@@ -709,8 +1064,15 @@ def unpack_and_setup(args):
                         print('Unpacking and setting up tgzs for {} {} located here: {}'.format(subject, session_name, tgz_dir))
                         print("Running: ", UNPACK_AND_SETUP, subject, "ses-" + session_name, session_dir.path, args.output, args.temp, args.fsl_dir, args.mre_dir)
 
-                        # Unpack/setup the data for this subject/session
-                        subprocess.check_call((
+                        # Unpack/setup the data for this subject/session in
+                        # a registered temp folder, then delete that folder
+                        # once the session has been copied to --output
+                        workspace = register_workspace(
+                            args.temp, subject, "ses-" + session_name
+                        )
+                        if quota:
+                            enforce_scratch_quota(args.temp, quota, workspace)
+                        peak_usage = max(peak_usage, run_and_monitor_scratch((
                             UNPACK_AND_SETUP,
                             subject,
                             "ses-" + session_name,
@@ -718,8 +1080,9 @@ def unpack_and_setup(args):
                             args.output,
                             args.temp,
                             args.fsl_dir,
-                            args.mre_dir
-                        ))
+                            args.mre_dir or ""
+                        ), args.temp, quota, workspace, unpack_env))
+                        release_workspace(args.temp, workspace)
 
                         # If user said to, delete all the raw downloaded
                         # files for each subject after that subject's data
@@ -729,27 +1092,308 @@ def unpack_and_setup(args):
                                                        subject))
                         break
 
+    print("Peak temp directory usage while unpacking: {:.2f} GB".format(
+        peak_usage / 1024 ** 3
+    ))
+    if args.benchmark_sefm_ranking:
+        report_sefm_ranking_benchmark(ranking_results)
+
+
+def report_sefm_ranking_benchmark(results_path):
+    """
+    Print how often fast and full SEFM ranking chose the same pair, and how
+    much time fast ranking saved, across every session benchmarked by
+    sefm_eval_and_json_editor.py while unpacking, then delete their results
+    :param results_path: Path to the file that each session's benchmark
+    result was appended to as one line of JSON
+    :return: N/A
+    """
+    try:
+        with open(results_path) as infile:
+            results = [json.loads(line) for line in infile if line.strip()]
+        os.remove(results_path)
+    except OSError:
+        results = []
+    if not results:
+        print("SEFM ranking benchmark: no sessions were benchmarked.")
+        return
+    agreed = sum(1 for result in results if result["agree"])
+    full_seconds = sum(result["full_seconds"] for result in results)
+    fast_seconds = sum(result["fast_seconds"] for result in results)
+    print("SEFM ranking benchmark: fast and full ranking chose the same pair "
+          "for {} of {} session(s) ({:.0f}%). Ranking took {:.2f} seconds "
+          "fast and {:.2f} seconds full, saving {:.2f} seconds ({:.0f}%)."
+          .format(agreed, len(results), 100 * agreed / len(results),
+                  fast_seconds, full_seconds, full_seconds - fast_seconds,
+                  100 * (full_seconds - fast_seconds)
+                  / max(full_seconds, 1e-9)))
+
+
+def get_dir_size(dir_path):
+    """
+    :param dir_path: Path to a directory
+    :return: Integer, the total size in bytes of all files in dir_path and its
+    subdirectories, without following symbolic links
+    """
+    total = 0
+    try:
+        entries = list(os.scandir(dir_path))
+    except OSError:  # Directory was deleted while being measured
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += get_dir_size(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return total
+
+
+def read_scratch_registry(temp_dir):
+    """
+    :param temp_dir: Path to folder containing temporary files
+    :return: Dictionary mapping the name of each registered session folder in
+    temp_dir to the host, process ID, and time of the run that registered it
+    """
+    try:
+        with open(os.path.join(temp_dir, SCRATCH_REGISTRY)) as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_scratch_registry(temp_dir, registry):
+    """
+    Save the session folder registry into temp_dir, replacing it atomically
+    so that a crash never leaves a half-written registry behind.
+    :param temp_dir: Path to folder containing temporary files
+    :param registry: Dictionary returned by read_scratch_registry
+    :return: N/A
+    """
+    registry_path = os.path.join(temp_dir, SCRATCH_REGISTRY)
+    with open(registry_path + ".tmp", "w") as outfile:
+        json.dump(registry, outfile, indent=4)
+    os.replace(registry_path + ".tmp", registry_path)
+
+
+@contextmanager
+def lock_scratch_registry(temp_dir):
+    """
+    Hold an exclusive lock on the session folder registry in temp_dir, so
+    that runs sharing temp_dir never overwrite each other's changes to it.
+    Read, change, and write the registry inside of one with block. The lock
+    is reentrant, so cleanup() can still take it if a signal arrives while
+    this run already holds it.
+    :param temp_dir: Path to folder containing temporary files
+    :return: N/A
+    """
+    if temp_dir in HELD_REGISTRY_LOCKS:
+        yield
+        return
+    lock_path = os.path.join(temp_dir, SCRATCH_REGISTRY + ".lock")
+    with open(lock_path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        HELD_REGISTRY_LOCKS.add(temp_dir)
+        try:
+            yield
+        finally:
+            HELD_REGISTRY_LOCKS.discard(temp_dir)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def is_workspace(entry):
+    """
+    :param entry: os.DirEntry in the temp folder
+    :return: True if entry is a session folder made by unpack_and_setup.sh,
+    and False if it is anything else, e.g. a cache folder kept in temp
+    """
+    return (entry.is_dir(follow_symlinks=False)
+            and fnmatch.fnmatch(entry.name, SCRATCH_WORKSPACE_PATTERN))
+
+
+def is_owned_by_live_run(entry):
+    """
+    :param entry: Dictionary from the scratch registry describing which run
+    registered a session folder
+    :return: True if the run that registered the folder is still running on
+    this host, and False otherwise
+    """
+    if entry.get("host") != socket.gethostname():
+        return True  # Can't check PIDs on other hosts, so assume it's running
+    try:
+        os.kill(entry["pid"], 0)
+    except PermissionError:  # Process exists, but belongs to another user
+        return True
+    except (KeyError, TypeError, OSError):
+        return False
+    return True
+
+
+def register_workspace(temp_dir, subject, session):
+    """
+    Record that this run owns the temp folder which unpack_and_setup.sh uses
+    for one session, so other runs sharing temp_dir will not delete it.
+    :param temp_dir: Path to folder containing temporary files
+    :param subject: String, the BIDS subject ID (sub-...)
+    :param session: String, the BIDS session ID (ses-...)
+    :return: String, the name of the session folder in temp_dir
+    """
+    workspace = "{}_{}".format(subject, session)
+    with lock_scratch_registry(temp_dir):
+        registry = read_scratch_registry(temp_dir)
+        registry[workspace] = {
+            "host": socket.gethostname(), "pid": os.getpid(),
+            "registered": datetime.datetime.now().isoformat()
+        }
+        write_scratch_registry(temp_dir, registry)
+    return workspace
+
+
+def release_workspace(temp_dir, workspace):
+    """
+    Delete a session's temp folder if that session finished being copied to
+    the output folder. Otherwise keep it, so unpack_and_setup.sh can resume
+    the session from its checkpoints the next time it runs.
+    :param temp_dir: Path to folder containing temporary files
+    :param workspace: String, name of the session folder in temp_dir
+    :return: N/A
+    """
+    workspace_path = os.path.join(temp_dir, workspace)
+    if os.path.exists(os.path.join(workspace_path, "checkpoints", "publish")):
+        with lock_scratch_registry(temp_dir):
+            shutil.rmtree(workspace_path, ignore_errors=True)
+            registry = read_scratch_registry(temp_dir)
+            registry.pop(workspace, None)
+            write_scratch_registry(temp_dir, registry)
+    else:
+        print("{} did not finish, so its temp files were kept in {} to "
+              "resume from later.".format(workspace, workspace_path))
+
+
+def recover_orphaned_workspaces(temp_dir, subjects_to_resume=()):
+    """
+    Delete every session folder in temp_dir left behind by a run which crashed
+    or was killed: folders registered by runs which are no longer running, and
+    folders which no run registered at all. Only folders named like session
+    folders (sub-*_ses-*) are considered, so e.g. caches kept in temp_dir are
+    never deleted.
+    :param temp_dir: Path to folder containing temporary files
+    :param subjects_to_resume: BIDS subject IDs whose session folders should
+    be kept because this run will resume them
+    :return: N/A
+    """
+    subjects_to_resume = tuple(sub + "_" for sub in subjects_to_resume)
+    with lock_scratch_registry(temp_dir):
+        registry = read_scratch_registry(temp_dir)
+        for entry in os.scandir(temp_dir):
+            if not is_workspace(entry) or (
+                    entry.name in registry
+                    and is_owned_by_live_run(registry[entry.name])):
+                continue
+            if entry.name.startswith(subjects_to_resume):
+                print("Resuming from leftover temp folder {}".format(
+                    entry.path
+                ))
+                continue
+            print("Removing orphaned temp folder {}".format(entry.path))
+            shutil.rmtree(entry.path, ignore_errors=True)
+            registry.pop(entry.name, None)
+        write_scratch_registry(temp_dir, {
+            name: entry for name, entry in registry.items()
+            if os.path.isdir(os.path.join(temp_dir, name))
+        })
+
+
+def enforce_scratch_quota(temp_dir, quota, active_workspace):
+    """
+    Delete leftover session folders in temp_dir, least recently modified
+    first, until the temp folder's total size is no more than quota. Folders
+    used by this run's active session or by other live runs are never
+    deleted, nor is anything in temp_dir besides session folders (sub-*_ses-*).
+    :param temp_dir: Path to folder containing temporary files
+    :param quota: Integer, maximum total size of temp_dir in bytes
+    :param active_workspace: String, name of the session folder in use now
+    :return: Integer, the total size of temp_dir in bytes afterwards
+    """
+    with lock_scratch_registry(temp_dir):
+        registry = read_scratch_registry(temp_dir)
+        total = get_dir_size(temp_dir)
+        sizes = {entry.path: get_dir_size(entry.path)
+                 for entry in os.scandir(temp_dir) if is_workspace(entry)}
+        evictable = sorted((
+            path for path in sizes
+            if os.path.basename(path) != active_workspace and not (
+                os.path.basename(path) in registry
+                and registry[os.path.basename(path)].get("pid") != os.getpid()
+                and is_owned_by_live_run(registry[os.path.basename(path)])
+            )
+        ), key=os.path.getmtime)
+        while total > quota and evictable:
+            path = evictable.pop(0)
+            print("Temp folder is over its {:.2f} GB quota. Removing {}"
+                  .format(quota / 1024 ** 3, path))
+            shutil.rmtree(path, ignore_errors=True)
+            registry.pop(os.path.basename(path), None)
+            total -= sizes[path]
+        write_scratch_registry(temp_dir, registry)
+    return total
+
+
+def run_and_monitor_scratch(cmd, temp_dir, quota, active_workspace,
+                            env=None):
+    """
+    Run a command like subprocess.check_call, measuring how much space
+    temp_dir uses every SCRATCH_POLL_SECONDS seconds while it runs. If temp_dir
+    grows past quota and no leftover session folders can be deleted to get
+    back under it, stop the command and exit, keeping its temp files so that
+    it can resume later.
+    :param cmd: Tuple of strings, the command to run
+    :param temp_dir: Path to folder containing temporary files
+    :param quota: Integer, maximum total size of temp_dir in bytes, or None
+    :param active_workspace: String, name of the session folder in use now
+    :param env: Dictionary of environment variables to run cmd with
+    :return: Integer, the most space in bytes that temp_dir used during cmd
+    """
+    peak_usage = 0
+    process = subprocess.Popen(cmd, env=env)
+    while True:
+        try:
+            process.wait(timeout=SCRATCH_POLL_SECONDS)
+            break
+        except subprocess.TimeoutExpired:
+            usage = get_dir_size(temp_dir)
+            if quota and usage > quota:
+                usage = enforce_scratch_quota(temp_dir, quota,
+                                              active_workspace)
+                if usage > quota:
+                    process.terminate()
+                    process.wait()
+                    print("Error: {} alone needs more than the {:.2f} GB "
+                          "temp folder quota. Its temp files were kept in {} "
+                          "to resume from later.".format(
+                              active_workspace, quota / 1024 ** 3, temp_dir
+                          ))
+                    sys.exit(1)
+            peak_usage = max(peak_usage, usage)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return max(peak_usage, get_dir_size(temp_dir))
+
 
 def correct_jsons(cli_args):
     """
     Correct ABCD BIDS input data to conform to official BIDS Validator.
     :param cli_args: argparse namespace containing all CLI arguments. This
     function only uses the --output argument, the path to the folder containing
-    corrected NDA data to validate.
+    corrected NDA data to validate, and --correct-jsons-jobs.
     :return: N/A
     """
-    subprocess.check_call((CORRECT_JSONS, cli_args.output))
-
-    # Remove the .json files added to each subject's output directory by
-    # sefm_eval_and_json_editor.py, and the vol*.nii.gz files
-    sub_dirs = os.path.join(cli_args.output, "sub*")
-    for json_path in glob.iglob(os.path.join(sub_dirs, "*.json")):
-        print("Removing .JSON file: {}".format(json_path))
-        os.remove(json_path)
-    for vol_file in glob.iglob(os.path.join(sub_dirs, "ses*", 
-                          "fmap", "vol*.nii.gz")):
-        print("Removing 'vol' file: {}".format(vol_file))
-        os.remove(vol_file)
+    # correct_jsons.py also removes the .json files added to each subject's
+    # output directory by sefm_eval_and_json_editor.py
+    subprocess.check_call((CORRECT_JSONS, cli_args.output, "--jobs",
+                           str(cli_args.correct_jsons_jobs)))
 
 
 def validate_bids(cli_args):
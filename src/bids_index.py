@@ -0,0 +1,636 @@
+#! /usr/bin/env python3
+
+"""
+Indexes of the files in a BIDS dataset
+SessionIndex parses the BIDS entities out of every filename in one subject's
+session folders once, then answers the same get and get_metadata queries
+that sefm_eval_and_json_editor.py used to send to pybids' BIDSLayout, from
+dictionaries instead of its SQL database. Metadata is read from each file's
+own JSON sidecar the first time it is asked for; unlike pybids, metadata
+inherited from JSON files higher up in the dataset is not merged in.
+
+DatasetIndex keeps the same entities for every file in the datatype folders
+of a whole output dataset in an SQLite database saved in the dataset as
+.bids_index.sqlite, along with each file's size and modification time and
+a SHA-256 hash of each JSON sidecar. unpack_and_setup.sh updates it for each
+session it publishes, and later steps list files from it instead of walking
+the whole dataset again. Updating a session only rehashes files whose size
+or modification time changed. Pipeline steps can
+also record which files they processed, and in which state, so that they
+only process new or changed files when they run again.
+
+Each update holds SQLite's write lock on the index from before it scans
+the dataset until its rows are committed, so sessions published at the same
+time are indexed one after another. That relies on file locking, so the
+dataset must not be on a filesystem without working locks, like some NFS
+mounts; otherwise concurrent updates can corrupt the index or lose rows.
+
+Usage:
+  bids_index.py update BIDS_DIR [--session sub-X/ses-Y ...] [--if-incomplete]
+  bids_index.py summary BIDS_DIR
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+INDEX_FILENAME = ".bids_index.sqlite"
+INDEX_VERSION = "1"
+
+# Seconds to wait for another process updating the same index
+LOCK_TIMEOUT = 300
+
+# Datatype folders of the session folders which DatasetIndex indexes
+DATATYPES = ("anat", "func", "fmap", "dwi")
+
+# BIDS filename entity keys and the names pybids queries them by
+ENTITY_NAMES = {"sub": "subject", "ses": "session", "task": "task",
+                "acq": "acquisition", "ce": "ceagent", "dir": "direction",
+                "rec": "reconstruction", "run": "run", "echo": "echo"}
+FILENAME_PATTERN = re.compile(r"^((?:[a-zA-Z]+-[a-zA-Z0-9]+_)*)"
+                              r"([a-zA-Z0-9]+)(\..+)$")
+
+
+def natural_key(text):
+    """
+    :return: Key to sort text by which puts "run-2" before "run-10", like
+    pybids sorts query results
+    """
+    return [int(part) if part.isdigit() else part.lower()
+            for part in re.split("([0-9]+)", text)]
+
+
+def in_folders(session_dir, folders):
+    """
+    :param session_dir: Path to a session or subject folder, relative to root
+    :param folders: Tuple of normalized paths to subject or session folders,
+    relative to root, or None
+    :return: True if session_dir is one of folders or inside one of them, or
+    if folders is None
+    """
+    return folders is None or session_dir in folders or session_dir.startswith(
+        tuple(folder + os.sep for folder in folders)
+    )
+
+
+def normalize_folders(folders):
+    return None if folders is None else tuple(
+        os.path.normpath(folder) for folder in folders
+    )
+
+
+def listify(value):
+    return value if isinstance(value, (list, tuple, set)) else [value]
+
+
+def list_sessions(root):
+    """
+    :param root: Path to a BIDS dataset
+    :return: Dictionary mapping each subject label in root, without "sub-",
+    to a sorted list of its session labels, without "ses-"
+    """
+    subjects = {}
+    for subject_dir in os.scandir(root):
+        if subject_dir.name.startswith("sub-") and subject_dir.is_dir():
+            subjects[subject_dir.name[4:]] = sorted(
+                session_dir.name[4:] for session_dir in
+                os.scandir(subject_dir.path)
+                if session_dir.name.startswith("ses-")
+                and session_dir.is_dir()
+            )
+    return subjects
+
+
+def hash_file(path):
+    """
+    :return: String, hexadecimal SHA-256 hash of the file at path
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class IndexedFile(object):
+    """
+    One file in a session folder, with the attributes of a pybids BIDSFile
+    that the SEFM script uses
+    """
+    __slots__ = ("path", "dirname", "filename", "datatype", "suffix",
+                 "extension", "entities", "_metadata")
+
+    def __init__(self, dirname, filename, datatype):
+        self.dirname = dirname
+        self.filename = filename
+        self.path = os.path.join(dirname, filename)
+        self.datatype = datatype
+        self.suffix = None
+        self.extension = None
+        self.entities = {}
+        self._metadata = None
+        match = FILENAME_PATTERN.match(filename)
+        if match:
+            for pair in match.group(1).split("_")[:-1]:
+                key, value = pair.split("-", 1)
+                self.entities[ENTITY_NAMES.get(key, key)] = value
+            self.suffix = match.group(2)
+            self.extension = match.group(3)
+
+    def get_metadata(self):
+        """
+        :return: Dictionary of the JSON sidecar of this file, read the first
+        time it is asked for, or an empty dictionary if it has none
+        """
+        if self._metadata is None:
+            sidecar = self.path[:-len(self.extension)] + ".json" \
+                if self.extension else self.path
+            try:
+                with open(sidecar) as f:
+                    self._metadata = json.load(f)
+            except (OSError, ValueError):
+                self._metadata = {}
+        return self._metadata
+
+
+class SessionIndex(object):
+    """
+    Every file in the datatype folders of one subject's session folders,
+    grouped by datatype
+    """
+    __slots__ = ("root", "subject", "sessions", "by_datatype", "by_path")
+
+    def __init__(self, root, subject, sessions):
+        """
+        :param root: Path to a BIDS dataset
+        :param subject: Subject label, without "sub-"
+        :param sessions: Session label, list of session labels, or
+        "session" if the subject has no session folders
+        """
+        self.root = root
+        self.subject = subject
+        self.sessions = listify(sessions)
+        self.by_datatype = {}
+        self.by_path = {}
+        subject_dir = os.path.join(root, "sub-" + subject)
+        session_dirs = [subject_dir] if self.sessions == ["session"] else [
+            os.path.join(subject_dir, "ses-" + session)
+            for session in self.sessions
+        ]
+        for session_dir in session_dirs:
+            if not os.path.isdir(session_dir):
+                continue
+            for datatype_dir in os.scandir(session_dir):
+                if not datatype_dir.is_dir():
+                    continue
+                for entry in os.scandir(datatype_dir.path):
+                    if entry.is_file():
+                        indexed = IndexedFile(datatype_dir.path, entry.name,
+                                              datatype_dir.name)
+                        self.by_datatype.setdefault(datatype_dir.name,
+                                                    []).append(indexed)
+                        self.by_path[indexed.path] = indexed
+        for files in self.by_datatype.values():
+            files.sort(key=lambda indexed: natural_key(indexed.path))
+
+    def get(self, datatype=None, suffix=None, extension=None, **entities):
+        """
+        :param extension: Extension or list of extensions, with or without
+        the leading dot
+        :param entities: Entity names mapped to a value or list of values to
+        match, like subject="NDARINV00000000" or direction="AP"
+        :return: List of IndexedFile objects matching every filter, sorted
+        naturally by path
+        """
+        if datatype is None:
+            files = sorted(self.by_path.values(),
+                           key=lambda indexed: natural_key(indexed.path))
+        else:
+            files = self.by_datatype.get(datatype, [])
+        if suffix is not None:
+            files = [f for f in files if f.suffix in listify(suffix)]
+        if extension is not None:
+            extensions = {"." + ext.lstrip(".") for ext in listify(extension)}
+            files = [f for f in files if f.extension in extensions]
+        for name, values in entities.items():
+            values = {str(value) for value in listify(values)}
+            files = [f for f in files if f.entities.get(name) in values]
+        return files
+
+    def get_metadata(self, path):
+        """
+        :param path: Path to a file in the index
+        :return: Dictionary of the JSON sidecar of the file at path
+        """
+        return self.by_path[path].get_metadata()
+
+
+class DatasetIndex(object):
+    """
+    Persistent index of every file in the anat, func, fmap, and dwi folders
+    of the session folders of a BIDS dataset, and directly in its subject
+    folders, saved in the dataset itself
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS settings (
+            name TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, session_dir TEXT NOT NULL,
+            subject TEXT, session TEXT, datatype TEXT, suffix TEXT,
+            extension TEXT, entities TEXT, size INTEGER, mtime_ns INTEGER,
+            sha256 TEXT);
+        CREATE INDEX IF NOT EXISTS files_session_dir ON files (session_dir);
+        CREATE INDEX IF NOT EXISTS files_extension ON files (extension);
+        CREATE TABLE IF NOT EXISTS processed (
+            step TEXT, path TEXT, size INTEGER, mtime_ns INTEGER,
+            sha256 TEXT, PRIMARY KEY (step, path));
+    """
+
+    def __init__(self, root):
+        """
+        :param root: Path to a BIDS dataset. Its index is created empty if
+        the dataset doesn't have one yet
+        """
+        self.root = os.path.abspath(root)
+        self.path = os.path.join(self.root, INDEX_FILENAME)
+        self.connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+        with self.connection:
+            self.connection.executescript(self.SCHEMA)
+            if self.get_setting("version") != INDEX_VERSION:
+                self.connection.execute("DELETE FROM files")
+                self.set_setting("version", INDEX_VERSION)
+                self.set_setting("complete", "0")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def get_setting(self, name):
+        row = self.connection.execute(
+            "SELECT value FROM settings WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_setting(self, name, value):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)",
+            (name, value)
+        )
+
+    def is_complete(self):
+        """
+        :return: True if every session folder in the dataset was indexed by
+        a full update, and only updated incrementally since
+        """
+        return self.get_setting("complete") == "1"
+
+    def relative_path(self, path):
+        """
+        :param path: Path to a file in the dataset
+        :return: Path to the same file, relative to root
+        """
+        if path.startswith(self.root + os.sep):  # Faster than relpath
+            return path[len(self.root) + 1:]
+        return os.path.relpath(path, self.root)
+
+    def file_row(self, path, datatype, session_dir, known):
+        """
+        :param path: Absolute path to a file in a datatype folder
+        :param session_dir: Path to its session folder, relative to root
+        :param known: Dictionary mapping relative paths to the size,
+        modification time, and hash already in the index
+        :return: Tuple of the values of the file's row in the files table
+        """
+        stat = os.stat(path)
+        relative_path = os.path.relpath(path, self.root)
+        indexed = IndexedFile(os.path.dirname(path), os.path.basename(path),
+                              datatype)
+        previous = known.get(relative_path)
+        if previous and previous[:2] == (stat.st_size, stat.st_mtime_ns):
+            sha256 = previous[2]
+        elif indexed.extension == ".json":
+            sha256 = hash_file(path)
+        else:
+            sha256 = None
+        return (relative_path, session_dir, indexed.entities.get("subject"),
+                indexed.entities.get("session"), datatype, indexed.suffix,
+                indexed.extension, json.dumps(indexed.entities),
+                stat.st_size, stat.st_mtime_ns, sha256)
+
+    def write_rows(self, rows):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, "
+            "?, ?)", rows
+        )
+
+    def known_files(self, session_dir):
+        return {row[0]: row[1:] for row in self.connection.execute(
+            "SELECT path, size, mtime_ns, sha256 FROM files WHERE "
+            "session_dir = ?", (session_dir,)
+        )}
+
+    def scan_session(self, session_dir):
+        """
+        :param session_dir: Path to a session folder, like "sub-X/ses-Y",
+        relative to root
+        :return: List of the rows of the files now in the session folder
+        """
+        known = self.known_files(session_dir)
+        rows = []
+        for datatype in DATATYPES:
+            datatype_dir = os.path.join(self.root, session_dir, datatype)
+            if os.path.isdir(datatype_dir):
+                rows += [self.file_row(entry.path, datatype, session_dir,
+                                       known)
+                         for entry in os.scandir(datatype_dir)
+                         if entry.is_file()]
+        return rows
+
+    def scan_subject(self, subject_dir):
+        """
+        :param subject_dir: Path to a subject folder, like "sub-X", relative
+        to root
+        :return: Tuple of the rows of the files directly in the subject
+        folder, which have no datatype, and the list of paths to its session
+        folders, relative to root
+        """
+        known = self.known_files(subject_dir)
+        rows = []
+        session_dirs = []
+        full_path = os.path.join(self.root, subject_dir)
+        if os.path.isdir(full_path):
+            for entry in os.scandir(full_path):
+                if entry.is_file():
+                    rows.append(self.file_row(entry.path, None, subject_dir,
+                                              known))
+                elif entry.name.startswith("ses-") and entry.is_dir():
+                    session_dirs.append(os.path.join(subject_dir,
+                                                     entry.name))
+        return rows, session_dirs
+
+    def update(self, session_dirs=None):
+        """
+        Only the datatype folders of each session folder are searched, along
+        with the files directly in the subject folders of the sessions
+        :param session_dirs: List of paths to session folders, relative to
+        root, to index again. If None, or if the index doesn't cover the
+        whole dataset yet, every session folder is indexed again and rows of
+        session folders which no longer exist are removed
+        :return: Int, number of files in the session folders indexed
+        """
+        with self.connection:
+            # Take the write lock before deciding what to scan and hold it
+            # until the new rows are committed, so that rows committed by a
+            # concurrent update can't be deleted by this one
+            self.connection.execute("BEGIN IMMEDIATE")
+            full = session_dirs is None or not self.is_complete()
+            rows = []
+            if full:
+                session_dirs = []
+                subject_dirs = sorted(
+                    entry.name for entry in os.scandir(self.root)
+                    if entry.name.startswith("sub-") and entry.is_dir()
+                )
+            else:
+                session_dirs = [os.path.normpath(d) for d in session_dirs]
+                subject_dirs = sorted({d.split(os.sep)[0]
+                                       for d in session_dirs})
+            for subject_dir in subject_dirs:
+                subject_rows, subject_session_dirs = self.scan_subject(
+                    subject_dir
+                )
+                rows += subject_rows
+                if full:
+                    session_dirs += subject_session_dirs or [subject_dir]
+            for session_dir in session_dirs:
+                rows += self.scan_session(session_dir)
+            if full:
+                self.connection.execute("DELETE FROM files")
+            else:
+                self.connection.executemany(
+                    "DELETE FROM files WHERE session_dir = ?",
+                    [(session_dir,) for session_dir in session_dirs]
+                )
+                self.connection.executemany(
+                    "DELETE FROM files WHERE session_dir = ? AND "
+                    "datatype IS NULL",
+                    [(subject_dir,) for subject_dir in subject_dirs]
+                )
+            self.write_rows(rows)
+            if full:
+                self.connection.execute(
+                    "DELETE FROM processed WHERE path NOT IN "
+                    "(SELECT path FROM files)"
+                )
+                self.set_setting("complete", "1")
+        return len(rows)
+
+    def update_files(self, paths):
+        """
+        Index files in the dataset again after they were edited or removed.
+        Only the rows of files whose size or modification time changed are
+        written again, so this also cheaply checks many files for changes.
+        :param paths: List of absolute paths to files in datatype folders
+        """
+        rows = []
+        removed = []
+        known = {}
+        for path in paths:
+            relative_path = self.relative_path(path)
+            datatype_dir = os.path.dirname(relative_path)
+            session_dir = os.path.dirname(datatype_dir)
+            if session_dir not in known:
+                known[session_dir] = self.known_files(session_dir)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                removed.append((relative_path,))
+                continue
+            previous = known[session_dir].get(relative_path)
+            if not previous or previous[:2] != (stat.st_size,
+                                                stat.st_mtime_ns):
+                rows.append(self.file_row(
+                    os.path.join(self.root, relative_path),
+                    os.path.basename(datatype_dir), session_dir,
+                    known[session_dir]
+                ))
+        with self.connection:
+            self.write_rows(rows)
+            self.connection.executemany("DELETE FROM files WHERE path = ?",
+                                        removed)
+
+    def files(self, extension=None, datatype=None, subjects=None,
+              folders=None, unprocessed_by=None):
+        """
+        :param extension: Extension, with its leading dot, to filter on
+        :param datatype: Datatype folder name to filter on
+        :param subjects: List of subject labels, without "sub-", to filter on
+        :param folders: List of paths to subject or session folders, like
+        "sub-X" or "sub-X/ses-Y", relative to root, to only return the files
+        in
+        :param unprocessed_by: Name of a pipeline step. If given, only return
+        files which that step hasn't processed in their current state, i.e.
+        which weren't marked as processed by it with the same size,
+        modification time, and hash
+        :return: List of absolute paths to the matching files in the index,
+        sorted naturally
+        """
+        query = "SELECT f.path, f.subject, f.session_dir FROM files f"
+        values = []
+        if unprocessed_by is not None:
+            query += (" LEFT JOIN processed p ON p.step = ? AND "
+                      "p.path = f.path")
+            values.append(unprocessed_by)
+        query += " WHERE 1"
+        for column, value in (("extension", extension),
+                              ("datatype", datatype)):
+            if value is not None:
+                query += " AND f.{} = ?".format(column)
+                values.append(value)
+        if unprocessed_by is not None:
+            query += (" AND (p.path IS NULL OR p.size IS NOT f.size OR "
+                      "p.mtime_ns IS NOT f.mtime_ns OR "
+                      "p.sha256 IS NOT f.sha256)")
+        subjects = None if subjects is None else set(subjects)
+        folders = normalize_folders(folders)
+        return sorted((os.path.join(self.root, path)
+                       for path, subject, session_dir in
+                       self.connection.execute(query, values)
+                       if (subjects is None or subject in subjects) and
+                       in_folders(session_dir, folders)),
+                      key=natural_key)
+
+    def mark_processed(self, step, paths):
+        """
+        Record that a pipeline step processed files in their current state
+        :param step: Name of the pipeline step
+        :param paths: List of absolute paths to files in the index
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO processed (step, path, size, "
+                "mtime_ns, sha256) SELECT ?, path, size, mtime_ns, sha256 "
+                "FROM files WHERE path = ?",
+                [(step, os.path.relpath(path, self.root)) for path in paths]
+            )
+
+    def subject_files(self, folders=None):
+        """
+        :param folders: List of paths to subject or session folders, like
+        "sub-X" or "sub-X/ses-Y", relative to root, to only return the files
+        in
+        :return: List of absolute paths to the files directly in subject
+        folders, which have no datatype, sorted naturally
+        """
+        folders = normalize_folders(folders)
+        return sorted((os.path.join(self.root, path) for path, session_dir in
+                       self.connection.execute(
+                           "SELECT path, session_dir FROM files WHERE "
+                           "datatype IS NULL"
+                       ) if in_folders(session_dir, folders)),
+                      key=natural_key)
+
+    def summary(self):
+        """
+        :return: Tuple of the numbers of session folders and files indexed
+        """
+        return self.connection.execute(
+            "SELECT COUNT(DISTINCT CASE WHEN datatype IS NOT NULL THEN "
+            "session_dir END), COUNT(*) FROM files"
+        ).fetchone()
+
+
+def load_dataset_index(root):
+    """
+    :param root: Path to a BIDS dataset
+    :return: DatasetIndex of root, after indexing the whole dataset if its
+    index didn't cover all of it yet
+    """
+    index = DatasetIndex(root)
+    if not index.is_complete():
+        index.update()
+    return index
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    update = subparsers.add_parser(
+        "update",
+        help="Create or update the index of a BIDS folder."
+    )
+    update.add_argument(
+        "bids_dir",
+        help="Path to a BIDS folder."
+    )
+    update.add_argument(
+        "--session", dest="sessions", action="append",
+        help="Path to a session folder to index again, like sub-X/ses-Y, "
+             "relative to the BIDS folder. Can be given more than once. By "
+             "default, or if the BIDS folder has no complete index yet, "
+             "every session folder is indexed."
+    )
+    update.add_argument(
+        "--if-incomplete", action="store_true",
+        help="Only index the BIDS folder if it has no complete index yet. "
+             "Otherwise leave its index as it is."
+    )
+
+    summary = subparsers.add_parser(
+        "summary",
+        help="Print how many session folders and files a BIDS folder's index "
+             "has."
+    )
+    summary.add_argument(
+        "bids_dir",
+        help="Path to a BIDS folder."
+    )
+    return parser
+
+
+def main(argv=sys.argv):
+    args = generate_parser().parse_args(argv[1:])
+
+    if args.command == "update":
+        started = time.time()
+        with DatasetIndex(args.bids_dir) as index:
+            if args.if_incomplete and index.is_complete():
+                count = 0
+            else:
+                count = index.update(args.sessions)
+            sessions, files = index.summary()
+        print("Indexed {} file(s) in {:.1f} seconds; the index of {} has {} "
+              "file(s) in {} session folder(s)".format(
+                  count, time.time() - started, args.bids_dir, files,
+                  sessions))
+
+    elif args.command == "summary":
+        if not os.path.exists(os.path.join(args.bids_dir, INDEX_FILENAME)):
+            print("ERROR: {} has no index. Build one with 'bids_index.py "
+                  "update' first.".format(args.bids_dir))
+            return 1
+        with DatasetIndex(args.bids_dir) as index:
+            sessions, files = index.summary()
+            print("{} file(s) in {} session folder(s){}".format(
+                files, sessions,
+                "" if index.is_complete() else " (incomplete index)"
+            ))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,714 @@
+#! /usr/bin/env python3
+
+"""
+Convert one session's DICOM series to NIfTI in BIDS format
+Runs dcm2niix on each series folder separately, optionally several at once.
+Series which were converted before by the same dcm2niix version with the same
+options are restored from a conversion cache instead of being converted again.
+
+With --naming dcm2bids (the default), the outputs are written into the
+temporary folder which dcm2bids reads its dcm2niix outputs from. Afterwards,
+dcm2bids must be run WITHOUT --forceDcm2niix so that it uses these outputs.
+
+With --naming internal, dcm2bids is not needed: each series is classified by
+its sidecar using the descriptions in the config file, then converted
+straight to its final BIDS file name.
+
+NIfTIs can be gzipped with pigz on every core, gzipped by dcm2niix on one
+core, or left uncompressed as .nii, at a chosen compression level. The size
+and throughput of the outputs are reported so these can be compared.
+"""
+
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel
+import numpy as np
+
+try:
+    from series_classifier import Sidecar, SeriesClassifier, split_ext
+except ImportError:
+    from src.series_classifier import Sidecar, SeriesClassifier, split_ext
+
+# Defaults used by dcm2bids 2.1.4, so that outputs are named the same way
+DCM2NIIX_OPTIONS = "-b y -ba y -z y -f '%3s_%f_%p_%t'"
+TMP_DIR_NAME = "tmp_dcm2bids"
+
+# dcm2niix exit code when a folder has no DICOMs to convert
+DCM2NIIX_NO_DICOMS = 2
+
+# dcm2niix options for each way of writing NIfTIs: gzipped by pigz, which
+# uses every core, gzipped by dcm2niix itself on one core, or uncompressed
+COMPRESSION_OPTIONS = {'pigz': ['-z', 'y'], 'gzip': ['-z', 'i'],
+                       'none': ['-z', 'n']}
+
+CACHE_SIZE_GB = 100
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__
+    )
+    parser.add_argument(
+        'dicom_dir',
+        help='Path to the folder containing all of the DICOM series folders '
+             'of one participant, i.e. the folder given to dcm2bids -d.'
+    )
+    parser.add_argument(
+        'participant',
+        help='Participant label, with or without "sub-".'
+    )
+    parser.add_argument(
+        'session',
+        help='Session label, with or without "ses-".'
+    )
+    parser.add_argument(
+        'config',
+        help='Path to the dcm2bids config file, e.g. abcd_dcm2bids.conf.'
+    )
+    parser.add_argument(
+        'output_dir',
+        help='Path to the BIDS output folder, i.e. the folder given to '
+             'dcm2bids -o.'
+    )
+    parser.add_argument(
+        '--cache-dir', dest='cache_dir', default=None,
+        help='Folder to keep converted series in, so that they can be '
+             'restored instead of converted again. By default, no cache is '
+             'used.'
+    )
+    parser.add_argument(
+        '--cache-size', dest='cache_size', type=float, default=CACHE_SIZE_GB,
+        help='Maximum size of the conversion cache in gigabytes. The least '
+             'recently used series are deleted from the cache once it gets '
+             'bigger than this. Default: {} GB.'.format(CACHE_SIZE_GB)
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of series to convert at the same time. Default: 1.'
+    )
+    parser.add_argument(
+        '--naming', choices=['dcm2bids', 'internal'], default='dcm2bids',
+        help='Whether to leave naming the outputs to dcm2bids, or to classify '
+             'each series with the config file and convert it straight to '
+             'its BIDS file name. Default: dcm2bids.'
+    )
+    parser.add_argument(
+        '--compression', choices=sorted(COMPRESSION_OPTIONS), default=None,
+        help='How to write NIfTIs: gzipped with pigz on every core (needs '
+             'pigz on the PATH), gzipped by dcm2niix on one core, or '
+             'uncompressed as .nii. By default, the config file\'s '
+             'dcm2niixOptions decide.'
+    )
+    parser.add_argument(
+        '--compression-level', dest='compression_level', type=int,
+        choices=range(1, 10), metavar='{1-9}', default=None,
+        help='gzip compression level, from 1 (fastest, biggest files) to 9 '
+             '(slowest, smallest files). Default: dcm2niix\'s default, 6.'
+    )
+    parser.add_argument(
+        '--benchmark', action='store_true',
+        help='Also convert the session one series at a time, and with one '
+             'dcm2niix call over the whole DICOM folder like before, into '
+             'temporary folders without the cache, then report the wall '
+             'times and whether every conversion made identical outputs.'
+    )
+    return parser
+
+
+def get_bids_labels(participant, session):
+    """
+    :return: Tuple of 'sub-<participant>' and 'ses-<session>'
+    """
+    if not participant.startswith('sub-'):
+        participant = 'sub-' + participant
+    if not session.startswith('ses-'):
+        session = 'ses-' + session
+    return participant, session
+
+
+def get_dcm2niix_options(config_path, compression=None, level=None):
+    """
+    :param config_path: Path to dcm2bids config file
+    :param compression: Optional key of COMPRESSION_OPTIONS to override the
+    config file's compression with
+    :param level: Optional int, gzip compression level from 1 to 9
+    :return: List of dcm2niix options from the config file, or the dcm2bids
+    defaults. '-d 0' is added so that each call converts only one folder.
+    Later options override earlier ones in dcm2niix, so the compression
+    options are added at the end.
+    """
+    with open(config_path) as f:
+        config = json.load(f)
+    options = shlex.split(config.get('dcm2niixOptions', DCM2NIIX_OPTIONS)) + \
+        ['-d', '0']
+    if compression:
+        options += COMPRESSION_OPTIONS[compression]
+    if level:
+        options.append('-{}'.format(level))
+    return options
+
+
+def fill_folder_name(options, dicom_dir):
+    """
+    dcm2niix fills %f in its -f file name format with the name of the folder
+    it was given. Given one series folder at a time, it would use the series
+    folder's name instead of the DICOM folder's name which one call over the
+    whole DICOM folder uses, so fill in the DICOM folder's name beforehand.
+    :param options: List of dcm2niix options
+    :param dicom_dir: Path to a participant's DICOM folder
+    :return: List of dcm2niix options with %f filled in
+    """
+    folder_name = os.path.basename(os.path.normpath(dicom_dir))
+    return [option.replace('%f', folder_name)
+            if i and options[i - 1] == '-f' else option
+            for i, option in enumerate(options)]
+
+
+def get_nifti_extension(options):
+    """
+    :param options: List of dcm2niix options
+    :return: Extension of the NIfTIs dcm2niix writes with options
+    """
+    compress = 'y'
+    for i, option in enumerate(options[:-1]):
+        if option == '-z':
+            compress = options[i + 1]
+    return '.nii' if compress == 'n' else '.nii.gz'
+
+
+def get_dcm2niix_version():
+    """
+    :return: String with the version of the dcm2niix executable on the PATH
+    """
+    output = subprocess.run(['dcm2niix'], stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT).stdout.decode()
+    version = re.search(r'version (v\S+)', output)
+    if version:
+        return version.group(1)
+    return output.splitlines()[0] if output else 'unknown'
+
+
+def find_series_dirs(dicom_dir):
+    """
+    :param dicom_dir: Path to a participant's DICOM folder
+    :return: Sorted list of paths to every folder in dicom_dir which has files
+    but no subfolders, i.e. each series folder unpacked from the tgzs
+    """
+    series_dirs = []
+    for root, dirs, files in os.walk(dicom_dir):
+        if files and not dirs:
+            series_dirs.append(root)
+    return sorted(series_dirs)
+
+
+def hash_series(series_dir, version, options):
+    """
+    :param series_dir: Path to a folder of DICOMs from one series
+    :param version: String, dcm2niix version
+    :param options: List of dcm2niix options
+    :return: String, hex digest identifying the outputs dcm2niix will make
+    from series_dir, based on the DICOMs' names and contents, the series
+    folder name (which dcm2niix puts into output file names), the dcm2niix
+    version, and the dcm2niix options
+    """
+    series_hash = hashlib.sha256()
+    for value in [version, ' '.join(options), os.path.basename(series_dir)]:
+        series_hash.update(value.encode() + b'\0')
+    for filename in sorted(os.listdir(series_dir)):
+        series_hash.update(filename.encode() + b'\0')
+        with open(os.path.join(series_dir, filename), 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                series_hash.update(chunk)
+    return series_hash.hexdigest()
+
+
+def get_dir_size(dir_path):
+    return sum(entry.stat().st_size for entry in os.scandir(dir_path)
+               if entry.is_file())
+
+
+def restore_from_cache(cache_dir, key, out_dir):
+    """
+    Copy the cached outputs of one series into out_dir, if they exist. Copies
+    are used instead of links because later steps edit some outputs in place.
+    :return: List of restored file names, or None if the series isn't cached
+    """
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return None
+    restored = []
+    for filename in sorted(os.listdir(entry)):
+        shutil.copy2(os.path.join(entry, filename),
+                     os.path.join(out_dir, filename))
+        restored.append(filename)
+    # Mark entry as most recently used
+    os.utime(entry)
+    return restored
+
+
+def save_to_cache(cache_dir, key, out_dir, filenames, cache_names=None):
+    """
+    Copy one series' outputs from out_dir into the cache. The entry is built
+    under a temporary name and then renamed, so an interrupted save never
+    leaves a partial entry behind.
+    :param cache_names: Optional list of names to save filenames as, to keep
+    the names dcm2niix would have given outputs which were renamed
+    """
+    entry = os.path.join(cache_dir, key)
+    partial = '{}.partial-{}'.format(entry, os.getpid())
+    os.makedirs(partial, exist_ok=True)
+    for filename, cache_name in zip(filenames, cache_names or filenames):
+        shutil.copy2(os.path.join(out_dir, filename),
+                     os.path.join(partial, cache_name))
+    try:
+        os.rename(partial, entry)
+    except OSError:  # Another process cached this series first
+        shutil.rmtree(partial, ignore_errors=True)
+
+
+def evict_from_cache(cache_dir, max_bytes):
+    """
+    Delete the least recently used cache entries until the cache is no
+    bigger than max_bytes.
+    """
+    entries = [entry for entry in os.scandir(cache_dir)
+               if entry.is_dir() and '.partial-' not in entry.name]
+    sizes = {entry.path: get_dir_size(entry.path) for entry in entries}
+    total = sum(sizes.values())
+    for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+        if total <= max_bytes:
+            break
+        print('Evicting {} from conversion cache'.format(entry.name))
+        shutil.rmtree(entry.path, ignore_errors=True)
+        total -= sizes[entry.path]
+
+
+def convert_series(series_dir, staging_dir, options):
+    """
+    Run dcm2niix on one series folder.
+    :return: List of names of the files dcm2niix wrote into staging_dir
+    """
+    os.makedirs(staging_dir, exist_ok=True)
+    cmd = ['dcm2niix'] + options + ['-o', staging_dir, series_dir]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    if result.returncode not in (0, DCM2NIIX_NO_DICOMS):
+        print(result.stdout.decode())
+        raise subprocess.CalledProcessError(result.returncode, cmd)
+    return sorted(os.listdir(staging_dir))
+
+
+def prepare_series(i, series_dir, out_dir, options, version, cache_dir=None):
+    """
+    Convert one series folder, or restore it from the cache, into its own
+    staging folder inside out_dir.
+    :return: Tuple of the staging folder path, the names of the files in it,
+    and whether they were restored from the cache
+    """
+    staging_dir = os.path.join(out_dir, 'series-{}'.format(i))
+    os.makedirs(staging_dir, exist_ok=True)
+    key = None
+    if cache_dir:
+        key = hash_series(series_dir, version, options)
+        filenames = restore_from_cache(cache_dir, key, staging_dir)
+        if filenames is not None:
+            print('Restored {} from conversion cache'.format(series_dir))
+            return staging_dir, filenames, True
+
+    print('Converting {}'.format(series_dir))
+    filenames = convert_series(series_dir, staging_dir, options)
+    if key:
+        save_to_cache(cache_dir, key, staging_dir, filenames)
+    return staging_dir, filenames, False
+
+
+def convert_session(series_dirs, out_dir, options, version, cache_dir=None,
+                    jobs=1):
+    """
+    Convert every series folder into out_dir, using the cache if given, with
+    up to jobs series being converted at once.
+    :return: Tuple of the number of series converted and restored from cache
+    """
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        results = list(pool.map(
+            lambda i_dir: prepare_series(i_dir[0], i_dir[1], out_dir, options,
+                                         version, cache_dir),
+            enumerate(series_dirs)
+        ))
+
+    # One dcm2niix call over the whole DICOM folder would rename the second
+    # of two outputs with the same name instead of replacing the first, so
+    # stop before moving anything rather than lose one of them
+    series_of = {}
+    for series_dir, (_, filenames, _) in zip(series_dirs, results):
+        for filename in filenames:
+            if filename in series_of or os.path.exists(
+                    os.path.join(out_dir, filename)):
+                raise FileExistsError(
+                    'Series {} and {} both have an output named {}'.format(
+                        series_of.get(filename, out_dir), series_dir, filename
+                    )
+                )
+            series_of[filename] = series_dir
+
+    # Move outputs in series order so that the result doesn't depend on
+    # which series finished converting first
+    converted = restored = 0
+    for series_dir, (staging_dir, filenames, from_cache) in zip(series_dirs,
+                                                                results):
+        for filename in filenames:
+            os.replace(os.path.join(staging_dir, filename),
+                       os.path.join(out_dir, filename))
+        os.rmdir(staging_dir)
+        if from_cache:
+            restored += 1
+        else:
+            converted += 1
+    return converted, restored
+
+
+def scan_series(i, series_dir, out_dir, options, version, cache_dir=None):
+    """
+    Restore one series from the cache, or else write only its sidecars, into
+    its own staging folder inside out_dir, so it can be classified before it
+    is converted.
+    :return: Tuple of the staging folder path, the names of the files in it,
+    whether they were restored from the cache, and the series' cache key
+    """
+    staging_dir = os.path.join(out_dir, 'series-{}'.format(i))
+    os.makedirs(staging_dir, exist_ok=True)
+    key = None
+    if cache_dir:
+        key = hash_series(series_dir, version, options)
+        filenames = restore_from_cache(cache_dir, key, staging_dir)
+        if filenames is not None:
+            print('Restored {} from conversion cache'.format(series_dir))
+            return staging_dir, filenames, True, key
+    return (staging_dir, convert_series(series_dir, staging_dir,
+                                        options + ['-b', 'o']), False, key)
+
+
+def write_sidecar(json_path, data):
+    with open(json_path, 'w') as f:
+        json.dump(data, f, indent=4)
+
+
+def move_acquisition(acquisition, bids_dir, classifier, prefix):
+    """
+    Move every output file of one acquisition to its BIDS path, rewriting
+    its sidecar the way dcm2bids does.
+    """
+    dst_root = os.path.join(bids_dir, acquisition.dst_root)
+    os.makedirs(os.path.dirname(dst_root), exist_ok=True)
+    for src_file in glob.glob(glob.escape(acquisition.src_root) + '.*'):
+        ext = split_ext(src_file)[1]
+        if ext == '.json':
+            data = Sidecar(src_file).orig_data
+            write_sidecar(dst_root + ext, classifier.sidecar_data(
+                acquisition._replace(data=data), prefix
+            ))
+            os.remove(src_file)
+        else:
+            os.replace(src_file, dst_root + ext)
+
+
+def convert_straight_to_bids(acquisition, series_dir, bids_dir, classifier,
+                             prefix, options, cache_dir=None, key=None):
+    """
+    Convert a series with exactly one output straight to its BIDS path.
+    """
+    dst_dir, dst_name = os.path.split(os.path.join(bids_dir,
+                                                   acquisition.dst_root))
+    os.makedirs(dst_dir, exist_ok=True)
+    cmd = (['dcm2niix'] + options
+           + ['-w', '1', '-f', dst_name, '-o', dst_dir, series_dir])
+    result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    filenames = sorted(f for f in os.listdir(dst_dir)
+                       if split_ext(f)[0] == dst_name)
+    if result.returncode or dst_name + '.json' not in filenames:
+        print(result.stdout.decode())
+        raise subprocess.CalledProcessError(result.returncode, cmd)
+
+    if key:
+        src_name = os.path.basename(acquisition.src_root)
+        save_to_cache(cache_dir, key, dst_dir, filenames,
+                      [src_name + split_ext(f)[1] for f in filenames])
+    json_path = os.path.join(dst_dir, dst_name + '.json')
+    write_sidecar(json_path, classifier.sidecar_data(
+        acquisition._replace(data=Sidecar(json_path).orig_data), prefix
+    ))
+
+
+def convert_session_to_bids(series_dirs, bids_dir, participant, session,
+                            classifier, options, version, cache_dir=None,
+                            jobs=1):
+    """
+    Classify every series folder by its sidecar, then convert each one that
+    matches exactly one config description straight to its BIDS path, with
+    up to jobs series being converted at once. Series which do not match
+    are not converted, just as dcm2bids would not use them.
+    :return: Tuple of the number of series converted and restored from cache
+    """
+    prefix = participant + '_' + session
+    staging_root = os.path.join(bids_dir, TMP_DIR_NAME, prefix)
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        scans = list(pool.map(
+            lambda i_dir: scan_series(i_dir[0], i_dir[1], staging_root,
+                                      options, version, cache_dir),
+            enumerate(series_dirs)
+        ))
+
+    sidecar_paths = []
+    series_of = {}
+    for i, (staging_dir, filenames, _, _) in enumerate(scans):
+        for filename in filenames:
+            if filename.endswith('.json'):
+                sidecar_paths.append(os.path.join(staging_dir, filename))
+                series_of[split_ext(sidecar_paths[-1])[0]] = i
+    acquisitions = defaultdict(list)
+    for acq in classifier.classify(sidecar_paths, participant, session):
+        acquisitions[series_of[acq.src_root]].append(acq)
+
+    def finish_series(i):
+        staging_dir, filenames, from_cache, key = scans[i]
+        if not acquisitions[i]:
+            return None
+        if not from_cache:
+            print('Converting {}'.format(series_dirs[i]))
+            if [f.endswith('.json') for f in filenames].count(True) == 1:
+                convert_straight_to_bids(acquisitions[i][0], series_dirs[i],
+                                         bids_dir, classifier, prefix,
+                                         options, cache_dir, key)
+                return False
+
+            # A series with several outputs is converted into its staging
+            # folder first, and then each output is moved to its BIDS path
+            shutil.rmtree(staging_dir)
+            filenames = convert_series(series_dirs[i], staging_dir, options)
+            if key:
+                save_to_cache(cache_dir, key, staging_dir, filenames)
+        for acq in acquisitions[i]:
+            move_acquisition(acq, bids_dir, classifier, prefix)
+        return from_cache
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        results = list(pool.map(finish_series, range(len(series_dirs))))
+    shutil.rmtree(staging_root, ignore_errors=True)
+    return results.count(False), results.count(True)
+
+
+def run_conversion(series_dirs, bids_dir, participant, session, options,
+                   version, classifier=None, cache_dir=None, jobs=1):
+    """
+    Convert every series folder, naming the outputs with the classifier if
+    one is given, or leaving them for dcm2bids to name otherwise.
+    :return: Tuple of the number of series converted, the number restored
+    from the cache, and the path to the folder containing the outputs
+    """
+    tmp_dir = os.path.join(bids_dir, TMP_DIR_NAME, participant + '_' + session)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    if classifier:
+        return convert_session_to_bids(
+            series_dirs, bids_dir, participant, session, classifier, options,
+            version, cache_dir, jobs
+        ) + (os.path.join(bids_dir, participant, session),)
+    return convert_session(series_dirs, tmp_dir, options, version, cache_dir,
+                           jobs) + (tmp_dir,)
+
+
+def hash_outputs(out_dir):
+    """
+    :return: Dictionary mapping the path of each file in out_dir, relative to
+    out_dir, to a hash of its contents, decompressing .gz files so that gzip
+    headers are ignored
+    """
+    hashes = {}
+    for root, _, files in os.walk(out_dir):
+        for filename in files:
+            opener = gzip.open if filename.endswith('.gz') else open
+            file_hash = hashlib.sha256()
+            with opener(os.path.join(root, filename), 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    file_hash.update(chunk)
+            hashes[os.path.relpath(os.path.join(root, filename),
+                                   out_dir)] = file_hash.hexdigest()
+    return hashes
+
+
+def get_nifti_sizes(out_dir):
+    """
+    :return: Tuple of the number of NIfTIs in out_dir and its subfolders,
+    their total size on disk in bytes, and their total uncompressed size in
+    bytes, calculated from each NIfTI's header
+    """
+    count = disk_bytes = raw_bytes = 0
+    for root, _, files in os.walk(out_dir):
+        for filename in files:
+            if not filename.endswith(('.nii', '.nii.gz')):
+                continue
+            path = os.path.join(root, filename)
+            # The size at the end of a gzip file is only the uncompressed
+            # size modulo 2 ** 32, which is wrong for NIfTIs of 4 GB or more,
+            # so use the size of the header and image data instead
+            image = nibabel.load(path)
+            count += 1
+            disk_bytes += os.path.getsize(path)
+            raw_bytes += (int(image.dataobj.offset) +
+                          int(np.prod(image.shape)) *
+                          image.get_data_dtype().itemsize)
+    return count, disk_bytes, raw_bytes
+
+
+def benchmark_serial(series_dirs, bids_dir, participant, session, options,
+                     version, classifier=None):
+    """
+    Convert every series folder one at a time into a temporary BIDS folder
+    inside bids_dir, without the cache.
+    :return: Tuple of the wall time in seconds and hash_outputs of the result
+    """
+    os.makedirs(os.path.join(bids_dir, TMP_DIR_NAME), exist_ok=True)
+    serial_dir = tempfile.mkdtemp(prefix='serial-',
+                                  dir=os.path.join(bids_dir, TMP_DIR_NAME))
+    try:
+        start = time.time()
+        out_dir = run_conversion(series_dirs, serial_dir, participant,
+                                 session, options, version, classifier)[2]
+        return time.time() - start, hash_outputs(out_dir)
+    finally:
+        shutil.rmtree(serial_dir, ignore_errors=True)
+
+
+def benchmark_single_call(dicom_dir, bids_dir, participant, session, config,
+                          options, classifier=None):
+    """
+    Convert the session the way it was converted before series were
+    converted separately: with one dcm2niix call over the whole DICOM
+    folder, like dcm2bids makes, into a temporary BIDS folder inside
+    bids_dir. With the classifier, dcm2bids then names the outputs, so it
+    must be on the PATH.
+    :return: Tuple of the wall time in seconds and hash_outputs of the result,
+    laid out like the output of run_conversion, or None if dcm2bids is needed
+    but not found
+    """
+    if classifier and not shutil.which('dcm2bids'):
+        return None
+    os.makedirs(os.path.join(bids_dir, TMP_DIR_NAME), exist_ok=True)
+    single_dir = tempfile.mkdtemp(prefix='single-',
+                                  dir=os.path.join(bids_dir, TMP_DIR_NAME))
+    try:
+        tmp_dir = os.path.join(single_dir, TMP_DIR_NAME,
+                               participant + '_' + session)
+        os.makedirs(tmp_dir)
+        # Drop the '-d 0' which limits each call to one series folder
+        depth = options.index('-d')
+        cmd = (['dcm2niix'] + options[:depth] + options[depth + 2:]
+               + ['-o', tmp_dir, dicom_dir])
+        start = time.time()
+        subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+        if not classifier:
+            return time.time() - start, hash_outputs(tmp_dir)
+        subprocess.run(['dcm2bids', '-d', dicom_dir,
+                        '-p', participant.replace('sub-', '', 1),
+                        '-s', session.replace('ses-', '', 1), '-c', config,
+                        '-o', single_dir, '--clobber'],
+                       stdout=subprocess.PIPE, check=True)
+        return time.time() - start, hash_outputs(
+            os.path.join(single_dir, participant, session)
+        )
+    finally:
+        shutil.rmtree(single_dir, ignore_errors=True)
+
+
+def main():
+    args = generate_parser().parse_args()
+
+    participant, session = get_bids_labels(args.participant, args.session)
+    options = get_dcm2niix_options(args.config, args.compression,
+                                   args.compression_level)
+    classifier = None
+    if args.naming == 'internal':
+        classifier = SeriesClassifier(args.config,
+                                      get_nifti_extension(options))
+
+    version = get_dcm2niix_version()
+    print('dcm2niix version: {}'.format(version))
+    if args.cache_dir:
+        os.makedirs(args.cache_dir, exist_ok=True)
+
+    series_dirs = find_series_dirs(args.dicom_dir)
+    series_options = fill_folder_name(options, args.dicom_dir)
+    if args.benchmark:
+        serial_time, serial_hashes = benchmark_serial(
+            series_dirs, args.output_dir, participant, session,
+            series_options, version, classifier
+        )
+        single_call = benchmark_single_call(
+            args.dicom_dir, args.output_dir, participant, session,
+            args.config, options, classifier
+        )
+
+    start = time.time()
+    converted, restored, out_dir = run_conversion(
+        series_dirs, args.output_dir, participant, session, series_options,
+        version, classifier, args.cache_dir, args.jobs
+    )
+    wall_time = time.time() - start
+    print('Converted {} and restored {} of {} series in {:.1f} seconds using '
+          '{} job(s)'.format(converted, restored, len(series_dirs), wall_time,
+                             args.jobs))
+    count, disk_bytes, raw_bytes = get_nifti_sizes(out_dir)
+    print('Wrote {} NIfTI(s) as {}: {:.1f} MB on disk, {:.0%} of {:.1f} MB '
+          'uncompressed, at {:.1f} MB/s uncompressed'.format(
+              count, get_nifti_extension(options), disk_bytes / 1024 ** 2,
+              disk_bytes / max(raw_bytes, 1), raw_bytes / 1024 ** 2,
+              raw_bytes / 1024 ** 2 / max(wall_time, 1e-9)
+          ))
+
+    if args.benchmark:
+        print('Benchmark for {}: {:.1f} seconds with 1 job, {:.1f} seconds with '
+              '{} job(s), {:.2f}x speedup'.format(
+                  participant + '_' + session, serial_time,
+                  wall_time, args.jobs, serial_time / max(wall_time, 1e-9)
+              ))
+        out_hashes = hash_outputs(out_dir)
+        if out_hashes == serial_hashes:
+            print('Benchmark outputs are identical')
+        else:
+            print('ERROR: Benchmark outputs differ between 1 job and {} '
+                  'job(s)'.format(args.jobs))
+            return 1
+        if single_call is None:
+            print('Skipped comparing against one dcm2niix call over the '
+                  'whole DICOM folder, because dcm2bids is not on the PATH')
+        elif out_hashes == single_call[1]:
+            print('Benchmark outputs are identical to one dcm2niix call '
+                  'over the whole DICOM folder, which took {:.1f} '
+                  'seconds'.format(single_call[0]))
+        else:
+            print('ERROR: Benchmark outputs differ from one dcm2niix call '
+                  'over the whole DICOM folder')
+            return 1
+
+    if args.cache_dir:
+        evict_from_cache(args.cache_dir, args.cache_size * 1024 ** 3)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
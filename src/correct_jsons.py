@@ -1,13 +1,19 @@
 #! /usr/bin/env python3
 
-import json,os,sys,argparse,re
+import json,os,sys,argparse,re,time,shutil,tempfile
+from concurrent.futures import ThreadPoolExecutor
+from bids_index import load_dataset_index
 
 __doc__ = \
 """
 This scripts is meant to correct ABCD BIDS input data to
 conform to the Official BIDS Validator.
 """
-__version__ = "1.0.0"
+__version__ = "1.1.0"
+
+# Name the sidecars processed by this version of the rules are recorded
+# under in the dataset index, so that changing the rules processes them again
+MANIFEST_STEP = 'correct_jsons ' + __version__
 
 def read_json_field(json_path, json_field):
 
@@ -52,70 +58,379 @@ def update_json_field(json_path, json_field, value):
 
     return flag
 
+def match_nifti_extension(fmap_dir, intended_path):
+    """
+    :param fmap_dir: Path to the fmap folder of the JSON with intended_path
+    :param intended_path: Path to a NIfTI from an IntendedFor field, relative
+    to the session or subject folder
+    :return: intended_path, with its extension changed to .nii or .nii.gz if
+    only the NIfTI with that extension exists
+    """
+    root = re.sub(r'\.nii(\.gz)?$', '', intended_path)
+    if root == intended_path:
+        return intended_path
+    session_dir = os.path.dirname(fmap_dir)
+    for base_dir in (session_dir, os.path.dirname(session_dir)):
+        if os.path.exists(os.path.join(base_dir, intended_path)):
+            return intended_path
+        for ext in ('.nii.gz', '.nii'):
+            if os.path.exists(os.path.join(base_dir, root + ext)):
+                return root + ext
+    return intended_path
+
+def fix_total_readout_time(json_path, datatype, data):
+    """
+    Calculate a missing TotalReadoutTime of a fmap or func JSON from its
+    EffectiveEchoSpacing and ReconMatrixPE
+    :return: True if data was changed
+    """
+    if datatype not in ('fmap', 'func') or 'TotalReadoutTime' in data:
+        return False
+
+    # If EffectiveEchoSpacing is missing print error
+    if 'EffectiveEchoSpacing' not in data:
+        print(json_path + ': No EffectiveEchoSpacing')
+
+    # If ReconMatrixPE is missing print error
+    if 'ReconMatrixPE' not in data:
+        print(json_path + ': No ReconMatrixPE')
+
+    if 'EffectiveEchoSpacing' in data and 'ReconMatrixPE' in data:
+        # Calculated TotalReadoutTime = EffectiveEchoSpacing * (ReconMatrixPE - 1)
+        data['TotalReadoutTime'] = data['EffectiveEchoSpacing'] * (data['ReconMatrixPE'] - 1)
+        return True
+    return False
+
+def fix_intended_for(json_path, datatype, data):
+    """
+    Make every path in a non-empty IntendedFor field of a fmap JSON relative
+    to the subject folder, pointing at the NIfTI as it was written
+    :return: True if data was changed
+    """
+    if datatype != 'fmap' or not data.get('IntendedFor'):
+        return False
+    intended_list = data['IntendedFor']
+    if not isinstance(intended_list, list):
+        intended_list = [intended_list]
+    # Regular expression replace all paths in that list with a relative path to ses-SESSION
+    corrected_intended_list = [re.sub(r'.*(ses-.*_ses-.+)','\g<1>',entry) for entry in intended_list]
+    # Point at the NIfTIs as they were written, gzipped or not
+    corrected_intended_list = [match_nifti_extension(os.path.dirname(json_path), entry) for entry in corrected_intended_list]
+    if data['IntendedFor'] == corrected_intended_list:
+        return False
+    data['IntendedFor'] = corrected_intended_list
+    return True
+
+def remove_slice_timing(json_path, datatype, data):
+    """
+    Remove the SliceTiming field from func JSONs
+    :return: True if data was changed
+    """
+    if datatype != 'func' or 'SliceTiming' not in data:
+        return False
+    del data['SliceTiming']
+    return True
+
+# Every correction, by the name its hit count is reported under, in the
+# order they are applied to each JSON
+RULES = [
+    ('TotalReadoutTime', fix_total_readout_time),
+    ('IntendedFor', fix_intended_for),
+    ('SliceTiming', remove_slice_timing)
+]
+
+def correct_json(json_path, hits):
+    """
+    Apply every rule to one sidecar JSON in memory, then write it once if
+    any rule changed it
+    :param json_path: Path to a sidecar JSON in a datatype folder
+    :param hits: Dictionary mapping each rule name to the number of JSONs it
+    has changed, which is updated
+    :return: True if the JSON was written, False if not, or None if it
+    could not be decoded
+    """
+    datatype = os.path.basename(os.path.dirname(json_path))
+    with open(json_path, 'r') as f:
+        try:
+            data = json.load(f)
+        except ValueError:
+            print('Decoding JSON has failed: {}'.format(json_path))
+            return None
+
+    changed = False
+    for name, rule in RULES:
+        if rule(json_path, datatype, data):
+            hits[name] += 1
+            changed = True
+
+    # Only open the JSON for writing if a rule changed it, so sidecars which
+    # are already correct are never opened writable
+    if changed:
+        with open(json_path, 'w') as f:
+            json.dump(data, f, indent=4)
+    return changed
+
+def correct_json_per_field(json_path):
+    """
+    Correct one sidecar JSON the way correct_jsons.py used to, reading and
+    writing it again for each field it changes, to benchmark against
+    """
+    datatype = os.path.basename(os.path.dirname(json_path))
+    with open(json_path, 'r') as f:
+        data = json.load(f)
+    if datatype in ('fmap', 'func') and 'TotalReadoutTime' not in data:
+        if 'EffectiveEchoSpacing' in data and 'ReconMatrixPE' in data:
+            update_json_field(json_path, 'TotalReadoutTime', data['EffectiveEchoSpacing'] * (data['ReconMatrixPE'] - 1))
+    if datatype == 'fmap' and 'IntendedFor' in data and len(data['IntendedFor']) > 0:
+        intended_list = data['IntendedFor']
+        if not isinstance(intended_list, list):
+            intended_list = [intended_list]
+        corrected_intended_list = [re.sub(r'.*(ses-.*_ses-.+)','\g<1>',entry) for entry in intended_list]
+        corrected_intended_list = [match_nifti_extension(os.path.dirname(json_path), entry) for entry in corrected_intended_list]
+        update_json_field(json_path, 'IntendedFor', corrected_intended_list)
+    if datatype == 'func' and 'SliceTiming' in data:
+        remove_json_field(json_path, 'SliceTiming')
+
+def make_synthetic_dataset(bids_dir, sidecars):
+    """
+    Fill bids_dir with ABCD-like sessions of anat, func, and fmap sidecar
+    JSONs which need every correction, and empty NIfTIs for them
+    :param sidecars: Int, number of sidecar JSONs to make
+    :return: List of paths to the sidecar JSONs
+    """
+    json_paths = []
+    session = 0
+    while len(json_paths) < sidecars:
+        sub = 'sub-SYNTHETIC{:06d}'.format(session)
+        ses = 'ses-baselineYear1Arm1'
+        prefix = os.path.join(bids_dir, sub, ses)
+        bold = '{}/func/{}_{}_task-rest_run-01_bold.nii.gz'.format(ses, sub, ses)
+        for datatype, name, data in [
+            ('anat', 'T1w', {'Manufacturer': 'Siemens', 'EchoTime': 0.00207}),
+            ('func', 'task-rest_run-01_bold', {'EffectiveEchoSpacing': 0.000510012, 'ReconMatrixPE': 90,
+                                               'SliceTiming': [0.0, 0.4, 0.1, 0.5, 0.2, 0.6, 0.3], 'TaskName': 'rest'}),
+            ('func', 'task-rest_run-02_bold', {'EffectiveEchoSpacing': 0.000510012, 'ReconMatrixPE': 90,
+                                               'TotalReadoutTime': 0.0453911, 'TaskName': 'rest'}),
+            ('fmap', 'acq-func_dir-AP_run-01_epi', {'EffectiveEchoSpacing': 0.000510012, 'ReconMatrixPE': 90,
+                                                    'IntendedFor': ['/tmp/BIDS_unprocessed/' + sub + '/' + bold]}),
+            ('fmap', 'acq-func_dir-PA_run-01_epi', {'EffectiveEchoSpacing': 0.000510012, 'ReconMatrixPE': 90,
+                                                    'TotalReadoutTime': 0.0453911, 'IntendedFor': [bold]})
+        ][:sidecars - len(json_paths)]:
+            datatype_dir = os.path.join(prefix, datatype)
+            if not os.path.isdir(datatype_dir):
+                os.makedirs(datatype_dir)
+            json_path = os.path.join(datatype_dir, '{}_{}_{}.json'.format(sub, ses, name))
+            with open(json_path, 'w') as f:
+                json.dump(data, f, indent=4)
+            open(json_path[:-len('.json')] + '.nii.gz', 'w').close()
+            json_paths.append(json_path)
+        session += 1
+    return json_paths
+
+def correct_subject_jsons(json_paths):
+    """
+    :param json_paths: List of paths to the sidecar JSONs of one subject
+    :return: Tuple of the list of JSONs written, the list of JSONs which
+    could not be decoded, and a dictionary mapping each rule name to the
+    number of JSONs it changed
+    """
+    hits = {name: 0 for name, _ in RULES}
+    edited = []
+    failed = []
+    for json_path in json_paths:
+        written = correct_json(json_path, hits)
+        if written:
+            edited.append(json_path)
+        elif written is None:
+            failed.append(json_path)
+    return edited, failed, hits
+
+def correct_all_jsons(json_paths, jobs=1):
+    """
+    Correct sidecar JSONs, one subject at a time per job
+    :param json_paths: List of paths to sidecar JSONs
+    :param jobs: Int, number of subjects to correct at the same time
+    :return: Tuple like correct_subject_jsons returns, for all subjects
+    """
+    # Group the JSONs by the subject label their file names start with
+    subjects = {}
+    for json_path in json_paths:
+        subjects.setdefault(os.path.basename(json_path).split('_')[0], []).append(json_path)
+    edited = []
+    failed = []
+    hits = {name: 0 for name, _ in RULES}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for subject_edited, subject_failed, subject_hits in executor.map(correct_subject_jsons, subjects.values()):
+            edited += subject_edited
+            failed += subject_failed
+            for name in hits:
+                hits[name] += subject_hits[name]
+    return edited, failed, hits
+
+def benchmark_rules(sidecars, jobs=1):
+    """
+    Time correcting a synthetic dataset with the rules, which write each
+    JSON at most once, and field by field, then check that both corrected
+    every JSON the same way
+    :param sidecars: Int, number of sidecar JSONs in the synthetic dataset
+    :param jobs: Int, if more than 1, also time correcting that many subjects
+    at the same time with the rules
+    """
+    methods = ['per_field', 'rules'] + (['rules_jobs'] if jobs > 1 else [])
+    temp_dir = tempfile.mkdtemp(prefix='correct_jsons_benchmark_')
+    try:
+        seconds = {}
+        corrected = {}
+        for method in methods:
+            json_paths = make_synthetic_dataset(os.path.join(temp_dir, method), sidecars)
+            # Flush the new files to disk first, so that writing them back
+            # doesn't slow down whichever method runs while they are flushed
+            if hasattr(os, 'sync'):
+                os.sync()
+            start = time.time()
+            if method == 'per_field':
+                for json_path in json_paths:
+                    correct_json_per_field(json_path)
+            else:
+                edited, _, hits = correct_all_jsons(json_paths, jobs if method == 'rules_jobs' else 1)
+            seconds[method] = time.time() - start
+            corrected[method] = json_paths
+
+        mismatched = {method: 0 for method in methods[1:]}
+        for paths in zip(*[corrected[method] for method in methods]):
+            with open(paths[0]) as f:
+                expected = json.load(f)
+            for method, json_path in zip(methods[1:], paths[1:]):
+                with open(json_path) as f:
+                    mismatched[method] += json.load(f) != expected
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print('Corrected {} synthetic sidecar JSONs in {:.2f} seconds field by field and in {:.2f} seconds with rules '
+          '({:.1f}x faster), writing {} of them'.format(sidecars, seconds['per_field'], seconds['rules'],
+                                                        seconds['per_field'] / max(seconds['rules'], 1e-9), len(edited)))
+    if jobs > 1:
+        print('With rules and {} jobs: {:.2f} seconds ({:.1f}x faster than 1 job)'.format(
+            jobs, seconds['rules_jobs'], seconds['rules'] / max(seconds['rules_jobs'], 1e-9)))
+    print_hits(hits)
+    for method, count in mismatched.items():
+        if count:
+            print('ERROR: {} JSONs were corrected differently {} than field by field'.format(
+                count, 'with rules' if method == 'rules' else 'with rules and {} jobs'.format(jobs)))
+    if any(mismatched.values()):
+        return 1
+
+def remove_stray_files(index, folders=None):
+    """
+    Remove the JSONs directly in subject folders, which are not sidecars,
+    and the vol* files which splitting concatenated fieldmaps used to leave
+    in fmap folders
+    :param index: DatasetIndex of the BIDS dataset
+    :param folders: List of subject or session folders, relative to the
+    dataset, to only remove files from, or None to remove them from all
+    """
+    removed = []
+    for json_path in index.subject_files(folders):
+        if json_path.endswith('.json'):
+            print('Removing .JSON file: {}'.format(json_path))
+            os.remove(json_path)
+            removed.append(json_path)
+    for vol_file in index.files(datatype='fmap', folders=folders):
+        if os.path.basename(vol_file).startswith('vol'):
+            print("Removing 'vol' file: {}".format(vol_file))
+            os.remove(vol_file)
+            removed.append(vol_file)
+    index.update_files(removed)
+
+def print_hits(hits):
+    for name, _ in RULES:
+        print('{}: corrected in {} JSON(s)'.format(name, hits[name]))
+
 def main(argv=sys.argv):
     parser = argparse.ArgumentParser(
         prog='correct_jsons.py',
         description=__doc__,
-        usage='%(prog)s BIDS_DIR'
+        usage='%(prog)s BIDS_DIR [--jobs N] [--subjects SUBJECT [SUBJECT ...]] [--all]\n       %(prog)s --benchmark SIDECARS [--jobs N]'
     )
     parser.add_argument(
-        'BIDS_DIR',
+        'BIDS_DIR', nargs='?',
         help='Path to the input BIDS dataset root directory.  Read more '
              'about the BIDS standard in the link in the description.  It is '
              'recommended to use Dcm2Bids to convert from participant dicoms '
              'into BIDS format.'
     )
+    parser.add_argument(
+        '--benchmark', type=int, metavar='SIDECARS',
+        help='Instead of correcting BIDS_DIR, time correcting a synthetic '
+             'dataset of this many sidecar JSONs in a temporary folder, '
+             'both with the rules and field by field like before, and check '
+             'that both give the same JSONs.'
+    )
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='Number of subjects whose sidecar JSONs to correct at the same '
+             'time, in separate threads. Helps most on network filesystems, '
+             'where correcting a JSON mostly means waiting to read and write '
+             'it. With --benchmark, also time correcting the synthetic '
+             'dataset with this many jobs. The default is 1.'
+    )
+    parser.add_argument(
+        '--subjects', nargs='+', metavar='SUBJECT',
+        help='Only correct the sidecar JSONs of these subjects, given as '
+             'folders like sub-NDARINV00000000, or of these sessions, given '
+             'as session folders like sub-NDARINV00000000/ses-baselineYear1Arm1. '
+             'By default, every subject is corrected.'
+    )
+    parser.add_argument(
+        '--all', action='store_true',
+        help='Search the whole dataset for files again, then correct every '
+             'sidecar JSON again, even the ones which were already corrected '
+             'and haven\'t changed since. By default, only new or changed '
+             'sidecar JSONs in the dataset\'s index are corrected.'
+    )
     parser.add_argument(
         '--version', '-v', action='version', version='%(prog)s ' + __version__
     )
 
     args = parser.parse_args()
 
-    for root, dirs, files in os.walk(args.BIDS_DIR):
-        for filename in files:
-            fn, ext = os.path.splitext(filename)
-
-            if ext == '.json':
-                json_path = os.path.join(root, filename)
-                #print(json_path)
-
-                with open(json_path, 'r') as f:
-                    try:
-                        data = json.load(f)
-                    except ValueError:
-                        print('Decoding JSON has failed: {}'.format(json_path))
-
-                # If TotalReadoutTime is missing from fmap JSON
-                if ('fmap' in root or 'func' in root) and 'TotalReadoutTime' not in data:
-                    # Then check for EffectiveEchoSpacing and ReconMatrixPE
-                    if 'EffectiveEchoSpacing' in data and 'ReconMatrixPE' in data:
-                        # If both are present then update the JSON with a calculated TotalReadoutTime
-                        EffectiveEchoSpacing = data['EffectiveEchoSpacing']
-                        ReconMatrixPE = data['ReconMatrixPE']
-                        # Calculated TotalReadoutTime = EffectiveEchoSpacing * (ReconMatrixPE - 1)
-                        TotalReadoutTime = EffectiveEchoSpacing * (ReconMatrixPE - 1)
-                        update_json_field(json_path, 'TotalReadoutTime', TotalReadoutTime)
-
-                    # If EffectiveEchoSpacing is missing print error
-                    if 'EffectiveEchoSpacing' not in data:
-                        print(json_path + ': No EffectiveEchoSpacing')
-
-                    # If ReconMatrixPE is missing print error
-                    if 'ReconMatrixPE' not in data:
-                        print(json_path + ': No ReconMatrixPE')
-
-                # Find the IntendedFor field that is a non-empty list
-                if 'fmap' in root and 'IntendedFor' in data and len(data['IntendedFor']) > 0:
-                    # Regular expression replace all paths in that list with a relative path to ses-SESSION
-                    intended_list = data['IntendedFor']
-                    if not isinstance(intended_list, list):
-                        intended_list = [intended_list]
-                    corrected_intended_list = [re.sub(r'.*(ses-.*_ses-.+)','\g<1>',entry) for entry in intended_list]
-                    update_json_field(json_path, 'IntendedFor', corrected_intended_list)
-
-                # Remove SliceTiming field from func JSONs
-                if 'func' in root and 'SliceTiming' in data:
-                    remove_json_field(json_path, 'SliceTiming')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1.')
+    if args.benchmark:
+        return benchmark_rules(args.benchmark, args.jobs)
+    if not args.BIDS_DIR:
+        parser.error('BIDS_DIR is required unless --benchmark is given.')
+
+    # Restrict the corrections to the chosen subject and session folders
+    folders = None
+    if args.subjects:
+        folders = [s.strip('/') if s.startswith('sub-') else 'sub-' + s.strip('/') for s in args.subjects]
+
+    # List the sidecars from the dataset's index instead of walking the whole
+    # dataset, skipping the ones already corrected in their current state.
+    # The indexed sidecars are checked for changes made since they were
+    # indexed first, so ones edited outside of this pipeline are corrected too
+    index = load_dataset_index(args.BIDS_DIR)
+    if args.all:
+        index.update()
+    remove_stray_files(index, folders)
+    if not args.all:
+        index.update_files(index.files(extension='.json', folders=folders))
+    json_paths = index.files(extension='.json', folders=folders,
+                             unprocessed_by=None if args.all else MANIFEST_STEP)
+
+    start = time.time()
+    edited, failed, hits = correct_all_jsons(json_paths, args.jobs)
+    print('Corrected {} of {} {}sidecar JSONs in {:.1f} seconds with {} job(s)'.format(
+        len(edited), len(json_paths), '' if args.all else 'new or changed ', time.time() - start, args.jobs))
+    print_hits(hits)
+
+    # Record the new sizes and hashes of the edited sidecars, then record
+    # every sidecar processed as it is now, so the next run can skip it
+    index.update_files(edited)
+    failed = set(failed)
+    index.mark_processed(MANIFEST_STEP, [json_path for json_path in json_paths if json_path not in failed])
+    index.close()
 
 if __name__ == "__main__":
     sys.exit(main())
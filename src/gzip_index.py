@@ -0,0 +1,263 @@
+#! /usr/bin/env python3
+
+"""
+Random-access indexes for large gzipped 4D NIfTIs
+Builds an index next to each large 4D .nii.gz file in a BIDS folder, so that
+readers can seek straight to any volume instead of decompressing everything
+before it. Each index is saved as <NIfTI path>.gzidx in the format used by
+indexed_gzip. Only readers which open the .gzidx file themselves use it:
+nibabel.load uses indexed_gzip when it's installed, but never loads an
+existing index, so it still decompresses everything before the volumes it
+reads. To read through the index, use read_volume or open_nifti, or
+load_nifti to get a nibabel image whose data is read through it.
+
+Usage:
+  gzip_index.py build BIDS_DIR [--min-size GB] [--spacing MB]
+  gzip_index.py benchmark NIFTI [--reads N]
+
+Building and using indexes needs the indexed_gzip package:
+  pip install indexed_gzip
+"""
+
+import argparse
+import gzip
+import os
+import random
+import statistics
+import sys
+import time
+
+import nibabel
+import numpy as np
+
+INDEX_EXT = ".gzidx"
+MIN_SIZE_GB = 1
+SPACING_MB = 4
+BENCHMARK_READS = 20
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    build = subparsers.add_parser(
+        "build",
+        help="Build an index for each large 4D .nii.gz file in a BIDS folder."
+    )
+    build.add_argument(
+        "bids_dir",
+        help="Path to a BIDS folder. Every sub-*/ses-* folder in it is "
+             "searched for .nii.gz files."
+    )
+    build.add_argument(
+        "--min-size", dest="min_size", type=float, default=MIN_SIZE_GB,
+        help="Only index 4D .nii.gz files at least this many gigabytes big. "
+             "Default: {} GB.".format(MIN_SIZE_GB)
+    )
+    build.add_argument(
+        "--spacing", type=float, default=SPACING_MB,
+        help="Megabytes of uncompressed data between index points. Smaller "
+             "spacing makes seeking faster but the index bigger, since each "
+             "point stores 32 KB. Default: {} MB.".format(SPACING_MB)
+    )
+
+    benchmark = subparsers.add_parser(
+        "benchmark",
+        help="Time reading random volumes from a 4D .nii.gz file with and "
+             "without its index."
+    )
+    benchmark.add_argument(
+        "nifti",
+        help="Path to a 4D .nii.gz file which has an index."
+    )
+    benchmark.add_argument(
+        "--reads", type=int, default=BENCHMARK_READS,
+        help="Number of random volumes to read. Default: {}."
+             .format(BENCHMARK_READS)
+    )
+    return parser
+
+
+def import_indexed_gzip():
+    """
+    :return: The indexed_gzip module, or exit with an error if it is not
+    installed
+    """
+    try:
+        import indexed_gzip
+    except ImportError:
+        sys.exit("ERROR: Indexing .nii.gz files needs the indexed_gzip "
+                 "package. Install it with 'pip install indexed_gzip'.")
+    return indexed_gzip
+
+
+def get_index_path(nifti_path):
+    return nifti_path + INDEX_EXT
+
+
+def get_volume_layout(nifti_path):
+    """
+    :param nifti_path: Path to a NIfTI file
+    :return: Tuple of the byte offset of the image data, the number of bytes
+    in each volume, the number of volumes, the data type, and the shape of
+    each volume
+    """
+    header = nibabel.load(nifti_path).header
+    shape = header.get_data_shape()
+    dtype = header.get_data_dtype()
+    volumes = shape[3] if len(shape) > 3 else 1
+    volume_shape = shape[:3]
+    volume_bytes = int(np.prod(volume_shape)) * dtype.itemsize
+    return (int(header.get_data_offset()), volume_bytes, volumes, dtype,
+            volume_shape)
+
+
+def find_large_4d_niftis(bids_dir, min_bytes):
+    """
+    :param bids_dir: Path to a BIDS folder
+    :param min_bytes: Minimum size of a .nii.gz file to return
+    :return: Sorted list of paths to every .nii.gz file in the datatype
+    folders of bids_dir's sessions which is at least min_bytes big and has
+    more than one volume
+    """
+    niftis = []
+    for root, _, files in os.walk(bids_dir):
+        if not os.path.basename(os.path.dirname(root)).startswith("ses-"):
+            continue
+        for filename in files:
+            path = os.path.join(root, filename)
+            if (filename.endswith(".nii.gz")
+                    and os.path.getsize(path) >= min_bytes
+                    and get_volume_layout(path)[2] > 1):
+                niftis.append(path)
+    return sorted(niftis)
+
+
+def build_index(nifti_path, spacing):
+    """
+    Index nifti_path, unless its index is already newer than it. The index
+    is exported under a temporary name and then renamed, so an interrupted
+    build never leaves a partial index behind.
+    :param spacing: Int, bytes of uncompressed data between index points
+    :return: True if an index was built, else False
+    """
+    index_path = get_index_path(nifti_path)
+    if (os.path.exists(index_path) and
+            os.path.getmtime(index_path) >= os.path.getmtime(nifti_path)):
+        return False
+    indexed_gzip = import_indexed_gzip()
+    partial = "{}.partial-{}".format(index_path, os.getpid())
+    with indexed_gzip.IndexedGzipFile(nifti_path, spacing=spacing) as f:
+        f.build_full_index()
+        f.export_index(partial)
+    os.replace(partial, index_path)
+    return True
+
+
+def open_nifti(nifti_path, use_index=True):
+    """
+    :param use_index: True to use nifti_path's index if it has one
+    :return: Readable, seekable binary file object of the uncompressed
+    contents of nifti_path
+    """
+    index_path = get_index_path(nifti_path)
+    if use_index and os.path.exists(index_path):
+        indexed_gzip = import_indexed_gzip()
+        return indexed_gzip.IndexedGzipFile(nifti_path, index_file=index_path)
+    return gzip.open(nifti_path, "rb")
+
+
+def load_nifti(nifti_path):
+    """
+    Load a NIfTI with nibabel, reading its data through its index if it has
+    one, unlike nibabel.load. The file stays open while the image is in use.
+    Slice the image's dataobj, e.g. img.dataobj[..., volume], to only read
+    the volumes needed.
+    :return: nibabel Nifti1Image or Nifti2Image of nifti_path
+    """
+    if not os.path.exists(get_index_path(nifti_path)):
+        return nibabel.load(nifti_path)
+    image_class = type(nibabel.load(nifti_path))
+    file_holder = nibabel.FileHolder(nifti_path, open_nifti(nifti_path))
+    return image_class.from_file_map({"header": file_holder,
+                                      "image": file_holder})
+
+
+def read_volume(nifti_path, volume, use_index=True):
+    """
+    :param volume: Int, index of the volume to read
+    :return: numpy array with the data of one volume of nifti_path, not
+    scaled by the header's slope and intercept
+    """
+    offset, volume_bytes, volumes, dtype, shape = get_volume_layout(nifti_path)
+    if not 0 <= volume < volumes:
+        raise IndexError("{} has no volume {}".format(nifti_path, volume))
+    with open_nifti(nifti_path, use_index) as f:
+        f.seek(offset + volume * volume_bytes)
+        data = f.read(volume_bytes)
+    return np.frombuffer(data, dtype=dtype).reshape(shape, order="F")
+
+
+def benchmark_reads(nifti_path, reads=BENCHMARK_READS):
+    """
+    Read the same random volumes from nifti_path with and without its index,
+    opening the file again for each read like a new reader would.
+    :return: Tuple of lists of seconds per read without and with the index
+    """
+    volumes = get_volume_layout(nifti_path)[2]
+    picks = [random.randrange(volumes) for _ in range(reads)]
+    times = {False: [], True: []}
+    for volume in picks:
+        data = {}
+        for use_index in (False, True):
+            start = time.time()
+            data[use_index] = read_volume(nifti_path, volume, use_index)
+            times[use_index].append(time.time() - start)
+        if not np.array_equal(data[False], data[True]):
+            raise ValueError("Volume {} of {} differs when read with its "
+                             "index".format(volume, nifti_path))
+    return times[False], times[True]
+
+
+def main(argv=sys.argv):
+    args = generate_parser().parse_args(argv[1:])
+
+    if args.command == "build":
+        started = time.time()
+        niftis = find_large_4d_niftis(args.bids_dir,
+                                      args.min_size * 1024 ** 3)
+        built = 0
+        for nifti_path in niftis:
+            if build_index(nifti_path, int(args.spacing * 1024 ** 2)):
+                built += 1
+                print("Indexed {} ({:.1f} MB index)".format(
+                    nifti_path,
+                    os.path.getsize(get_index_path(nifti_path)) / 1024 ** 2
+                ))
+        print("Indexed {} of {} large 4D .nii.gz file(s) in {:.1f} seconds"
+              .format(built, len(niftis), time.time() - started))
+
+    elif args.command == "benchmark":
+        if not os.path.exists(get_index_path(args.nifti)):
+            print("ERROR: {} has no index. Build one with 'gzip_index.py "
+                  "build' first.".format(args.nifti))
+            return 1
+        without_index, with_index = benchmark_reads(args.nifti, args.reads)
+        for label, times in (("Without index", without_index),
+                             ("With index", with_index)):
+            print("{}: {:.1f} ms median, {:.1f} ms mean, {:.1f} ms max per "
+                  "volume".format(label, 1000 * statistics.median(times),
+                                  1000 * statistics.mean(times),
+                                  1000 * max(times)))
+        print("{:.1f}x faster random volume reads with the index".format(
+            statistics.mean(without_index) / max(statistics.mean(with_index),
+                                                  1e-9)
+        ))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""
+In-process rigid registration of images from the same session
+Aligns one 3D image to another with 6 degrees of freedom (3 rotations and 3
+translations), like FLIRT with -dof 6, using NumPy and SciPy on arrays which
+are already in memory. The transform is found from coarse to fine on
+smoothed and subsampled copies of the images, by maximizing the correlation
+between the reference and the resampled image, and the moving image is then
+resampled with it at full resolution.
+
+Transforms are 4x4 arrays in world (scanner) coordinates which map a point
+in the reference image to the matching point in the moving image.
+flirt_to_world converts a matrix saved by FLIRT's -omat into the same
+convention, after inverting it, so that both can be compared.
+"""
+
+import numpy as np
+from scipy import ndimage, optimize
+
+# Subsampling factor of each resolution level, from coarsest to finest. For
+# SEFMs, the transform found at half resolution is already accurate to a
+# small fraction of a voxel, and refining it at full resolution takes longer
+# than both coarser levels together
+LEVELS = (4, 2)
+
+# Powell optimizer tolerances, in degrees and millimeters for the parameters
+# and in correlation for the cost
+PARAMETER_TOLERANCE = 1e-2
+COST_TOLERANCE = 1e-6
+
+# Spacing in voxels of the reference grid points used to compare transforms
+DISTANCE_SPACING = 4
+
+
+def rigid_matrix(params, center):
+    """
+    :param params: Sequence of 3 rotations in degrees about the x, y, and z
+    axes, then 3 translations in mm along them
+    :param center: Point in world coordinates to rotate about
+    :return: 4x4 numpy array, the rigid transform in world coordinates
+    """
+    rx, ry, rz = np.deg2rad(params[:3])
+    rot_x = np.array([[1, 0, 0],
+                      [0, np.cos(rx), -np.sin(rx)],
+                      [0, np.sin(rx), np.cos(rx)]])
+    rot_y = np.array([[np.cos(ry), 0, np.sin(ry)],
+                      [0, 1, 0],
+                      [-np.sin(ry), 0, np.cos(ry)]])
+    rot_z = np.array([[np.cos(rz), -np.sin(rz), 0],
+                      [np.sin(rz), np.cos(rz), 0],
+                      [0, 0, 1]])
+    rotation = rot_z.dot(rot_y).dot(rot_x)
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation
+    matrix[:3, 3] = center - rotation.dot(center) + np.asarray(params[3:])
+    return matrix
+
+
+def grid_center(shape, affine):
+    """
+    :return: numpy array, world coordinates of the center of a voxel grid
+    """
+    return affine.dot(np.append((np.asarray(shape[:3]) - 1) / 2.0, 1))[:3]
+
+
+def resample(moving, moving_affine, ref_shape, ref_affine, matrix,
+             order=1, cval=0.0):
+    """
+    :param moving: 3D numpy array to resample
+    :param matrix: 4x4 numpy array mapping reference world coordinates to
+    moving world coordinates
+    :param order: Spline interpolation order, 1 for trilinear
+    :param cval: Value of reference voxels which fall outside of moving
+    :return: 3D numpy array of moving resampled onto the reference grid
+    """
+    voxel_matrix = np.linalg.inv(moving_affine).dot(matrix).dot(ref_affine)
+    return ndimage.affine_transform(
+        moving, voxel_matrix[:3, :3], voxel_matrix[:3, 3],
+        output_shape=tuple(ref_shape[:3]), order=order, mode="constant",
+        cval=cval
+    )
+
+
+def pyramid_level(data, affine, level):
+    """
+    :param level: Int, subsampling factor
+    :return: Tuple of data smoothed and subsampled by level, and the affine
+    of the subsampled grid
+    """
+    if level <= 1:
+        return data, affine
+    smoothed = ndimage.gaussian_filter(data, sigma=level / 2.0)
+    level_affine = affine.copy()
+    level_affine[:3, :3] = affine[:3, :3] * level
+    return smoothed[::level, ::level, ::level], level_affine
+
+
+def correlation_cost(params, moving, moving_affine, ref, ref_affine, center):
+    """
+    :return: Float, 1 minus the correlation of ref with moving resampled by
+    the transform with params, over the voxels which they both cover
+    """
+    resampled = resample(moving, moving_affine, ref.shape, ref_affine,
+                         rigid_matrix(params, center), cval=np.nan)
+    overlap = np.isfinite(resampled)
+    if overlap.sum() < 2:
+        return 1.0
+    a = resampled[overlap] - resampled[overlap].mean()
+    b = ref[overlap] - ref[overlap].mean()
+    denominator = np.sqrt(a.dot(a) * b.dot(b))
+    return 1.0 - a.dot(b) / denominator if denominator > 0 else 1.0
+
+
+def register(moving, moving_affine, ref, ref_affine, levels=LEVELS):
+    """
+    :param moving: 3D numpy array to align to ref
+    :param ref: 3D numpy array
+    :param levels: Sequence of subsampling factors, from coarsest to finest
+    :return: 4x4 numpy array, the rigid transform mapping ref world
+    coordinates to moving world coordinates which best aligns them
+    """
+    moving = np.asarray(moving, dtype=np.float64)
+    ref = np.asarray(ref, dtype=np.float64)
+    center = grid_center(ref.shape, ref_affine)
+    params = np.zeros(6)
+    for level in levels:
+        ref_level, ref_level_affine = pyramid_level(ref, ref_affine, level)
+        moving_level = (ndimage.gaussian_filter(moving, sigma=level / 2.0)
+                        if level > 1 else moving)
+        params = optimize.minimize(
+            correlation_cost, params, method="Powell",
+            args=(moving_level, moving_affine, ref_level, ref_level_affine,
+                  center),
+            options={"xtol": PARAMETER_TOLERANCE, "ftol": COST_TOLERANCE}
+        ).x
+    return rigid_matrix(params, center)
+
+
+def align(moving, moving_affine, ref, ref_affine, levels=LEVELS):
+    """
+    :return: Tuple of moving aligned to and resampled onto the grid of ref,
+    and the transform returned by register
+    """
+    matrix = register(moving, moving_affine, ref, ref_affine, levels)
+    return (resample(np.asarray(moving, dtype=np.float64), moving_affine,
+                     ref.shape, ref_affine, matrix), matrix)
+
+
+def fsl_scaling(shape, zooms, affine):
+    """
+    :return: 4x4 numpy array mapping voxel coordinates to the scaled voxel
+    coordinates FSL uses, which flip the x axis of radiological images
+    """
+    scaling = np.diag(list(zooms[:3]) + [1.0])
+    if np.linalg.det(affine) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = shape[0] - 1
+        scaling = scaling.dot(flip)
+    return scaling
+
+
+def flirt_to_world(flirt_matrix, moving_img, ref_img):
+    """
+    :param flirt_matrix: 4x4 numpy array saved by FLIRT's -omat
+    :param moving_img: nibabel image FLIRT was given with -in
+    :param ref_img: nibabel image FLIRT was given with -ref
+    :return: 4x4 numpy array, the same transform mapping ref world
+    coordinates to moving world coordinates, like register returns
+    """
+    moving_scaling = fsl_scaling(moving_img.shape, moving_img.header.get_zooms(),
+                                 moving_img.affine)
+    ref_scaling = fsl_scaling(ref_img.shape, ref_img.header.get_zooms(),
+                              ref_img.affine)
+    moving_to_ref = (ref_img.affine.dot(np.linalg.inv(ref_scaling))
+                     .dot(flirt_matrix).dot(moving_scaling)
+                     .dot(np.linalg.inv(moving_img.affine)))
+    return np.linalg.inv(moving_to_ref)
+
+
+def transform_distance(matrix_a, matrix_b, ref_shape, ref_affine,
+                       spacing=DISTANCE_SPACING):
+    """
+    :return: Tuple of the root mean square and the maximum distance in mm
+    between where matrix_a and matrix_b move points spread over the
+    reference grid
+    """
+    voxels = np.mgrid[tuple(slice(0, size, spacing)
+                            for size in ref_shape[:3])].reshape(3, -1)
+    points = ref_affine.dot(np.vstack([voxels, np.ones(voxels.shape[1])]))
+    distances = np.linalg.norm((matrix_a - matrix_b).dot(points)[:3], axis=0)
+    return np.sqrt(np.mean(distances ** 2)), distances.max()
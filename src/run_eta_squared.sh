@@ -1,19 +1,31 @@
 #!/bin/sh
 # script for execution of deployed applications
 #
-# Sets up the MATLAB Runtime environment for the current $ARCH and executes 
+# Sets up the MATLAB Runtime environment for the current $ARCH and executes
 # the specified command.
 #
+# Usage:
+#   run_eta_squared.sh <deployedMCRroot> <image> <template>
+#   run_eta_squared.sh <deployedMCRroot> --batch <template> <image> [<image> ...]
+#
+# --batch sets up the environment variables once, then runs eta_squared (and
+# so starts the MATLAB Runtime) once per image, printing "<image> <eta value>"
+# for each image. If eta_squared fails on an image, it stops and exits with
+# status 1. If MCR_CACHE_DIR is set, it is used as a persistent MCR cache
+# shared by every call instead of a new cache being made and deleted for each
+# call, so the CTF archive is only extracted once.
+#
 exe_name=$0
 exe_dir=`dirname "$0"`
-if [ ! -d $TMPDIR/$USER ]; then
-    mkdir $TMPDIR/$USER
+if [ ! -d ${TMPDIR:-/tmp}/$USER ]; then
+    mkdir -p ${TMPDIR:-/tmp}/$USER
 fi
-export MCR_CACHE_ROOT=$TMPDIR/$USER
+export MCR_CACHE_ROOT=${TMPDIR:-/tmp}/$USER
 echo "------------------------------------------"
 if [ "x$1" = "x" ]; then
   echo Usage:
   echo    $0 \<deployedMCRroot\> args
+  echo    $0 \<deployedMCRroot\> --batch template image [image ...]
 else
   echo Setting up environment variables
   MCRROOT="$1"
@@ -25,17 +37,53 @@ else
   export LD_LIBRARY_PATH;
   echo LD_LIBRARY_PATH is ${LD_LIBRARY_PATH};
   shift 1
-  RANDHASH=`cat /dev/urandom | tr -cd "a-f0-9" | head -c 8`
-  export MCR_CACHE_ROOT=$TMPDIR/$USER/$RANDHASH
-  mkdir -p $MCR_CACHE_ROOT
-  args=
-  while [ $# -gt 0 ]; do
-      token=$1
-      args="${args} \"${token}\"" 
-      shift
-  done
-  eval "\"${exe_dir}/eta_squared\"" $args
-  rm -rf ${MCR_CACHE_ROOT}
+  if [ -n "${MCR_CACHE_DIR}" ]; then
+      export MCR_CACHE_ROOT=${MCR_CACHE_DIR}
+      mkdir -p ${MCR_CACHE_ROOT}
+      # Only one process extracts the CTF archive into a new persistent
+      # cache; others wait for it to finish
+      if [ ! -e ${MCR_CACHE_ROOT}/.eta_squared_ready ] && command -v flock > /dev/null; then
+          exec 9> ${MCR_CACHE_ROOT}/.eta_squared_lock
+          flock 9
+      fi
+  else
+      RANDHASH=`cat /dev/urandom | tr -cd "a-f0-9" | head -c 8`
+      export MCR_CACHE_ROOT=${TMPDIR:-/tmp}/$USER/$RANDHASH
+      mkdir -p $MCR_CACHE_ROOT
+  fi
+  if [ "x$1" = "x--batch" ]; then
+      template=$2
+      shift 2
+      status=0
+      for image in "$@"; do
+          output=`"${exe_dir}/eta_squared" "${image}" "${template}"` || status=1
+          eta=`echo "${output}" | awk 'NF {last=$NF} END {print last}'`
+          if [ ${status} -ne 0 ] || [ -z "${eta}" ]; then
+              echo "ERROR: eta_squared failed for ${image}" >&2
+              status=1
+              break
+          fi
+          if [ -n "${MCR_CACHE_DIR}" ]; then
+              touch ${MCR_CACHE_ROOT}/.eta_squared_ready
+              exec 9>&-
+          fi
+          echo ${image} ${eta}
+      done
+  else
+      args=
+      while [ $# -gt 0 ]; do
+          token=$1
+          args="${args} \"${token}\""
+          shift
+      done
+      eval "\"${exe_dir}/eta_squared\"" $args
+      if [ -n "${MCR_CACHE_DIR}" ]; then
+          touch ${MCR_CACHE_ROOT}/.eta_squared_ready
+      fi
+  fi
+  if [ -z "${MCR_CACHE_DIR}" ]; then
+      rm -rf ${MCR_CACHE_ROOT}
+  fi
 fi
-exit
+exit ${status}
 
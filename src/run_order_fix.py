@@ -8,7 +8,9 @@ import shutil
 import tempfile
 from collections import OrderedDict
 
-taskmatch = re.compile('^.*task-([A-z0-9]+)_run-(\d+).*.nii.gz$')
+taskmatch = re.compile('^.*task-([A-z0-9]+)_run-(\d+).*\.nii(\.gz)?$')
+niftiext = re.compile('\.nii(\.gz)?$')
+runmatch = re.compile('task-[a-zA-Z0-9]+_run-\d+')
 
 
 def _cli():
@@ -122,6 +124,9 @@ def get_bids_errors(bids_input, output_json, subject_list=None, detailed=False):
         if subject_list and subject not in subject_list:
             continue
         print(subject)
+        # errors are recorded by session folder, e.g. sub-X/ses-Y, so the
+        # files to swap can be found in whichever session they came from
+        session_folder = os.path.relpath(os.path.dirname(folder), bids_input)
         contents = os.listdir(folder)
         # sort contents
         tasks = task_splitter(contents)
@@ -137,14 +142,16 @@ def get_bids_errors(bids_input, output_json, subject_list=None, detailed=False):
             order = [1 + n for n in order]
             if run_nums == order:
                 if detailed:
-                    structured_output[subject][name] = 'correct'
+                    structured_output.setdefault(session_folder, {})[name] = \
+                        'correct'
                 continue
             if new:
-                structured_output[subject] = {}
+                structured_output[session_folder] = {}
                 new = False
-            structured_output[subject][name] = {}
-            structured_output[subject][name]['current_order'] = run_nums
-            structured_output[subject][name]['actual_order'] = order
+            structured_output[session_folder][name] = {}
+            structured_output[session_folder][name]['current_order'] = \
+                run_nums
+            structured_output[session_folder][name]['actual_order'] = order
 
     if output_json:
         if os.path.exists(output_json):
@@ -159,9 +166,12 @@ def get_bids_errors_correction_map(input_json,  output_map, bids_input=None):
 
     mapping = OrderedDict()
 
-    for subject, tasks in jso.items():
-        subject_folder = bids_input + '/{subject}/{session}'.format(
-            subject=subject, session='ses-baselineYear1Arm1')
+    for session_folder, tasks in jso.items():
+        # error files from before errors were recorded by session folder
+        # are keyed by subject, so their whole subject folder is indexed
+        subject = session_folder.split('/')[0]
+        file_index = index_session_files(
+            os.path.join(bids_input, session_folder)) if bids_input else {}
         for name, map_data in tasks.items():
             if map_data == 'correct':
                 continue
@@ -184,7 +194,7 @@ def get_bids_errors_correction_map(input_json,  output_map, bids_input=None):
                                     actual_order]
                 for (current, end) in zip(current_names, actual_names):
                     mapping.update(
-                        generate_file_map(subject_folder, current, end))
+                        generate_file_map(file_index, current, end))
 
     if os.path.exists(output_map):
         os.remove(output_map)
@@ -217,16 +227,36 @@ def swap_files(json_file):
         swapped.append(after)
 
 
-def generate_file_map(subject_directory, current_task, end_task,
-                      tempspace=None):
+def index_session_files(session_directory):
+    """
+    :param session_directory: path to a session folder, or to a subject folder
+    :return: dict mapping each task-<name>_run-<number> string in the names of
+    the files under session_directory to the paths of the files with it
+    """
+    file_index = {}
+    for pathspec in os.walk(session_directory):
+        for filename in pathspec[2]:
+            for task_run in set(runmatch.findall(filename)):
+                file_index.setdefault(task_run, []).append(
+                    os.path.join(pathspec[0], filename))
+
+    return file_index
+
+
+def generate_file_map(file_index, current_task, end_task):
+    """
+    :param file_index: dict returned by index_session_files
+    :param current_task: task-<name>_run-<number> string of the files to move
+    :param end_task: task-<name>_run-<number> string to rename them with
+    :return: dict mapping each file path with current_task to its path with
+    end_task instead
+    """
     file_map = {}
-    task_directory = subject_directory
 
-    for pathspec in os.walk(task_directory):
-        for filepath in (os.path.join(pathspec[0], f) for f in pathspec[2]):
-            end_filepath = filepath.replace(current_task, end_task)
-            if filepath != end_filepath:
-                file_map[filepath] = end_filepath
+    for filepath in file_index.get(current_task, []):
+        end_filepath = filepath.replace(current_task, end_task)
+        if filepath != end_filepath:
+            file_map[filepath] = end_filepath
 
     return file_map
 
@@ -253,7 +283,7 @@ def task_splitter(filenames):
 
 
 def acquisition_time(filename):
-    sidecar = filename[:-7] + '.json'
+    sidecar = niftiext.sub('.json', filename)
     with open(sidecar) as fd:
         jso = json.load(fd)
         time = datetime.datetime.strptime(jso['AcquisitionTime'],
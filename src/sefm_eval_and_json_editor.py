@@ -1,8 +1,13 @@
 #! /usr/bin/env python3
 
-import os, sys, glob, argparse, subprocess, socket, operator, shutil, json
-from bids import BIDSLayout
+import os, sys, glob, argparse, subprocess, socket, operator, shutil, json, time, gzip, hashlib, copy, fcntl
+import nibabel
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy import ndimage
 from itertools import product
+import rigid_registration
+from bids_index import SessionIndex, list_sessions
 
 os.environ['FSLOUTPUTTYPE'] = 'NIFTI_GZ'
 
@@ -17,15 +22,60 @@ prog_descrip =  """%(prog)s: sefm_eval pairs each of the pos/neg sefm and return
 # by Greg 2019-06-10 & updated 2019-11-07
 ETA_DIR = os.path.dirname(os.path.abspath(__file__))
 
-def read_bids_layout(layout, subject_list=None, collect_on_subject=False):
+# Ways to calculate eta squared: natively with NumPy, with the compiled MATLAB
+# function (which needs the MRE), or both, to check that they agree. The
+# MATLAB function prints its result rounded to 4 decimal places.
+ETA_ENGINES = ['numpy', 'matlab', 'compare']
+ETA_TOLERANCE = 1e-4
+
+# Bump this to ignore SEFM selections cached by older versions of this script
+SEFM_CACHE_VERSION = '1'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Ways to align the SEFMs: with FSL's FLIRT, or in this process with
+# rigid_registration
+REGISTRATION_ENGINES = ['flirt', 'numpy']
+
+# Fast SEFM ranking: downsampling factor, the fraction of the template's
+# 98th percentile above which voxels count as brain, and how close the best
+# approximate eta values must be to score those pairs at full resolution
+FAST_RANKING_FACTOR = 2
+BRAIN_MASK_FRACTION = 0.1
+FAST_RANKING_MARGIN = 0.002
+
+# NIfTI outputs can be gzipped or not, depending on the conversion settings
+NIFTI_EXTENSIONS = ['.nii.gz', '.nii']
+
+
+def get_nifti_extension(nifti_path):
+    """
+    :param nifti_path: Path to a NIfTI file
+    :return: The extension of nifti_path, either .nii.gz or .nii
     """
-    :param bids_input: path to input bids folder
+    for ext in NIFTI_EXTENSIONS:
+        if nifti_path.endswith(ext):
+            return ext
+    raise ValueError('Not a NIfTI file: {}'.format(nifti_path))
+
+
+def get_sidecar_path(nifti_path):
+    """
+    :param nifti_path: Path to a .nii.gz or .nii file
+    :return: Path to the JSON sidecar of nifti_path
+    """
+    return nifti_path[:-len(get_nifti_extension(nifti_path))] + '.json'
+
+
+def read_bids_layout(bids_dir, subject_list=None, collect_on_subject=False):
+    """
+    :param bids_dir: path to input bids folder
     :param subject_list: a list of subject ids to filter on
     :param collect_on_subject: collapses all sessions, for cases with
     non-longitudinal data spread across scan sessions.
     """
 
-    subjects = layout.get_subjects()
+    subject_sessions = list_sessions(bids_dir)
+    subjects = sorted(subject_sessions)
 
     # filter subject list
     if isinstance(subject_list, list):
@@ -36,7 +86,7 @@ def read_bids_layout(layout, subject_list=None, collect_on_subject=False):
     subsess = []
     # filter session list
     for s in subjects:
-        sessions = layout.get_sessions(subject=s)
+        sessions = subject_sessions[s]
         if not sessions:
             subsess += [(s, 'session')]
         elif collect_on_subject:
@@ -51,8 +101,514 @@ def read_bids_layout(layout, subject_list=None, collect_on_subject=False):
     return subsess
 
 
-def sefm_select(layout, subject, sessions, base_temp_dir, fsl_dir, mre_dir,
-                debug=False):
+def get_image_data(image):
+    """
+    :param image: Path to a NIfTI image, a nibabel image, or image data
+    :return: numpy array of float64 with the scaled image data
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, str):
+        image = nibabel.load(image)
+    return image.get_fdata(dtype=np.float64, caching='unchanged')
+
+
+def mean_image(image_paths, reference=None):
+    """
+    Average images one at a time, so that only the running sum and the
+    current image are in memory at once. Like fslmaths, the mean is saved
+    with the data type of the first image, rounded if that is an integer type.
+    :param image_paths: List of paths to NIfTI images on the same grid, or of
+    their data
+    :param reference: nibabel image to take the data type, affine, and header
+    of the mean from instead of the first image, which is needed if
+    image_paths are data
+    :return: nibabel image with the voxelwise mean of the images
+    """
+    total = None
+    for image_path in image_paths:
+        if total is None:
+            total = np.array(get_image_data(image_path))
+        else:
+            total += get_image_data(image_path)
+    mean = total / len(image_paths)
+    first = reference if reference is not None else nibabel.load(image_paths[0])
+    header = first.header.copy()
+    header.set_slope_inter(1, 0)
+    return nibabel.Nifti1Image(cast_to_dtype(mean, first.get_data_dtype()), first.affine, header)
+
+
+def cast_to_dtype(data, dtype):
+    """
+    :return: data as dtype, rounded and clipped to its range if dtype is an
+    integer type
+    """
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        data = np.clip(np.rint(data), info.min, info.max)
+    return data.astype(dtype)
+
+
+def eta_squared(image, template):
+    """
+    Calculate eta squared (Cohen et al., 2008) between two images, the same
+    way as the compiled MATLAB eta_squared function
+    :param image: Path to a NIfTI image, or a nibabel image
+    :param template: Path to a NIfTI image on the same grid, or a nibabel
+    image
+    :return: Float, 1 minus the ratio of the variance within each voxel to
+    the total variance around the mean of both images
+    """
+    return eta_squared_arrays(get_image_data(image), get_image_data(template))
+
+
+def eta_squared_arrays(a, b):
+    """
+    :param a: numpy array
+    :param b: numpy array with the same number of values as a
+    :return: Float, eta squared between a and b
+    """
+    a = a.ravel()
+    b = b.ravel()
+    within_mean = (a + b) / 2
+    grand_mean = within_mean.mean()
+    ss_within = np.sum((a - within_mean) ** 2) + np.sum((b - within_mean) ** 2)
+    ss_total = np.sum((a - grand_mean) ** 2) + np.sum((b - grand_mean) ** 2)
+    return float(1 - ss_within / ss_total)
+
+
+def downsample(data, factor):
+    """
+    :param data: 3D numpy array
+    :param factor: Int, number of voxels along each side of a block
+    :return: numpy array with the mean of each factor**3 block of data,
+    leaving out voxels at the edges which do not fill a whole block
+    """
+    if factor <= 1:
+        return data
+    shape = [size // factor for size in data.shape[:3]]
+    data = data[:shape[0] * factor, :shape[1] * factor, :shape[2] * factor]
+    return data.reshape(shape[0], factor, shape[1], factor,
+                        shape[2], factor).mean(axis=(1, 3, 5))
+
+
+def matlab_eta_squared(mre_dir, image_paths, template_path, mcr_cache=None):
+    """
+    Calculate eta squared between each image and a template with the
+    compiled MATLAB function. One call to run_eta_squared.sh sets up the
+    environment for all of the images, but it still runs the function, and so
+    starts the MATLAB Runtime, once per image
+    :param image_paths: List of paths to NIfTI images
+    :param mcr_cache: Optional path to a persistent MCR cache folder, so that
+    the MATLAB function is not extracted again for every image
+    :return: List of floats, the value the MATLAB function printed last for
+    each image
+    """
+    mat_cmd = [os.path.join(ETA_DIR,'run_eta_squared.sh'), mre_dir, '--batch', template_path] + image_paths
+    env = dict(os.environ, MCR_CACHE_DIR=mcr_cache) if mcr_cache else os.environ
+    mat_stdout = subprocess.check_output(mat_cmd, env=env).decode()
+    etas = {}
+    for line in mat_stdout.splitlines():
+        tokens = line.split()
+        if len(tokens) == 2 and tokens[0] in image_paths:
+            etas[tokens[0]] = float(tokens[1])
+    missing = [image_path for image_path in image_paths if image_path not in etas]
+    if missing:
+        raise RuntimeError('run_eta_squared.sh printed no eta squared value for: {}'.format(', '.join(missing)))
+    return [etas[image_path] for image_path in image_paths]
+
+
+def get_registered_path(temp_dir, pedir, i):
+    """
+    :return: Path to the i-th SEFM with phase encoding direction pedir after
+    it is aligned by register_sefms
+    """
+    return os.path.join(temp_dir,'init_' + pedir + '_reg_' + str(i) + '.nii.gz')
+
+
+def get_matrix_path(temp_dir, pedir, i):
+    """
+    :return: Path to the FLIRT matrix saved for the i-th SEFM with phase
+    encoding direction pedir by register_sefms
+    """
+    return os.path.join(temp_dir,'init_' + pedir + '_reg_' + str(i) + '.mat')
+
+
+def register_sefms(pairs, pedirs, out_dir, fsl_dir, jobs=1, threads=1, save_matrices=False):
+    """
+    Align every SEFM to the first SEFM with the same phase encoding direction
+    using FLIRT, running up to jobs FLIRT processes at once
+    :param pairs: List of tuples of paths to each pair of pos/neg SEFMs
+    :param pedirs: Tuple of the pos and neg phase encoding direction labels
+    :param out_dir: Folder to save init_<pedir>_reg_<i>.nii.gz files in
+    :param threads: Number of threads each FLIRT process may use
+    :param save_matrices: True to also save each transform as
+    init_<pedir>_reg_<i>.mat
+    :return: Float, seconds taken to run all of the registrations
+    """
+    cmds = []
+    for i, pair in enumerate(pairs):
+        for pedir, ref, flirt_in in zip(pedirs, pairs[0], pair):
+            out = get_registered_path(out_dir, pedir, i)
+            cmds.append([fsl_dir + 'flirt', '-in', flirt_in, '-ref', ref, '-dof', str(6), '-out', out])
+            if save_matrices:
+                cmds[-1] += ['-omat', get_matrix_path(out_dir, pedir, i)]
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads),
+               OPENBLAS_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        list(pool.map(lambda cmd: subprocess.run(cmd, stdout=subprocess.DEVNULL, env=env), cmds))
+    return time.time() - start
+
+
+def benchmark_registrations(pairs, pedirs, temp_dir, fsl_dir, parallel_seconds, jobs):
+    """
+    Run the registrations again one at a time into a subfolder of temp_dir,
+    then print how long that took compared to running them in parallel and
+    whether both made identical images.
+    :return: True if the outputs are identical, else False
+    """
+    serial_dir = os.path.join(temp_dir, 'serial')
+    os.makedirs(serial_dir, exist_ok=True)
+    serial_seconds = register_sefms(pairs, pedirs, serial_dir, fsl_dir)
+    identical = True
+    for i in range(len(pairs)):
+        for pedir in pedirs:
+            if not np.array_equal(get_image_data(get_registered_path(temp_dir, pedir, i)),
+                                  get_image_data(get_registered_path(serial_dir, pedir, i))):
+                identical = False
+    shutil.rmtree(serial_dir)
+    print("FLIRT benchmark for {} SEFM pair(s): {:.1f} seconds serially, {:.1f} seconds with {} job(s), {:.2f}x speedup, {} outputs".format(
+        len(pairs), serial_seconds, parallel_seconds, jobs,
+        serial_seconds / max(parallel_seconds, 1e-9),
+        "identical" if identical else "DIFFERENT"))
+    return identical
+
+
+def align_sefms(pairs, pedirs):
+    """
+    Align every SEFM to the first SEFM with the same phase encoding direction
+    in this process with rigid_registration, instead of with FLIRT. The
+    alignments run one at a time, since SciPy's resampling holds the GIL.
+    :param pairs: List of tuples of paths to each pair of pos/neg SEFMs
+    :param pedirs: Tuple of the pos and neg phase encoding direction labels
+    :return: Tuple of dictionaries mapping (pedir, pair index) to the aligned
+    data of each SEFM and to its transform, and the seconds taken to align
+    all of them
+    """
+    start = time.time()
+    images = {}
+    matrices = {}
+    for j, pedir in enumerate(pedirs):
+        ref = nibabel.load(pairs[0][j])
+        ref_data = get_image_data(ref)
+        for i, pair in enumerate(pairs):
+            if i == 0:
+                images[(pedir, i)], matrices[(pedir, i)] = ref_data, np.eye(4)
+                continue
+            moving = nibabel.load(pair[j])
+            images[(pedir, i)], matrices[(pedir, i)] = rigid_registration.align(
+                get_image_data(moving), moving.affine, ref_data, ref.affine)
+    return images, matrices, time.time() - start
+
+
+def best_aligned_sefm_pair(images, pairs, pedirs):
+    """
+    :param images: Dictionary mapping (pedir, pair index) to aligned SEFM data
+    :return: Index of the pair that full eta squared ranking with NumPy picks
+    """
+    etas = {}
+    for j, pedir in enumerate(pedirs):
+        template = get_image_data(mean_image([images[(pedir, i)] for i in range(len(pairs))], nibabel.load(pairs[0][j])))
+        for i in range(len(pairs)):
+            etas[(pedir, i)] = eta_squared(images[(pedir, i)], template)
+    return best_sefm_pair(etas, list(range(len(pairs))), pedirs)
+
+
+def validate_registration(subject, pairs, pedirs, temp_dir, fsl_dir, jobs=1, threads=1):
+    """
+    Align the SEFMs both with FLIRT and in this process, then print how far
+    apart the two transforms of each SEFM move points of its reference, how
+    long each way took, and whether the SEFM pair chosen after each agrees
+    :return: True if both ways choose the same pair, else False
+    """
+    flirt_dir = os.path.join(temp_dir, 'flirt_validation')
+    os.makedirs(flirt_dir, exist_ok=True)
+    flirt_seconds = register_sefms(pairs, pedirs, flirt_dir, fsl_dir, jobs, threads, save_matrices=True)
+    images, matrices, numpy_seconds = align_sefms(pairs, pedirs)
+    flirt_images = {}
+    distances = []
+    for j, pedir in enumerate(pedirs):
+        ref = nibabel.load(pairs[0][j])
+        for i, pair in enumerate(pairs):
+            flirt_images[(pedir, i)] = get_image_data(get_registered_path(flirt_dir, pedir, i))
+            flirt_matrix = rigid_registration.flirt_to_world(np.loadtxt(get_matrix_path(flirt_dir, pedir, i)), nibabel.load(pair[j]), ref)
+            rms, furthest = rigid_registration.transform_distance(matrices[(pedir, i)], flirt_matrix, ref.shape, ref.affine)
+            distances.append(rms)
+            print("{} transforms differ by {:.3f} mm RMS, {:.3f} mm at most".format(pair[j], rms, furthest))
+    same = best_aligned_sefm_pair(images, pairs, pedirs) == best_aligned_sefm_pair(flirt_images, pairs, pedirs)
+    shutil.rmtree(flirt_dir)
+    print("Registration validation for {} ({} pairs): FLIRT {:.1f} seconds, numpy {:.1f} seconds, transforms differ by {:.3f} mm RMS on average, {} pair chosen".format(
+        subject, len(pairs), flirt_seconds, numpy_seconds, np.mean(distances), "same" if same else "DIFFERENT"))
+    return same
+
+
+def get_fsl_version():
+    """
+    :return: String with the version of FSL in $FSLDIR, or 'unknown'
+    """
+    try:
+        with open(os.path.join(os.environ.get('FSLDIR', ''), 'etc', 'fslversion')) as f:
+            return f.read().strip()
+    except OSError:
+        return 'unknown'
+
+
+def hash_sefm_inputs(pairs, settings):
+    """
+    :param pairs: List of tuples of paths to each pair of pos/neg SEFMs. The
+    first pair is the reference that the others are aligned to.
+    :param settings: List of strings with every setting that changes how the
+    pairs are ranked
+    :return: String, hex digest identifying the ranking of pairs, based on the
+    uncompressed contents of every SEFM in order, the FSL version, and settings
+    """
+    sefm_hash = hashlib.sha256()
+    for value in [SEFM_CACHE_VERSION, get_fsl_version()] + settings:
+        sefm_hash.update(value.encode() + b'\0')
+    for pair in pairs:
+        for image_path in pair:
+            opener = gzip.open if image_path.endswith('.gz') else open
+            with opener(image_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    sefm_hash.update(chunk)
+            sefm_hash.update(b'\0')
+    return sefm_hash.hexdigest()
+
+
+def load_sefm_selection(cache_path):
+    """
+    :return: Dictionary saved by save_sefm_selection, or None if there isn't
+    a readable one at cache_path
+    """
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_sefm_selection(cache_path, selection):
+    """
+    Save the eta values and best pair index of a ranking, writing to a
+    temporary file first so that an interrupted save leaves nothing behind
+    """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    partial = '{}.partial-{}'.format(cache_path, os.getpid())
+    with open(partial, 'w') as f:
+        json.dump(selection, f, indent=4)
+    os.replace(partial, cache_path)
+
+
+def rank_sefm_pairs(subject, pairs, pedirs, temp_dir, fsl_dir, mre_dir,
+                    eta_engine='numpy', mcr_cache=None, flirt_jobs=1,
+                    flirt_threads=1, benchmark=False, ranking='full',
+                    ranking_margin=FAST_RANKING_MARGIN,
+                    ranking_factor=FAST_RANKING_FACTOR,
+                    benchmark_results=None, registration='flirt',
+                    validate=False):
+    """
+    Align the SEFMs, average them into one template per phase encoding
+    direction, and calculate each SEFM's eta squared value to its template
+    :return: Dictionary mapping 'etas' to a dictionary of each phase encoding
+    direction's list of eta values, one per pair, and 'best_pair' to the
+    index of the pair whose lower eta value is highest
+    :param benchmark_results: Optional list to append a tuple to of whether
+    fast and full ranking chose the same pair, and the seconds each took
+    :param registration: 'flirt' to align the SEFMs with FLIRT, or 'numpy'
+    to align them in memory and pass them straight to the ranking
+    :param validate: True to also align the SEFMs the other way and compare
+    """
+    pos, neg = pedirs
+    print("Aligning SEFMs and creating template")
+    if registration == 'numpy':
+        images, _, seconds = align_sefms(pairs, pedirs)
+        print("Aligned {} SEFM(s) in memory in {:.1f} seconds".format(
+            2 * len(pairs), seconds))
+        references = {pedir: nibabel.load(path) for pedir, path in zip(pedirs, pairs[0])}
+        if eta_engine != 'numpy':
+            for (pedir, i), data in images.items():
+                nibabel.save(nibabel.Nifti1Image(data.astype(np.float32), references[pedir].affine),
+                             get_registered_path(temp_dir, pedir, i))
+    else:
+        images, references = None, {}
+        flirt_seconds = register_sefms(pairs, pedirs, temp_dir, fsl_dir,
+                                       flirt_jobs, flirt_threads)
+        print("Aligned {} SEFM(s) in {:.1f} seconds using {} job(s)".format(
+            2 * len(pairs), flirt_seconds, flirt_jobs))
+        if benchmark:
+            benchmark_registrations(pairs, pedirs, temp_dir, fsl_dir,
+                                    flirt_seconds, flirt_jobs)
+    if validate:
+        validate_registration(subject, pairs, pedirs, temp_dir, fsl_dir,
+                              flirt_jobs, flirt_threads)
+
+    # Average the pos/neg SEFMs after alignment in memory. The template is
+    # only written to disk if the MATLAB function needs to read it
+    templates = {}
+    for pedir in [pos,neg]:
+        if images:
+            templates[pedir] = mean_image([images[(pedir, i)] for i in range(len(pairs))], references[pedir])
+        else:
+            templates[pedir] = mean_image([get_registered_path(temp_dir, pedir, i) for i in range(len(pairs))])
+        if eta_engine != 'numpy':
+            nibabel.save(templates[pedir], os.path.join(temp_dir,pedir + '_mean.nii.gz'))
+    
+    print("Computing ETA squared value for each image to the template")
+    
+    # Calculate the eta squared value of each aligned image to the average and return the pair with the highest average
+    selection, seconds = choose_sefm_pair(ranking, subject, pairs, pedirs, temp_dir, templates, eta_engine, mre_dir, mcr_cache, ranking_margin, ranking_factor, images)
+    if benchmark_results is not None:
+        other_ranking = 'full' if ranking == 'fast' else 'fast'
+        print("Ranking SEFMs again with " + other_ranking + " ranking to benchmark it")
+        other, other_seconds = choose_sefm_pair(other_ranking, subject, pairs, pedirs, temp_dir, templates, eta_engine, mre_dir, mcr_cache, ranking_margin, ranking_factor, images)
+        times = {ranking: seconds, other_ranking: other_seconds}
+        agree = selection['best_pair'] == other['best_pair']
+        print("SEFM ranking benchmark for {} ({} pairs): full {:.2f} seconds, fast {:.2f} seconds, {} pair chosen".format(
+            subject, len(pairs), times['full'], times['fast'], "same" if agree else "DIFFERENT"))
+        benchmark_results.append((agree, times['full'], times['fast']))
+    return selection
+
+
+def save_ranking_results(results_path, results):
+    """
+    Append SEFM ranking benchmark results to a file which other runs may be
+    appending to at the same time, one line of JSON per session
+    :param results_path: Path to the shared results file
+    :param results: List of tuples of whether fast and full ranking chose
+    the same pair, and the seconds each took
+    """
+    with open(results_path, 'a') as outfile:
+        fcntl.flock(outfile, fcntl.LOCK_EX)
+        for agree, full_seconds, fast_seconds in results:
+            outfile.write(json.dumps({'agree': agree, 'full_seconds': full_seconds,
+                                      'fast_seconds': fast_seconds}) + '\n')
+
+
+def score_sefms(subject, pairs, indices, pedirs, temp_dir, templates, eta_engine='numpy', mre_dir=None, mcr_cache=None, images=None):
+    """
+    Calculate the eta squared value of some pairs' aligned SEFMs to the
+    template of their phase encoding direction at full resolution
+    :param indices: List of the indices of the pairs to score
+    :param images: Optional dictionary mapping (pedir, pair index) to the
+    data of aligned SEFMs which were already loaded
+    :return: Dictionary mapping (pedir, pair index) to the eta value
+    """
+    pos, neg = pedirs
+    images = images or {}
+    engines = ['numpy', 'matlab'] if eta_engine == 'compare' else [eta_engine]
+    eta_seconds = {}
+    etas = {}
+    for engine in engines:
+        start = time.time()
+        etas[engine] = {}
+        for pedir in [pos,neg]:
+            regs = [get_registered_path(temp_dir, pedir, i) for i in indices]
+            mean = os.path.join(temp_dir,pedir + '_mean.nii.gz')
+            if engine == 'matlab':
+                values = matlab_eta_squared(mre_dir, regs, mean, mcr_cache)
+            else:
+                values = [eta_squared(images.get((pedir, i), reg), templates[pedir]) for i, reg in zip(indices, regs)]
+            for i, eta in zip(indices, values):
+                etas[engine][(pedir, i)] = eta
+        eta_seconds[engine] = time.time() - start
+
+    for i in indices:
+        for pedir,image in zip(pedirs, pairs[i]):
+            for engine in engines:
+                print(image + " eta value = " + str(etas[engine][(pedir, i)]) + ("" if len(engines) == 1 else " (" + engine + ")"))
+            if eta_engine == 'compare' and abs(etas['numpy'][(pedir, i)] - etas['matlab'][(pedir, i)]) > ETA_TOLERANCE:
+                print("WARNING: NumPy and MATLAB eta values for " + image + " differ by more than " + str(ETA_TOLERANCE))
+    print("Eta squared timing for " + subject + ": " + ", ".join(
+        "{} {:.2f} seconds".format(engine, eta_seconds[engine]) for engine in engines))
+    if eta_engine == 'compare':
+        if best_sefm_pair(etas['numpy'], indices, pedirs) == best_sefm_pair(etas['matlab'], indices, pedirs):
+            print("NumPy and MATLAB eta values select the same SEFM pair")
+        else:
+            print("WARNING: NumPy and MATLAB eta values select different SEFM pairs. Using the MATLAB selection")
+    return etas[engines[-1]]
+
+
+def fast_score_sefms(pairs, pedirs, temp_dir, templates, factor=FAST_RANKING_FACTOR, images=None):
+    """
+    Approximate the eta squared value of every pair's aligned SEFMs to the
+    template of their phase encoding direction, using only the voxels
+    inside a rough brain mask of the template after downsampling by factor
+    :param images: Optional dictionary mapping (pedir, pair index) to the
+    data of aligned SEFMs which are already in memory
+    :return: Tuple of dictionaries mapping (pedir, pair index) to the
+    approximate eta value, and to the full resolution data of the aligned
+    SEFM, so it is not loaded again to score it at full resolution
+    """
+    etas = {}
+    images = dict(images or {})
+    for pedir in pedirs:
+        template = downsample(get_image_data(templates[pedir]), factor)
+        mask = template > BRAIN_MASK_FRACTION * np.percentile(template, 98)
+        for i, pair in enumerate(pairs):
+            if (pedir, i) not in images:
+                images[(pedir, i)] = get_image_data(get_registered_path(temp_dir, pedir, i))
+            image = downsample(images[(pedir, i)], factor)
+            etas[(pedir, i)] = eta_squared_arrays(image[mask], template[mask])
+            print(pair[pedirs.index(pedir)] + " approximate eta value = " + str(etas[(pedir, i)]))
+    return etas, images
+
+
+def best_sefm_pair(etas, indices, pedirs):
+    """
+    :param etas: Dictionary mapping (pedir, pair index) to eta value
+    :param indices: List of the indices of the pairs to choose from
+    :return: Index of the pair whose lowest eta value is highest
+    """
+    # instead of finding the average between eta values between pairs. Take the pair with the highest lowest eta value.
+    return max(indices, key=lambda i: min(etas[(pedir, i)] for pedir in pedirs))
+
+
+def choose_sefm_pair(ranking, subject, pairs, pedirs, temp_dir, templates, eta_engine='numpy', mre_dir=None, mcr_cache=None,
+                     margin=FAST_RANKING_MARGIN, factor=FAST_RANKING_FACTOR, images=None):
+    """
+    Rank the pairs by their eta values. With 'full' ranking, every pair is
+    scored at full resolution. With 'fast' ranking, every pair is scored
+    approximately, and only the pairs whose lowest approximate eta value is
+    within margin of the best one are scored again at full resolution.
+    :param images: Optional dictionary mapping (pedir, pair index) to the
+    data of aligned SEFMs which are already in memory
+    :return: Tuple of the selection dictionary returned by rank_sefm_pairs,
+    and the number of seconds the ranking took
+    """
+    start = time.time()
+    indices = list(range(len(pairs)))
+    etas = {}
+    if ranking == 'fast':
+        etas, images = fast_score_sefms(pairs, pedirs, temp_dir, templates, factor, images)
+        best = best_sefm_pair(etas, indices, pedirs)
+        lowest = {i: min(etas[(pedir, i)] for pedir in pedirs) for i in indices}
+        indices = [i for i in indices if lowest[best] - lowest[i] <= margin]
+        if len(indices) > 1:
+            print("{} SEFM pairs are within {} of the best approximate eta value, so scoring them at full resolution".format(len(indices), margin))
+    if ranking == 'full' or len(indices) > 1:
+        etas.update(score_sefms(subject, pairs, indices, pedirs, temp_dir, templates, eta_engine, mre_dir, mcr_cache, images))
+    return ({'etas': {pedir: [etas[(pedir, i)] for i in range(len(pairs))] for pedir in pedirs},
+             'best_pair': best_sefm_pair(etas, indices, pedirs)},
+            time.time() - start)
+
+
+def sefm_select(layout, edits, subject, sessions, base_temp_dir, fsl_dir, mre_dir,
+                debug=False, eta_engine='numpy', mcr_cache=None, flirt_jobs=1, flirt_threads=1,
+                benchmark=False, sefm_cache=None, invalidate_cache=False,
+                ranking='full', ranking_margin=FAST_RANKING_MARGIN,
+                ranking_factor=FAST_RANKING_FACTOR, benchmark_results=None,
+                registration='flirt', validate_registration=False):
     pos = 'PA'
     neg = 'AP'
 
@@ -69,12 +625,12 @@ def sefm_select(layout, subject, sessions, base_temp_dir, fsl_dir, mre_dir,
         pass
 
     print("Pairing for subject " + subject + ": " + subject + ", " + sessions)
-    pos_func_fmaps = layout.get(subject=subject, session=sessions, datatype='fmap', acquisition='func', direction=pos, extension='.nii.gz')
-    neg_func_fmaps = layout.get(subject=subject, session=sessions, datatype='fmap', acquisition='func', direction=neg, extension='.nii.gz')
+    pos_func_fmaps = layout.get(subject=subject, session=sessions, datatype='fmap', acquisition='func', direction=pos, extension=NIFTI_EXTENSIONS)
+    neg_func_fmaps = layout.get(subject=subject, session=sessions, datatype='fmap', acquisition='func', direction=neg, extension=NIFTI_EXTENSIONS)
     list_pos = [os.path.join(x.dirname, x.filename) for x in pos_func_fmaps]
     list_neg = [os.path.join(y.dirname, y.filename) for y in neg_func_fmaps]
 
-#    fmap = layout.get(subject=subject, session=sessions, datatype='fmap', acquisitionuisition='func', extension='.nii.gz')
+#    fmap = layout.get(subject=subject, session=sessions, datatype='fmap', acquisitionuisition='func', extension=NIFTI_EXTENSIONS)
 #    if len(fmap):
 #        list_pos = [x.filename for i, x in enumerate(fmap) if 'dir-PA' in x.filename]
 #        list_neg = [x.filename for i, x in enumerate(fmap) if 'dir-AP' in x.filename]
@@ -88,71 +644,53 @@ def sefm_select(layout, subject, sessions, base_temp_dir, fsl_dir, mre_dir,
     for pair in zip(list_pos, list_neg):
         pairs.append(pair)
     
-    pos_ref = pairs[0][0]
-    neg_ref = pairs[0][1]
-    
-    print("Aligning SEFMs and creating template")
-    for i, pair in enumerate(pairs):
-        pos_input = pair[0]
-        neg_input = pair[1]
-        for pedir,ref,flirt_in in [(pos,pos_ref,pos_input),(neg,neg_ref,neg_input)]:
-            out = os.path.join(temp_dir,'init_' + pedir + '_reg_' + str(i) + '.nii.gz')
-            cmd = [fsl_dir + 'flirt', '-in', flirt_in, '-ref', ref, '-dof', str(6), '-out', out]
-            subprocess.run(cmd, stdout=subprocess.DEVNULL, env=os.environ)
-
-    # Average the pos/neg SEFMs after alignment
-    
-    # First sum all of the images together
-    for pedir in [pos,neg]:
-        sum_cmd = [os.path.join(fsl_dir,'fslmaths'), os.path.join(temp_dir,'init_' + pedir + '_reg_0.nii.gz')]
-        for i in range(1,len(pairs)):
-            sum_cmd += ['-add', os.path.join(temp_dir,'init_' + pedir + '_reg_' + str(i) + '.nii.gz')]
-        sum_cmd += [os.path.join(temp_dir, pedir + '_sum.nii.gz')]
-        subprocess.run(sum_cmd, env=os.environ)
-
-    # Divide the sum by the number of pos/neg SEFMs to get the average
-    num_sefm = len(pairs)
-    for pedir in [pos,neg]:
-        avg_cmd = [os.path.join(fsl_dir, 'fslmaths'), os.path.join(temp_dir, pedir + '_sum.nii.gz'), '-div', str(num_sefm), os.path.join(temp_dir,pedir + '_mean.nii.gz')]
-        subprocess.run(avg_cmd, env=os.environ)
-    
-    print("Computing ETA squared value for each image to the template")
-    
-    # Calculate the eta squared value of each aligned image to the average and return the pair with the highest average
-    #avg_eta_dict = {}
-    min_eta_dict = {}
-    for i, pair in enumerate(pairs):
-        eta_list = []
-        for pedir,image in [(pos,pair[0]),(neg,pair[1])]:
-            mat_cmd = [os.path.join(ETA_DIR,'run_eta_squared.sh'), mre_dir, os.path.join(temp_dir,'init_' + pedir + '_reg_' + str(i) + '.nii.gz'), os.path.join(temp_dir,pedir + '_mean.nii.gz')]
-            mat_stdout = subprocess.check_output(mat_cmd)
-            eta = float(mat_stdout.split()[-1])
-            print(image + " eta value = " + str(eta))
-            eta_list.append(eta)
-        # instead of finding the average between eta values between pairs. Take the pair with the highest lowest eta value.
-        min_eta = min(eta_list)
-        min_eta_dict[pair] = min_eta
-    best_pos, best_neg = max(min_eta_dict, key=min_eta_dict.get)
+    # Rank the pairs, or restore their ranking from the cache if the SEFMs
+    # were ranked before with the same settings
+    cache_path = None
+    selection = None
+    if sefm_cache:
+        settings = [eta_engine]
+        if ranking == 'fast':
+            settings += [ranking, str(ranking_margin), str(ranking_factor)]
+        if registration != 'flirt':
+            settings += [registration]
+        cache_path = os.path.join(sefm_cache, hash_sefm_inputs(pairs, settings) + '.json')
+        if invalidate_cache and os.path.exists(cache_path):
+            print("Invalidating cached SEFM selection " + cache_path)
+            os.remove(cache_path)
+        selection = load_sefm_selection(cache_path)
+    if selection is None:
+        selection = rank_sefm_pairs(subject, pairs, (pos, neg), temp_dir, fsl_dir, mre_dir, eta_engine, mcr_cache, flirt_jobs, flirt_threads, benchmark,
+                                    ranking, ranking_margin, ranking_factor, benchmark_results, registration,
+                                    validate_registration)
+        if cache_path:
+            save_sefm_selection(cache_path, selection)
+    else:
+        print("Restored SEFM selection from " + cache_path)
+        for i, pair in enumerate(pairs):
+            for pedir, image in [(pos, pair[0]), (neg, pair[1])]:
+                print(image + " eta value = " + str(selection['etas'][pedir][i]))
+    best_pos, best_neg = pairs[selection['best_pair']]
     print(best_pos)
     print(best_neg)
 
     # Add metadata
-    func_list = [os.path.join(x.dirname, x.filename) for x in layout.get(subject=subject, session=sessions, datatype='func', extension='.nii.gz')]
-    anat_list = [os.path.join(x.dirname, x.filename) for x in layout.get(subject=subject, session=sessions, datatype='anat', extension='.nii.gz')]
+    func_list = [os.path.join(x.dirname, x.filename) for x in layout.get(subject=subject, session=sessions, datatype='func', extension=NIFTI_EXTENSIONS)]
+    anat_list = [os.path.join(x.dirname, x.filename) for x in layout.get(subject=subject, session=sessions, datatype='anat', extension=NIFTI_EXTENSIONS)]
     for pair in pairs:
         pos_nifti = pair[0]
         neg_nifti = pair[1]
-        pos_json = pos_nifti.replace(".nii.gz", ".json")
-        neg_json = neg_nifti.replace(".nii.gz", ".json")
-        insert_edit_json(pos_json, "PhaseEncodingDirection", "j")
-        insert_edit_json(neg_json, "PhaseEncodingDirection", "j-")
+        pos_json = get_sidecar_path(pos_nifti)
+        neg_json = get_sidecar_path(neg_nifti)
+        edits.insert_edit_json(pos_json, "PhaseEncodingDirection", "j")
+        edits.insert_edit_json(neg_json, "PhaseEncodingDirection", "j-")
         
         if pair == (best_pos, best_neg):
-            insert_edit_json(pos_json, "IntendedFor", anat_list + func_list)
-            insert_edit_json(neg_json, "IntendedFor", anat_list + func_list)
+            edits.insert_edit_json(pos_json, "IntendedFor", anat_list + func_list)
+            edits.insert_edit_json(neg_json, "IntendedFor", anat_list + func_list)
         else:
-            insert_edit_json(pos_json, "IntendedFor", [])
-            insert_edit_json(neg_json, "IntendedFor", [])
+            edits.insert_edit_json(pos_json, "IntendedFor", [])
+            edits.insert_edit_json(neg_json, "IntendedFor", [])
     
     # Delete the temp directory containing all the intermediate images
     if not debug:
@@ -164,13 +702,13 @@ def sefm_select(layout, subject, sessions, base_temp_dir, fsl_dir, mre_dir,
     return best_pos, best_neg
 
 
-def seperate_concatenated_fm(bids_layout, subject, session, fsl_dir, debug=False):
-    fmap = bids_layout.get(subject=subject, session=session, datatype='fmap', acquisition='func', direction='both', extension='.nii.gz')
-    # use the first functional image as the reference for the nifti header after fslswapdim
-    func_ref_fn = bids_layout.get(subject=subject, session=session, datatype='func', extension='.nii.gz')[0].filename
-    func_ref_dir = bids_layout.get(subject=subject, session=session, datatype='func', extension='.nii.gz')[0].dirname
-    func_ref = os.path.join(func_ref_dir, func_ref_fn)
-    print("functional reference: {}".format(func_ref))
+def seperate_concatenated_fm(bids_layout, edits, subject, session, debug=False):
+    fmap = bids_layout.get(subject=subject, session=session, datatype='fmap', acquisition='func', direction='both', extension=NIFTI_EXTENSIONS)
+    # use the first functional image as the reference for the nifti header after flipping the AP volume
+    func_ref_fn = bids_layout.get(subject=subject, session=session, datatype='func', extension=NIFTI_EXTENSIONS)[0].filename
+    func_ref_dir = bids_layout.get(subject=subject, session=session, datatype='func', extension=NIFTI_EXTENSIONS)[0].dirname
+    func_ref = nibabel.load(os.path.join(func_ref_dir, func_ref_fn))
+    print("functional reference: {}".format(func_ref.get_filename()))
     for FM in fmap:
         FM_dir = FM.dirname
         FM_fn = FM.filename
@@ -178,93 +716,121 @@ def seperate_concatenated_fm(bids_layout, subject, session, fsl_dir, debug=False
         print("Splitting up {}".format(FM_concatenated))
         AP_fn = FM_concatenated.replace("-both_", "-AP_")
         PA_fn = FM_concatenated.replace("-both_", "-PA_")
-        split = [fsl_dir + "/fslsplit", FM_concatenated, os.path.join(FM_dir,"vol"), "-t"]
-        subprocess.run(split, env=os.environ)
-        swap_dim = [fsl_dir + "/fslswapdim", os.path.join(FM_dir, "vol0000.nii.gz"), "x", "-y", "z", os.path.join(FM_dir, "vol0000.nii.gz")]
-        subprocess.run(swap_dim, env=os.environ)
-        os.rename(os.path.join(FM_dir, "vol0000.nii.gz"), AP_fn)
-        os.rename(os.path.join(FM_dir, "vol0001.nii.gz"), PA_fn)
-
-        # Change by Greg 2019-06-10: Replaced hardcoded Exacloud path to
-        # FSL_identity_transformation_matrix with relative path to that
-        # file in the pwd
-        AP_flirt = [fsl_dir + "/flirt", "-out", AP_fn, "-in", AP_fn, "-ref", func_ref, "-applyxfm", "-init", os.path.join(ETA_DIR, "FSL_identity_transformation_matrix.mat"), "-interp", "spline"]
-        PA_flirt = [fsl_dir + "/flirt", "-out", PA_fn, "-in", PA_fn, "-ref", func_ref, "-applyxfm", "-init", os.path.join(ETA_DIR, "FSL_identity_transformation_matrix.mat"), "-interp", "spline"]
-
-        subprocess.run(AP_flirt, env=os.environ)
-        subprocess.run(PA_flirt, env=os.environ)
+
+        # Split the volumes in memory, flipping the AP volume's y axis, and
+        # put both on the grid of the functional reference. The split
+        # fieldmaps keep the same format as the original, since their names do
+        concatenated = nibabel.load(FM_concatenated)
+        for volume, flip_y, out_fn in [(0, True, AP_fn), (1, False, PA_fn)]:
+            nibabel.save(split_fieldmap_volume(concatenated, volume, flip_y, func_ref), out_fn)
         
         # create the side car jsons for the new pair
-        orig_json = FM_concatenated.replace(".nii.gz", ".json")
-        AP_json = AP_fn.replace(".nii.gz", ".json")
-        PA_json = PA_fn.replace(".nii.gz", ".json")
+        orig_json = get_sidecar_path(FM_concatenated)
+        AP_json = get_sidecar_path(AP_fn)
+        PA_json = get_sidecar_path(PA_fn)
         shutil.copyfile(orig_json, AP_json)
         shutil.copyfile(orig_json, PA_json)
-        insert_edit_json(orig_json, 'PhaseEncodingDirection', 'NA')
-        insert_edit_json(AP_json, 'PhaseEncodingDirection', 'j-')
-        insert_edit_json(PA_json, 'PhaseEncodingDirection', 'j')
+        edits.insert_edit_json(orig_json, 'PhaseEncodingDirection', 'NA')
+        edits.insert_edit_json(AP_json, 'PhaseEncodingDirection', 'j-')
+        edits.insert_edit_json(PA_json, 'PhaseEncodingDirection', 'j')
         # add required fields to the orig json as well
-        insert_edit_json(orig_json, 'IntendedFor', [])
-
-    #if not debug:
-    #    rm_cmd = ['rm', '-rf', os.path.join(FM_dir, "vol*")]
-    #    subprocess.run(rm_cmd, env=os.environ)
-    #    rm_cmd = ['rm', '-rf', os.path.join()]
-    #    subprocess.run(rm_cmd, env=os.environ)
+        edits.insert_edit_json(orig_json, 'IntendedFor', [])
    
     return
 
-def edit_dwi_jsons(layout, subject, sessions):
+
+def split_fieldmap_volume(image, volume, flip_y, reference):
+    """
+    Do in memory what fslsplit, fslswapdim x -y z, and flirt -applyxfm with
+    an identity matrix and spline interpolation do to one volume: FLIRT maps
+    the volume onto the reference grid through FSL's scaled voxel
+    coordinates, ignoring where the headers place either image. When that
+    mapping only reorders voxels, which it does if both grids have the same
+    shape and voxel sizes, the voxels are copied instead of interpolated.
+    :param image: nibabel image of a 4D fieldmap
+    :param volume: Int, index of the volume to split off
+    :param flip_y: True to reverse the volume's y axis, like fslswapdim
+    :param reference: nibabel image whose grid and header to use
+    :return: nibabel image of the volume on the grid of reference, with the
+    data type of image
+    """
+    # Only the one volume is read, straight from the memory-mapped file if
+    # image is not compressed
+    data = np.asarray(image.dataobj[..., volume], dtype=np.float64)
+    affine = image.affine
+    if flip_y:
+        data = data[:, ::-1, :]
+        flip = np.eye(4)
+        flip[1, 1] = -1
+        flip[1, 3] = data.shape[1] - 1
+        affine = affine.dot(flip)
+    voxel_map = np.linalg.inv(rigid_registration.fsl_scaling(data.shape, image.header.get_zooms(), affine)).dot(
+        rigid_registration.fsl_scaling(reference.shape, reference.header.get_zooms(), reference.affine))
+    linear = voxel_map[:3, :3]
+    if (data.shape == reference.shape[:3] and np.allclose(np.abs(linear), np.eye(3))
+            and np.allclose(voxel_map[:3, 3], np.rint(voxel_map[:3, 3]))):
+        # Each axis maps onto itself, at most reversed, so no resampling is needed
+        print("Fieldmap grid matches the functional reference, so not resampling it")
+        resampled = data[tuple(slice(None, None, -1) if linear[axis, axis] < 0 else slice(None) for axis in range(3))]
+    else:
+        resampled = ndimage.affine_transform(data, linear, voxel_map[:3, 3], output_shape=reference.shape[:3],
+                                             order=3, mode='constant', cval=0.0)
+    header = reference.header.copy()
+    header.set_data_dtype(image.get_data_dtype())
+    header.set_slope_inter(1, 0)
+    return nibabel.Nifti1Image(cast_to_dtype(resampled, image.get_data_dtype()), None, header)
+
+
+def edit_dwi_jsons(layout, edits, scanners, subject, sessions):
     print('Editing DWI sidecar jsons')
     all_json_paths = []
     # Get rel path of all dwi images
     rel_dwi_paths = []
-    for dwi in layout.get(subject=subject, session=sessions, datatype='dwi', suffix='dwi', extension='.nii.gz'):
+    for dwi in layout.get(subject=subject, session=sessions, datatype='dwi', suffix='dwi', extension=NIFTI_EXTENSIONS):
         dwi_fn = dwi.filename
         dwi_dir = dwi.dirname
-        dwi_json = dwi_fn.replace('.nii.gz', '.json')
+        dwi_json = get_sidecar_path(dwi_fn)
         all_json_paths += [os.path.join(dwi_dir, dwi_json)]
         rel_path = "/".join(dwi_dir.split("/")[-3:] + [dwi_fn])
         rel_dwi_paths += [rel_path]
 
     # There should currently only be a single dwi fmap TODO: allow for multiple fmaps
-    AP = layout.get(subject=subject, session=sessions, datatype='fmap', acquisition='dwi', direction='AP', extension='.nii.gz')
+    AP = layout.get(subject=subject, session=sessions, datatype='fmap', acquisition='dwi', direction='AP', extension=NIFTI_EXTENSIONS)
     AP_json = layout.get(subject=subject, session=sessions, datatype='fmap', acquisition='dwi', direction='AP', extension='.json')
     assert(len(AP_json) == 1)
     AP_json_path = "/".join([AP_json[0].dirname, AP_json[0].filename])
     all_json_paths += [AP_json_path]
 
-    insert_edit_json(AP_json_path, 'IntendedFor', rel_dwi_paths)
-    insert_edit_json(AP_json_path, 'PhaseEncodingDirection', 'j-')
+    edits.insert_edit_json(AP_json_path, 'IntendedFor', rel_dwi_paths)
+    edits.insert_edit_json(AP_json_path, 'PhaseEncodingDirection', 'j-')
     
     # We are not using the PA even if one is included
     PA_json = layout.get(subject=subject, session=sessions, datatype='fmap', acquisition='dwi', direction='PA', extension='.json')
     if PA_json:
         PA_json_path = "/".join([PA_json[0].dirname, PA_json[0].filename])
         all_json_paths += [PA_json_path]
-        insert_edit_json(PA_json_path, 'IntendedFor',[])
-        insert_edit_json(PA_json_path, 'PhaseEncodingDirection', 'j')
+        edits.insert_edit_json(PA_json_path, 'IntendedFor',[])
+        edits.insert_edit_json(PA_json_path, 'PhaseEncodingDirection', 'j')
 
-        insert_edit_json(PA_json_path, 'PhaseEncodingDirection', 'j')
+        edits.insert_edit_json(PA_json_path, 'PhaseEncodingDirection', 'j')
 
     
     for json_path in all_json_paths:
-        nii_path = json_path.replace('.json', '.nii.gz')
-        dwi_metadata = layout.get_metadata(nii_path)
-        if 'GE' in dwi_metadata['Manufacturer']:
-            if 'DV26' in dwi_metadata['SoftwareVersions']:
-                insert_edit_json(json_path, 'EffectiveEchoSpacing', 0.000768)
-                insert_edit_json(json_path, 'TotalReadoutTime', 0.106752)
-            if 'DV25' in dwi_metadata['SoftwareVersions']:
-                insert_edit_json(json_path, 'EffectiveEchoSpacing', 0.000752)
-                insert_edit_json(json_path, 'TotalReadoutTime', 0.104528)
-        elif 'Philips' in dwi_metadata['Manufacturer']:
-            insert_edit_json(json_path, 'EffectiveEchoSpacing', 0.00062771)
-            insert_edit_json(json_path, 'TotalReadoutTime', 0.08976)
-            insert_edit_json(json_path, 'PhaseEncodingDirection', 'j')
-        elif 'Siemens' in dwi_metadata['Manufacturer']:
-            insert_edit_json(json_path, 'EffectiveEchoSpacing', 0.000689998)
-            insert_edit_json(json_path, 'TotalReadoutTime', 0.0959097)
+        manufacturer, software_versions = get_scanner(layout, scanners, json_path)
+        if 'GE' in manufacturer:
+            if 'DV26' in software_versions:
+                edits.insert_edit_json(json_path, 'EffectiveEchoSpacing', 0.000768)
+                edits.insert_edit_json(json_path, 'TotalReadoutTime', 0.106752)
+            if 'DV25' in software_versions:
+                edits.insert_edit_json(json_path, 'EffectiveEchoSpacing', 0.000752)
+                edits.insert_edit_json(json_path, 'TotalReadoutTime', 0.104528)
+        elif 'Philips' in manufacturer:
+            edits.insert_edit_json(json_path, 'EffectiveEchoSpacing', 0.00062771)
+            edits.insert_edit_json(json_path, 'TotalReadoutTime', 0.08976)
+            edits.insert_edit_json(json_path, 'PhaseEncodingDirection', 'j')
+        elif 'Siemens' in manufacturer:
+            edits.insert_edit_json(json_path, 'EffectiveEchoSpacing', 0.000689998)
+            edits.insert_edit_json(json_path, 'TotalReadoutTime', 0.0959097)
         else:
             print("ERROR: DWI manufacturer not recognized")
 
@@ -273,20 +839,82 @@ def edit_dwi_jsons(layout, subject, sessions):
     return
     
 
-def insert_edit_json(json_path, json_field, value):
-    with open(json_path, 'r') as f:
-        data = json.load(f)
-    if json_field in data and data[json_field] != value:
-        print('WARNING: Replacing {}: {} with {} in {}'.format(json_field, data[json_field], value, json_path))
-    else:
-        print('Inserting {}: {} in {}'.format(json_field, value, json_path))
-        
-    data[json_field] = value
-    with open(json_path, 'w') as f:    
-        json.dump(data, f, indent=4)
+class SidecarEdits(object):
+    """
+    Sidecar JSONs of a session, each read from disk once, and the field
+    changes made to them, collected in memory while the session is edited
+    and then written with one write per JSON. A JSON is only written again
+    if its fields differ from what was read.
+    """
+    def __init__(self):
+        self.originals = {}
+        self.edited = {}
+
+    def get_metadata(self, json_path):
+        """
+        :return: Dictionary of the sidecar JSON at json_path, with the
+        changes made to it so far
+        """
+        if json_path in self.edited:
+            return self.edited[json_path]
+        if json_path not in self.originals:
+            with open(json_path, 'r') as f:
+                self.originals[json_path] = json.load(f)
+        return self.originals[json_path]
+
+    def insert_edit_json(self, json_path, json_field, value):
+        if json_path not in self.edited:
+            self.edited[json_path] = copy.deepcopy(self.get_metadata(json_path))
+        data = self.edited[json_path]
+        if json_field in data and data[json_field] != value:
+            print('WARNING: Replacing {}: {} with {} in {}'.format(json_field, data[json_field], value, json_path))
+        else:
+            print('Inserting {}: {} in {}'.format(json_field, value, json_path))
+
+        data[json_field] = value
+
+    def flush(self):
+        """
+        Write every edited JSON whose fields changed, then forget the edits
+        :return: Int, number of JSONs written
+        """
+        written = 0
+        for json_path, data in self.edited.items():
+            if data != self.originals[json_path]:
+                with open(json_path, 'w') as f:
+                    json.dump(data, f, indent=4)
+                written += 1
+        print('Wrote {} of {} edited sidecar jsons'.format(written, len(self.edited)))
+        self.originals = {}
+        self.edited = {}
+        return written
+
+
+def session_scanners(layout, edits, subject, sessions):
+    """
+    :param layout: SessionIndex of the subject's sessions
+    :param edits: SidecarEdits to read the sidecar JSONs with
+    :return: Dictionary mapping each session label to a tuple of the
+    Manufacturer and SoftwareVersions of the scanner the session was acquired
+    on, read from the first of the session's sidecar JSONs which has them
+    """
+    scanners = {}
+    for sidecar in layout.get(subject=subject, session=sessions, extension='.json'):
+        session = sidecar.entities.get('session')
+        if session not in scanners:
+            metadata = edits.get_metadata(sidecar.path)
+            if 'Manufacturer' in metadata:
+                scanners[session] = (metadata['Manufacturer'], metadata.get('SoftwareVersions', ''))
+    return scanners
+
+
+def get_scanner(layout, scanners, path):
+    """
+    :return: Tuple of the Manufacturer and SoftwareVersions of the session of
+    the file at path, or of empty strings if none of its sidecars had them
+    """
+    return scanners.get(layout.by_path[path].entities.get('session'), ('', ''))
 
-    return
-        
 
 def generate_parser(parser=None):
     """
@@ -308,8 +936,16 @@ def generate_parser(parser=None):
         help="Required: Path to FSL directory."
     )
     parser.add_argument(
-        'mre_dir',
-        help="Required: Path to MATLAB Runtime Environment (MRE) directory."
+        'mre_dir', nargs='?', default=None,
+        help="Path to MATLAB Runtime Environment (MRE) directory. Only "
+             "needed with --eta-engine matlab or compare."
+    )
+    parser.add_argument(
+        '--eta-engine', dest='eta_engine', choices=ETA_ENGINES,
+        default='numpy',
+        help="How to calculate eta squared: natively with NumPy, with the "
+             "compiled MATLAB function, or with both, reporting whether "
+             "they agree and how long each took. Default: numpy."
     )
     parser.add_argument(
         '--participant-label', dest='subject_list', metavar='ID', nargs='+',
@@ -317,6 +953,94 @@ def generate_parser(parser=None):
              'found under the bids input directory.  A participant label '
              'does not include "sub-"'
     )
+    parser.add_argument(
+        '--mcr-cache', dest='mcr_cache', metavar='DIR', default=None,
+        help="Folder to keep the MATLAB Runtime cache in between calls of "
+             "the compiled MATLAB function, instead of making and deleting a "
+             "new one for every call. Only used with --eta-engine matlab or "
+             "compare."
+    )
+    parser.add_argument(
+        '--flirt-jobs', dest='flirt_jobs', type=int, default=1,
+        help="Number of FLIRT registrations to run at the same time. "
+             "Default: 1."
+    )
+    parser.add_argument(
+        '--flirt-threads', dest='flirt_threads', type=int, default=1,
+        help="Number of threads each FLIRT process may use. Default: 1."
+    )
+    parser.add_argument(
+        '--benchmark-flirt', dest='benchmark_flirt', action='store_true',
+        help="Also run the registrations one at a time, then print how long "
+             "that took compared to --flirt-jobs and whether both made "
+             "identical images."
+    )
+    parser.add_argument(
+        '--registration-engine', dest='registration', choices=REGISTRATION_ENGINES,
+        default='flirt',
+        help="How to align each SEFM to the first SEFM with the same phase "
+             "encoding direction: with FSL's FLIRT, or in this process with "
+             "NumPy and SciPy, passing the aligned SEFMs straight to the eta "
+             "squared calculation without writing them to disk. Default: "
+             "flirt."
+    )
+    parser.add_argument(
+        '--validate-registration', dest='validate_registration', action='store_true',
+        help="Also align the SEFMs both with FLIRT and in this process, then "
+             "print how far apart their transforms are, how long each took, "
+             "and whether both lead to the same SEFM pair."
+    )
+    parser.add_argument(
+        '--sefm-cache', dest='sefm_cache', metavar='DIR', default=None,
+        help="Folder to cache each session's eta values and best SEFM pair "
+             "in, keyed by the contents of its SEFMs, the FSL version, and "
+             "--eta-engine. Sessions whose SEFMs were ranked before are not "
+             "registered or ranked again; only their sidecars are edited. "
+             "By default, no cache is used."
+    )
+    parser.add_argument(
+        '--invalidate-sefm-cache', dest='invalidate_cache', action='store_true',
+        help="Rank the SEFMs again even if they are in --sefm-cache, and "
+             "replace the cached ranking."
+    )
+    parser.add_argument(
+        '--sefm-ranking', dest='ranking', choices=['full', 'fast'],
+        default='full',
+        help="How to rank the SEFM pairs. 'full' calculates every eta value "
+             "at full resolution. 'fast' approximates them inside a rough "
+             "brain mask on a downsampled grid, and only calculates them at "
+             "full resolution for the pairs within --fast-ranking-margin of "
+             "the best one. Default: full."
+    )
+    parser.add_argument(
+        '--fast-ranking-margin', dest='ranking_margin', type=float,
+        default=FAST_RANKING_MARGIN,
+        help="With --sefm-ranking fast, pairs whose lowest approximate eta "
+             "value is at most this much lower than the best pair's are "
+             "ranked again at full resolution. Default: {}."
+             .format(FAST_RANKING_MARGIN)
+    )
+    parser.add_argument(
+        '--fast-ranking-factor', dest='ranking_factor', type=int,
+        default=FAST_RANKING_FACTOR,
+        help="With --sefm-ranking fast, average blocks of this many voxels "
+             "along each side before approximating eta values. Default: {}."
+             .format(FAST_RANKING_FACTOR)
+    )
+    parser.add_argument(
+        '--benchmark-ranking', dest='benchmark_ranking', action='store_true',
+        help="Rank each session's SEFMs with both fast and full ranking, "
+             "then print how often they chose the same pair and how much "
+             "time fast ranking saved. Sessions restored from --sefm-cache "
+             "are not benchmarked."
+    )
+    parser.add_argument(
+        '--benchmark-ranking-results', dest='ranking_results_file',
+        metavar='FILE',
+        help="With --benchmark-ranking, also append each benchmarked "
+             "session's result to this file as one line of JSON, so that "
+             "the results of several runs can be combined."
+    )
     parser.add_argument(
         '-a','--all-sessions', dest='collect', action='store_true',
         help='collapses all sessions into one when running a subject.'
@@ -343,6 +1067,14 @@ def generate_parser(parser=None):
 def main(argv=sys.argv):
     parser = generate_parser()
     args = parser.parse_args()
+    if args.eta_engine != 'numpy' and not args.mre_dir:
+        parser.error("--eta-engine " + args.eta_engine + " needs mre_dir.")
+    if args.flirt_jobs < 1 or args.flirt_threads < 1:
+        parser.error("--flirt-jobs and --flirt-threads must be at least 1.")
+    if args.ranking_margin < 0 or args.ranking_factor < 1:
+        parser.error("--fast-ranking-margin must not be negative and "
+                     "--fast-ranking-factor must be at least 1.")
+    ranking_results = [] if args.benchmark_ranking else None
 
     # Set environment variables for FSL dir based on CLI
     os.environ['FSL_DIR'] = args.fsl_dir
@@ -350,80 +1082,111 @@ def main(argv=sys.argv):
     # for this script's usage of FSL_DIR...
     fsl_dir = args.fsl_dir + '/bin'
 
-    # Load the bids layout
-    layout = BIDSLayout(args.bids_dir)
-    subsess = read_bids_layout(layout, subject_list=args.subject_list, collect_on_subject=args.collect)
+    # List the subject and session folders
+    subsess = read_bids_layout(args.bids_dir, subject_list=args.subject_list, collect_on_subject=args.collect)
 
     for subject,sessions in subsess:
+        # Index the session's files once, then answer every query about them from the index
+        index = SessionIndex(os.path.abspath(args.bids_dir), subject, sessions)
+        # Collect the session's sidecar edits, to write each JSON once at the end
+        edits = SidecarEdits()
  
         # Check if fieldmaps are concatenated
-        if layout.get(subject=subject, session=sessions, datatype='fmap', extension='.nii.gz', acquisition='func', direction='both'):
+        if index.get(subject=subject, session=sessions, datatype='fmap', extension=NIFTI_EXTENSIONS, acquisition='func', direction='both'):
             print("Func fieldmaps are concatenated. Running seperate_concatenate_fm")
-            seperate_concatenated_fm(layout, subject, sessions, fsl_dir)
-            # recreate layout with the additional SEFMS
-            layout = BIDSLayout(args.bids_dir)
+            seperate_concatenated_fm(index, edits, subject, sessions)
+            # index the session again to find the additional SEFMS
+            index = SessionIndex(os.path.abspath(args.bids_dir), subject, sessions)
+
+        # Find which scanner each session was acquired on once, for all of the manufacturer-specific edits
+        scanners = session_scanners(index, edits, subject, sessions)
         
 
-        fmap = layout.get(subject=subject, session=sessions, datatype='fmap', extension='.nii.gz', acquisition='func')        
+        fmap = index.get(subject=subject, session=sessions, datatype='fmap', extension=NIFTI_EXTENSIONS, acquisition='func')        
         # Check if there are func fieldmaps and return a list of each SEFM pos/neg pair
         if fmap:
             print("Running SEFM select")
             base_temp_dir = fmap[0].dirname
-            bes_pos, best_neg = sefm_select(layout, subject, sessions,
+            bes_pos, best_neg = sefm_select(index, edits, subject, sessions,
                                             base_temp_dir, fsl_dir, args.mre_dir,
-                                            args.debug)
+                                            args.debug, args.eta_engine,
+                                            args.mcr_cache, args.flirt_jobs,
+                                            args.flirt_threads,
+                                            args.benchmark_flirt,
+                                            args.sefm_cache,
+                                            args.invalidate_cache,
+                                            args.ranking,
+                                            args.ranking_margin,
+                                            args.ranking_factor,
+                                            ranking_results,
+                                            args.registration,
+                                            args.validate_registration)
             for sefm in [os.path.join(x.dirname, x.filename) for x in fmap]:
-                sefm_json = sefm.replace('.nii.gz', '.json')
-                sefm_metadata = layout.get_metadata(sefm)
+                sefm_json = get_sidecar_path(sefm)
+                manufacturer, _ = get_scanner(index, scanners, sefm)
 
-                if 'Philips' in sefm_metadata['Manufacturer']:
-                    insert_edit_json(sefm_json, 'EffectiveEchoSpacing', 0.00062771)
-                if 'GE' in sefm_metadata['Manufacturer']:
-                    insert_edit_json(sefm_json, 'EffectiveEchoSpacing', 0.000536)
-                if 'Siemens' in sefm_metadata['Manufacturer']:
-                    insert_edit_json(sefm_json, 'EffectiveEchoSpacing', 0.000510012)
+                if 'Philips' in manufacturer:
+                    edits.insert_edit_json(sefm_json, 'EffectiveEchoSpacing', 0.00062771)
+                if 'GE' in manufacturer:
+                    edits.insert_edit_json(sefm_json, 'EffectiveEchoSpacing', 0.000536)
+                if 'Siemens' in manufacturer:
+                    edits.insert_edit_json(sefm_json, 'EffectiveEchoSpacing', 0.000510012)
 
         # Check if there are dwi fieldmaps and insert IntendedFor field accordingly
-        if layout.get(subject=subject, session=sessions, datatype='fmap', extension='.nii.gz', acquisition='dwi'):
+        if index.get(subject=subject, session=sessions, datatype='fmap', extension=NIFTI_EXTENSIONS, acquisition='dwi'):
             print("Editing DWI jsons")
-            edit_dwi_jsons(layout, subject, sessions)
+            edit_dwi_jsons(index, edits, scanners, subject, sessions)
                     
 
 
         # Additional edits to the anat json sidecar
-        anat = layout.get(subject=subject, session=sessions, datatype='anat', extension='.nii.gz')
+        anat = index.get(subject=subject, session=sessions, datatype='anat', extension=NIFTI_EXTENSIONS)
         if anat:
             for TX in [os.path.join(x.dirname, x.filename) for x in anat]:
-                TX_json = TX.replace('.nii.gz', '.json') 
-                TX_metadata = layout.get_metadata(TX)
+                TX_json = get_sidecar_path(TX) 
+                manufacturer, _ = get_scanner(index, scanners, TX)
                     #if 'T1' in TX_metadata['SeriesDescription']:
 
-                if 'Philips' in TX_metadata['Manufacturer']:
-                    insert_edit_json(TX_json, 'DwellTime', 0.00062771)
-                if 'GE' in TX_metadata['Manufacturer']:
-                    insert_edit_json(TX_json, 'DwellTime', 0.000536)
-                if 'Siemens' in TX_metadata['Manufacturer']:
-                    insert_edit_json(TX_json, 'DwellTime', 0.000510012)
+                if 'Philips' in manufacturer:
+                    edits.insert_edit_json(TX_json, 'DwellTime', 0.00062771)
+                if 'GE' in manufacturer:
+                    edits.insert_edit_json(TX_json, 'DwellTime', 0.000536)
+                if 'Siemens' in manufacturer:
+                    edits.insert_edit_json(TX_json, 'DwellTime', 0.000510012)
         
         # add EffectiveEchoSpacing if it doesn't already exist
 
         # PE direction vs axis
-        func = layout.get(subject=subject, session=sessions, datatype='func', extension='.nii.gz')
+        func = index.get(subject=subject, session=sessions, datatype='func', extension=NIFTI_EXTENSIONS)
         if func:
             for task in [os.path.join(x.dirname, x.filename) for x in func]:
-                task_json = task.replace('.nii.gz', '.json')
-                task_metadata = layout.get_metadata(task)
-                if 'Philips' in task_metadata['Manufacturer']:
-                    insert_edit_json(task_json, 'EffectiveEchoSpacing', 0.00062771)
-                if 'GE' in task_metadata['Manufacturer']:
-                    if 'DV26' in task_metadata['SoftwareVersions']:
-                        insert_edit_json(task_json, 'EffectiveEchoSpacing', 0.000556)
-                if 'Siemens' in task_metadata['Manufacturer']:
-                    insert_edit_json(task_json, 'EffectiveEchoSpacing', 0.000510012)                
+                task_json = get_sidecar_path(task)
+                task_metadata = edits.get_metadata(task_json)
+                manufacturer, software_versions = get_scanner(index, scanners, task)
+                if 'Philips' in manufacturer:
+                    edits.insert_edit_json(task_json, 'EffectiveEchoSpacing', 0.00062771)
+                if 'GE' in manufacturer:
+                    if 'DV26' in software_versions:
+                        edits.insert_edit_json(task_json, 'EffectiveEchoSpacing', 0.000556)
+                if 'Siemens' in manufacturer:
+                    edits.insert_edit_json(task_json, 'EffectiveEchoSpacing', 0.000510012)                
                 if "PhaseEncodingAxis" in task_metadata:
-                    insert_edit_json(task_json, 'PhaseEncodingDirection', task_metadata['PhaseEncodingAxis'])
+                    edits.insert_edit_json(task_json, 'PhaseEncodingDirection', task_metadata['PhaseEncodingAxis'])
                 elif "PhaseEncodingDirection" in task_metadata:
-                    insert_edit_json(task_json, 'PhaseEncodingAxis', task_metadata['PhaseEncodingDirection'].strip('-'))
+                    edits.insert_edit_json(task_json, 'PhaseEncodingAxis', task_metadata['PhaseEncodingDirection'].strip('-'))
+
+        edits.flush()
+
+    if ranking_results and args.ranking_results_file:
+        save_ranking_results(args.ranking_results_file, ranking_results)
+    if ranking_results:
+        agreed = sum(1 for agree, _, _ in ranking_results if agree)
+        full_seconds = sum(full for _, full, _ in ranking_results)
+        fast_seconds = sum(fast for _, _, fast in ranking_results)
+        print("SEFM ranking benchmark: fast and full ranking chose the same pair for {} of {} session(s) ({:.0f}%). "
+              "Ranking took {:.2f} seconds fast and {:.2f} seconds full, saving {:.2f} seconds ({:.0f}%)".format(
+                  agreed, len(ranking_results), 100 * agreed / len(ranking_results), fast_seconds, full_seconds,
+                  full_seconds - fast_seconds, 100 * (full_seconds - fast_seconds) / max(full_seconds, 1e-9)))
      
 
 if __name__ == "__main__":
@@ -0,0 +1,238 @@
+#! /usr/bin/env python3
+
+"""
+Series classifier for dcm2bids config files
+Compiles the descriptions in a dcm2bids config file (abcd_dcm2bids.conf) into
+regular expressions once, then pairs dcm2niix sidecars with descriptions and
+builds their BIDS file names the same way dcm2bids 2.1.4 does:
+  - A sidecar is used only if exactly one description matches it
+  - Sidecars are ordered by SeriesNumber, AcquisitionTime, then file name
+  - Sidecars with the same BIDS name get _run-01, _run-02, ... in that order
+"""
+
+import fnmatch
+import json
+import os
+import re
+import sys
+from collections import OrderedDict, defaultdict, namedtuple
+
+# Version recorded in each sidecar's "Dcm2bidsVersion", as dcm2bids does
+DCM2BIDS_VERSION = "2.1.4"
+
+COMP_KEYS = ["SeriesNumber", "AcquisitionTime", "SidecarFilename"]
+RUN_TEMPLATE = "_run-{:02d}"
+SEARCH_METHODS = ["fnmatch", "re"]
+
+# One sidecar paired with one description. src_root is the sidecar's path
+# without extension; dst_root is the BIDS path, relative to the BIDS folder,
+# without extension.
+Acquisition = namedtuple("Acquisition", ["src_root", "data_type", "dst_root",
+                                         "description", "data"])
+
+
+def prepend(value, char="_"):
+    """
+    :return: value with char in front of it, unless it's empty or already
+    starts with char
+    """
+    if value.strip() == "":
+        return ""
+    elif value.startswith(char):
+        return value
+    else:
+        return char + value
+
+
+def split_ext(path):
+    """
+    :return: Tuple of path without its extension, and its extension, which
+    is .nii.gz for gzipped NIfTIs
+    """
+    if path.endswith(".nii.gz"):
+        return path[:-7], path[-7:]
+    return os.path.splitext(path)
+
+
+class Sidecar(object):
+    """
+    A dcm2niix sidecar, sorted like the dcm2bids Sidecar class: one sidecar
+    comes before another if ANY of the comparison keys is smaller.
+    """
+    __slots__ = ("path", "root", "orig_data", "data", "comp_keys")
+
+    def __init__(self, path, comp_keys=COMP_KEYS):
+        self.path = path
+        self.root = split_ext(path)[0]
+        try:
+            with open(path) as f:
+                self.orig_data = json.load(f, object_pairs_hook=OrderedDict)
+        except (OSError, ValueError):
+            self.orig_data = OrderedDict()
+        self.data = dict(self.orig_data)
+        self.data["SidecarFilename"] = os.path.basename(path)
+        self.comp_keys = comp_keys
+
+    def __lt__(self, other):
+        for key in self.comp_keys:
+            try:
+                if self.data.get(key) < other.data.get(key):
+                    return True
+            except TypeError:
+                pass
+        return False
+
+
+class SeriesClassifier(object):
+    """
+    Matches sidecars against the descriptions of a dcm2bids config file,
+    compiling each description's criteria into regular expressions once.
+    """
+
+    def __init__(self, config, nifti_ext=".nii.gz"):
+        """
+        :param config: Dictionary from a dcm2bids config file, or a path to one
+        :param nifti_ext: Extension of the NIfTIs that IntendedFor points to
+        """
+        self.nifti_ext = nifti_ext
+        if not isinstance(config, dict):
+            with open(config) as f:
+                config = json.load(f, object_pairs_hook=OrderedDict)
+        self.descriptions = config["descriptions"]
+        self.comp_keys = config.get("compKeys", COMP_KEYS)
+        search_method = config.get("searchMethod", "fnmatch")
+        if search_method not in SEARCH_METHODS:
+            print("WARNING: '{}' is not a dcm2bids search method. Falling back "
+                  "to fnmatch".format(search_method))
+            search_method = "fnmatch"
+        self.criteria = [
+            [(tag, self.compile(pattern, search_method))
+             for tag, pattern in description.get("criteria", {}).items()]
+            for description in self.descriptions
+        ]
+
+    @staticmethod
+    def compile(pattern, search_method):
+        """
+        :return: Function that takes a string and returns whether it matches
+        pattern, or, if pattern is a list, a list of such functions
+        """
+        if isinstance(pattern, list):
+            return [SeriesClassifier.compile(p, search_method)
+                    for p in pattern]
+        if search_method == "re":
+            return re.compile(str(pattern)).search
+        return re.compile(fnmatch.translate(str(pattern))).match
+
+    def matches(self, data):
+        """
+        :param data: Dictionary of one sidecar's fields
+        :return: List of indices of every description whose criteria all
+        match data
+        """
+        return [i for i, criteria in enumerate(self.criteria)
+                if criteria and all(self.is_match(data.get(tag), matcher)
+                                    for tag, matcher in criteria)]
+
+    @staticmethod
+    def is_match(value, matcher):
+        if isinstance(value, list):
+            return (isinstance(matcher, list) and len(value) == len(matcher)
+                    and all(bool(m(str(v))) for v, m in zip(value, matcher)))
+        if isinstance(matcher, list):
+            return False
+        return bool(matcher(str(value)))
+
+    def classify(self, sidecar_paths, participant, session):
+        """
+        :param sidecar_paths: List of paths to dcm2niix sidecars
+        :param participant: String, 'sub-<label>'
+        :param session: String, 'ses-<label>'
+        :return: List of Acquisitions, with run labels added where several
+        sidecars would otherwise get the same BIDS name
+        """
+        prefix = participant + "_" + session
+        sidecars = sorted(Sidecar(path, self.comp_keys)
+                          for path in sidecar_paths)
+        pairs = []
+        for sidecar in sidecars:
+            matched = self.matches(sidecar.data)
+            if len(matched) == 1:
+                pairs.append((sidecar, matched[0]))
+            elif len(matched) > 1:
+                print("WARNING: Several descriptions match {}, so it will not "
+                      "be used".format(os.path.basename(sidecar.root)))
+
+        def suffix(description, run=""):
+            return (prepend(description.get("customLabels", "")) + run
+                    + prepend(description["modalityLabel"]))
+
+        dst_roots = []
+        for sidecar, index in pairs:
+            description = self.descriptions[index]
+            dst_roots.append(os.path.join(participant, session,
+                                          description["dataType"],
+                                          prefix + suffix(description)))
+        runs = defaultdict(list)
+        for i, dst_root in enumerate(dst_roots):
+            runs[dst_root].append(i)
+
+        acquisitions = []
+        for i, (sidecar, index) in enumerate(pairs):
+            description = self.descriptions[index]
+            run = ""
+            if len(runs[dst_roots[i]]) > 1:
+                run = RUN_TEMPLATE.format(runs[dst_roots[i]].index(i) + 1)
+            acquisitions.append(Acquisition(
+                sidecar.root, description["dataType"],
+                os.path.join(participant, session, description["dataType"],
+                             prefix + suffix(description, run)),
+                index, sidecar.orig_data
+            ))
+        return acquisitions
+
+    def sidecar_data(self, acquisition, prefix):
+        """
+        :return: OrderedDict with the BIDS sidecar contents that dcm2bids
+        writes for acquisition: the dcm2niix sidecar, plus Dcm2bidsVersion,
+        IntendedFor, and the description's sidecarChanges
+        """
+        data = OrderedDict(acquisition.data)
+        data["Dcm2bidsVersion"] = DCM2BIDS_VERSION
+        description = self.descriptions[acquisition.description]
+        intended_for = description.get("intendedFor",
+                                       description.get("IntendedFor"))
+        if intended_for is not None:
+            if not isinstance(intended_for, list):
+                intended_for = [intended_for]
+            intended_value = []
+            for index in intended_for:
+                intended = self.descriptions[index]
+                intended_value.append("/".join([
+                    intended["dataType"],
+                    prefix + prepend(intended.get("customLabels", ""))
+                    + prepend(intended["modalityLabel"]) + self.nifti_ext
+                ]))
+            data["IntendedFor"] = (intended_value[0]
+                                   if len(intended_value) == 1
+                                   else intended_value)
+        for key, value in description.get("sidecarChanges", {}).items():
+            data[key] = value
+        return data
+
+
+def main(argv=sys.argv):
+    """
+    Print the BIDS name that each given sidecar would get.
+    Usage: series_classifier.py CONFIG PARTICIPANT SESSION SIDECAR [...]
+    """
+    if len(argv) < 5:
+        print(main.__doc__)
+        return 1
+    classifier = SeriesClassifier(argv[1])
+    for acq in classifier.classify(argv[4:], argv[2], argv[3]):
+        print("{} -> {}".format(os.path.basename(acq.src_root), acq.dst_root))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
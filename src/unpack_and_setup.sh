@@ -7,6 +7,11 @@
 #   4) Select the best SEFM
 #   5) Rename and move Eprime files
 #   6) Copy back to Lustre
+#
+# Each stage leaves a checkpoint marker in the session's scratch directory
+# once it finishes, so rerunning this script for the same session resumes
+# from the first stage that did not complete. If a stage fails, this script
+# exits with status 1 right away instead of running the later stages.
 
 ## Necessary dependencies
 # dcm2bids (https://github.com/DCAN-Labs/Dcm2Bids)
@@ -14,6 +19,35 @@
 # pigz-2.4 (https://zlib.net/pigz)
 # run_order_fix.py (in this repo)
 # sefm_eval_and_json_editor.py (in this repo)
+# convert_session.py (in this repo)
+# gzip_index.py (in this repo; needs indexed_gzip if GZIP_INDEX_MIN_SIZE is set)
+
+## Optional environment variables
+# CONVERSION_CACHE_DIR: folder to cache converted DICOM series in
+# CONVERSION_CACHE_SIZE: maximum size of that cache in GB
+# CONVERSION_JOBS: number of DICOM series to convert at the same time
+# CONVERSION_BENCHMARK: if set, also time converting one series at a time
+# CONVERSION_NAMING: "internal" to name outputs without running dcm2bids
+# NIFTI_COMPRESSION: "pigz", "gzip", or "none" to write NIfTIs with
+#   multithreaded gzip, single-threaded gzip, or uncompressed as .nii
+# NIFTI_COMPRESSION_LEVEL: gzip compression level, from 1 (fastest) to 9
+# ETA_ENGINE: how sefm_eval_and_json_editor.py calculates eta squared:
+#   "numpy" (default), "matlab" (needs the MRE), or "compare"
+# MCR_CACHE_DIR: persistent MATLAB Runtime cache for the compiled eta_squared
+# FLIRT_JOBS: number of SEFM registrations to run at the same time
+# FLIRT_THREADS: number of threads each FLIRT process may use
+# FLIRT_BENCHMARK: if set, also time running the registrations one at a time
+# SEFM_CACHE_DIR: folder to cache each session's SEFM ranking in
+# SEFM_CACHE_INVALIDATE: if set, rank SEFMs again and replace cached rankings
+# SEFM_REGISTRATION: "flirt" (default) or "numpy" to align SEFMs in memory
+# SEFM_REGISTRATION_VALIDATE: if set, align SEFMs both ways and compare them
+# SEFM_RANKING: "full" (default) or "fast" to rank SEFMs approximately first
+# SEFM_RANKING_MARGIN: how close approximate eta values must be to the best
+#   one for fast ranking to score those pairs at full resolution
+# SEFM_RANKING_BENCHMARK: if set, rank SEFMs both ways and compare them
+# SEFM_RANKING_RESULTS: file to append each session's ranking benchmark to
+# GZIP_INDEX_MIN_SIZE: if set, build a seek index for each 4D .nii.gz file
+#   at least this many GB big before copying the outputs back
 
 # If output folder is given as a command line arg, get it; otherwise use
 # ./data as the default. Added by Greg 2019-06-06
@@ -32,9 +66,11 @@ else
 fi
 
 # Get FSL and MRE directory paths from command line; added by Greg Conan on
-# 2019-06-10
-if [[ ! "x$6" = "x" && ! "x$7" = "x" ]]; then
+# 2019-06-10. The MRE is only needed if ETA_ENGINE is matlab or compare
+if [ ! "x$6" = "x" ]; then
     FSL_DIR=$6
+fi
+if [ ! "x$7" = "x" ]; then
     MRE_DIR=$7
 fi
 
@@ -58,25 +94,80 @@ if [ ! -d ${ScratchSpaceDir} ]; then
     # chown :fnl_lab ${ScratchSpaceDir} || true 
     chmod 770 ${ScratchSpaceDir} || true
 fi
-RandomHash=`cat /dev/urandom | tr -cd 'a-f0-9' | head -c 16`
-TempSubjectDir=${ScratchSpaceDir}/${RandomHash}
+# One scratch directory per session, named after the session instead of a
+# random hash, so that a rerun finds the work done by an earlier attempt
+TempSubjectDir=${ScratchSpaceDir}/${SUB}_${VISIT}
 mkdir -p ${TempSubjectDir}
 # chown :fnl_lab ${TempSubjectDir} || true
 
+# Stage checkpoints: stage_needed returns false only while every stage so far
+# already has a marker, so once one stage has to run, every later stage is
+# rerun as well instead of trusting markers left behind by an earlier attempt
+CheckpointDir=${TempSubjectDir}/checkpoints
+mkdir -p ${CheckpointDir}
+resuming=true
+last_stage=
+# Stages which change BIDS_unprocessed in place. A copy of BIDS_unprocessed
+# is kept as of the last of them to finish, and the first stage to run when
+# resuming starts from that copy, so it never runs on files which a failed
+# attempt at that stage already changed
+SNAPSHOT_STAGES="convert dwi_tables run_order sefm json_repair"
+stage_needed() {
+    if ${resuming} && [ -e ${CheckpointDir}/$1 ]; then
+        echo `date`" :SKIPPING STAGE $1, CHECKPOINT FOUND: ${CheckpointDir}/$1"
+        last_stage=$1
+        return 1
+    fi
+    if ${resuming} && [ -d ${CheckpointDir}/${last_stage}.BIDS_unprocessed ]; then
+        echo `date`" :RESTORING BIDS_unprocessed AS OF STAGE ${last_stage}"
+        rm -rf ${TempSubjectDir}/BIDS_unprocessed
+        cp -r --reflink=auto ${CheckpointDir}/${last_stage}.BIDS_unprocessed ${TempSubjectDir}/BIDS_unprocessed || exit 1
+    fi
+    resuming=false
+    rm -f ${CheckpointDir}/$1
+    return 0
+}
+stage_complete() {
+    snapshot=${CheckpointDir}/$1.BIDS_unprocessed
+    if [[ " ${SNAPSHOT_STAGES} " == *" $1 "* ]]; then
+        rm -rf ${snapshot}.partial
+        cp -r --reflink=auto ${TempSubjectDir}/BIDS_unprocessed ${snapshot}.partial || exit 1
+        rm -rf ${snapshot}
+        mv ${snapshot}.partial ${snapshot} || exit 1
+    fi
+    date > ${CheckpointDir}/$1
+    # only the copy from the last stage to finish is needed
+    for old_snapshot in ${CheckpointDir}/*.BIDS_unprocessed; do
+        if [ "${old_snapshot}" != "${snapshot}" ]; then
+            rm -rf ${old_snapshot}
+        fi
+    done
+    last_stage=$1
+}
+
 # copy all tgz to the scratch space dir
-echo `date`" :COPYING TGZs TO SCRATCH: ${TempSubjectDir}"
-cp ${TGZDIR}/image03/* ${TempSubjectDir}
+if stage_needed copy; then
+    echo `date`" :COPYING TGZs TO SCRATCH: ${TempSubjectDir}"
+    cp ${TGZDIR}/image03/* ${TempSubjectDir} || exit 1
+    stage_complete copy
+fi
 
 # unpack tgz to ABCD_DCMs directory
-mkdir ${TempSubjectDir}/DCMs
-echo `date`" :UNPACKING DCMs: ${TempSubjectDir}/DCMs"
-for tgz in ${TempSubjectDir}/*.tgz; do
-    echo $tgz
-    tar -xzf ${tgz} -C ${TempSubjectDir}/DCMs
-done
+if stage_needed extract; then
+    rm -rf ${TempSubjectDir}/DCMs
+    mkdir ${TempSubjectDir}/DCMs
+    echo `date`" :UNPACKING DCMs: ${TempSubjectDir}/DCMs"
+    extracted=true
+    for tgz in ${TempSubjectDir}/*.tgz; do
+        echo $tgz
+        tar -xzf ${tgz} -C ${TempSubjectDir}/DCMs || extracted=false
+    done
 
-if [ -e ${TempSubjectDir}/DCMs/${SUB}/${VISIT}/func ]; then
-    ${ABCD2BIDS_DIR}/src/remove_RawDataStorage_dcms.py ${TempSubjectDir}/DCMs/${SUB}/${VISIT}/func
+    if [ -e ${TempSubjectDir}/DCMs/${SUB}/${VISIT}/func ]; then
+        ${ABCD2BIDS_DIR}/src/remove_RawDataStorage_dcms.py ${TempSubjectDir}/DCMs/${SUB}/${VISIT}/func || extracted=false
+    fi
+    ${extracted} || exit 1
+    stage_complete extract
 fi
 
 
@@ -87,62 +178,99 @@ fi
 
 
 # convert DCM to BIDS and move to ABCD directory
-mkdir ${TempSubjectDir}/BIDS_unprocessed
-cp ${ABCD2BIDS_DIR}/dataset_description.json ${TempSubjectDir}/BIDS_unprocessed/
-echo ${participant}
-echo `date`" :RUNNING dcm2bids"
-dcm2bids -d ${TempSubjectDir}/DCMs/${SUB} -p ${participant} -s ${session} -c ${ABCD2BIDS_DIR}/abcd_dcm2bids.conf -o ${TempSubjectDir}/BIDS_unprocessed --forceDcm2niix --clobber
+if stage_needed convert; then
+    rm -rf ${TempSubjectDir}/BIDS_unprocessed
+    mkdir ${TempSubjectDir}/BIDS_unprocessed || exit 1
+    cp ${ABCD2BIDS_DIR}/dataset_description.json ${TempSubjectDir}/BIDS_unprocessed/ || exit 1
+    echo ${participant}
+    # convert each series with dcm2niix (or restore it from the conversion
+    # cache), then let dcm2bids name and move the outputs it finds
+    convert_opts=""
+    if [ -n "${CONVERSION_CACHE_DIR}" ]; then
+        convert_opts="${convert_opts} --cache-dir ${CONVERSION_CACHE_DIR}"
+    fi
+    if [ -n "${CONVERSION_CACHE_SIZE}" ]; then
+        convert_opts="${convert_opts} --cache-size ${CONVERSION_CACHE_SIZE}"
+    fi
+    if [ -n "${CONVERSION_JOBS}" ]; then
+        convert_opts="${convert_opts} --jobs ${CONVERSION_JOBS}"
+    fi
+    if [ -n "${NIFTI_COMPRESSION}" ]; then
+        convert_opts="${convert_opts} --compression ${NIFTI_COMPRESSION}"
+    fi
+    if [ -n "${NIFTI_COMPRESSION_LEVEL}" ]; then
+        convert_opts="${convert_opts} --compression-level ${NIFTI_COMPRESSION_LEVEL}"
+    fi
+    if [ -n "${CONVERSION_BENCHMARK}" ]; then
+        convert_opts="${convert_opts} --benchmark"
+    fi
+    if [ "${CONVERSION_NAMING}" = "internal" ]; then
+        echo `date`" :RUNNING dcm2niix STRAIGHT TO BIDS NAMES"
+        ${ABCD2BIDS_DIR}/src/convert_session.py ${TempSubjectDir}/DCMs/${SUB} ${participant} ${session} ${ABCD2BIDS_DIR}/abcd_dcm2bids.conf ${TempSubjectDir}/BIDS_unprocessed ${convert_opts} --naming internal || exit 1
+    else
+        echo `date`" :RUNNING dcm2niix"
+        ${ABCD2BIDS_DIR}/src/convert_session.py ${TempSubjectDir}/DCMs/${SUB} ${participant} ${session} ${ABCD2BIDS_DIR}/abcd_dcm2bids.conf ${TempSubjectDir}/BIDS_unprocessed ${convert_opts} &&
+        echo `date`" :RUNNING dcm2bids" &&
+        dcm2bids -d ${TempSubjectDir}/DCMs/${SUB} -p ${participant} -s ${session} -c ${ABCD2BIDS_DIR}/abcd_dcm2bids.conf -o ${TempSubjectDir}/BIDS_unprocessed --clobber || exit 1
+    fi
+    stage_complete convert
+fi
 
 
 # replace bvals and bvecs with files supplied by the NDA
+if stage_needed dwi_tables; then
 if [ -e ${TempSubjectDir}/DCMs/${SUB}/${VISIT}/dwi ]; then
     first_dcm=`ls ${TempSubjectDir}/DCMs/${SUB}/${VISIT}/dwi/*/*.dcm | head -n1`
     echo "Replacing bvals and bvecs with files supplied by the NDA"
-    for dwi in ${TempSubjectDir}/BIDS_unprocessed/${SUB}/${VISIT}/dwi/${SUB}_${VISIT}*.nii.gz; do
-        orig_bval=`echo $dwi | sed 's|.nii.gz|.bval|'`
-        orig_bvec=`echo $dwi | sed 's|.nii.gz|.bvec|'`
+    for dwi in ${TempSubjectDir}/BIDS_unprocessed/${SUB}/${VISIT}/dwi/${SUB}_${VISIT}*.nii ${TempSubjectDir}/BIDS_unprocessed/${SUB}/${VISIT}/dwi/${SUB}_${VISIT}*.nii.gz; do
+        if [ ! -e ${dwi} ]; then continue; fi
+        orig_bval=`echo $dwi | sed 's|\.nii\(\.gz\)\?$|.bval|'`
+        orig_bvec=`echo $dwi | sed 's|\.nii\(\.gz\)\?$|.bvec|'`
         
         if [[ `dcmdump --search 0008,0070 ${first_dcm} 2>/dev/null` == *GE* ]]; then 
             if dcmdump --search 0018,1020 ${first_dcm} 2>/dev/null | grep -q DV25; then
                 echo "Replacing GE DV25 bvals and bvecs"
                 echo cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/GE_bvals_DV25.txt ${orig_bval}
-                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/GE_bvals_DV25.txt ${orig_bval}
+                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/GE_bvals_DV25.txt ${orig_bval} || exit 1
                 echo cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/GE_bvecs_DV25.txt ${orig_bvec}
-                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/GE_bvecs_DV25.txt ${orig_bvec}
+                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/GE_bvecs_DV25.txt ${orig_bvec} || exit 1
             elif dcmdump --search 0018,1020 ${first_dcm} 2>/dev/null | grep -q DV26; then
                 echo "Replacing GE DV26 bvals and bvecs"
-                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/GE_bvals_DV26.txt ${orig_bval}
-                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/GE_bvecs_DV26.txt ${orig_bvec}
+                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/GE_bvals_DV26.txt ${orig_bval} || exit 1
+                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/GE_bvecs_DV26.txt ${orig_bvec} || exit 1
             else
                 echo "ERROR setting up DWI: GE software version not recognized"
-                exit
+                exit 1
             fi
         elif [[ `dcmdump --search 0008,0070 ${first_dcm} 2>/dev/null` == *Philips* ]]; then
             software_version=`dcmdump --search 0018,1020 ${first_dcm} 2>/dev/null | awk '{print $3}'`
             if [[ ${software_version} == *5.3* ]]; then
                 echo "Replacing Philips s1 bvals and bvecs"
-                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/Philips_bvals_s1.txt ${orig_bval}
-                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/Philips_bvecs_s1.txt ${orig_bvec}
+                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/Philips_bvals_s1.txt ${orig_bval} || exit 1
+                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/Philips_bvecs_s1.txt ${orig_bvec} || exit 1
             elif [[ ${software_version} == *5.4* ]]; then
                 echo "Replacing Philips s2 bvals and bvecs"
-                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/Philips_bvals_s2.txt ${orig_bval}
-                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/Philips_bvecs_s2.txt ${orig_bvec}
+                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/Philips_bvals_s2.txt ${orig_bval} || exit 1
+                cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/Philips_bvecs_s2.txt ${orig_bvec} || exit 1
             else
                 echo "ERROR setting up DWI: Philips software version " ${software_version} " not recognized"
-                exit
+                exit 1
             fi
         elif [[ `dcmdump --search 0008,0070 ${first_dcm} 2>/dev/null` == *SIEMENS* ]]; then
             echo "Replacing Siemens bvals and bvecs"
-            cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/Siemens_bvals.txt ${orig_bval}
-            cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/Siemens_bvecs.txt ${orig_bvec}
+            cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/Siemens_bvals.txt ${orig_bval} || exit 1
+            cp `dirname $0`/ABCD_Release_2.0_Diffusion_Tables/Siemens_bvecs.txt ${orig_bvec} || exit 1
         else
             echo "ERROR setting up DWI: Manufacturer not recognized"
-            exit
+            exit 1
         fi
     done
 fi
+stage_complete dwi_tables
+fi
 
 
+if stage_needed run_order; then
 if [[ -e ${TempSubjectDir}/BIDS_unprocessed/${SUB}/${VISIT}/func ]]; then
     echo `date`" :CHECKING BIDS ORDERING OF EPIs"
     i=0
@@ -154,31 +282,40 @@ if [[ -e ${TempSubjectDir}/BIDS_unprocessed/${SUB}/${VISIT}/func ]]; then
         echo `date`" : BIDS functional scans correctly ordered"
     else
         echo `date`" :  ERROR: BIDS incorrectly ordered even after running run_order_fix.py"
-        exit
+        exit 1
     fi
 fi
+stage_complete run_order
+fi
+
 # select best fieldmap and update sidecar jsons
-echo `date`" :RUNNING SEFM SELECTION AND EDITING SIDECAR JSONS"
-if [ -d ${TempSubjectDir}/BIDS_unprocessed/${SUB}/${VISIT}/fmap ]; then
-    ${ABCD2BIDS_DIR}/src/sefm_eval_and_json_editor.py ${TempSubjectDir}/BIDS_unprocessed ${FSL_DIR} ${MRE_DIR} --participant-label=${participant} --output_dir $ROOT_BIDSINPUT
+if stage_needed sefm; then
+    echo `date`" :RUNNING SEFM SELECTION AND EDITING SIDECAR JSONS"
+    if [ -d ${TempSubjectDir}/BIDS_unprocessed/${SUB}/${VISIT}/fmap ]; then
+        ${ABCD2BIDS_DIR}/src/sefm_eval_and_json_editor.py ${TempSubjectDir}/BIDS_unprocessed ${FSL_DIR} ${MRE_DIR} --eta-engine ${ETA_ENGINE:-numpy} ${MCR_CACHE_DIR:+--mcr-cache ${MCR_CACHE_DIR}} --flirt-jobs ${FLIRT_JOBS:-1} --flirt-threads ${FLIRT_THREADS:-1} ${FLIRT_BENCHMARK:+--benchmark-flirt} ${SEFM_CACHE_DIR:+--sefm-cache ${SEFM_CACHE_DIR}} ${SEFM_CACHE_INVALIDATE:+--invalidate-sefm-cache} --registration-engine ${SEFM_REGISTRATION:-flirt} ${SEFM_REGISTRATION_VALIDATE:+--validate-registration} --sefm-ranking ${SEFM_RANKING:-full} ${SEFM_RANKING_MARGIN:+--fast-ranking-margin ${SEFM_RANKING_MARGIN}} ${SEFM_RANKING_BENCHMARK:+--benchmark-ranking} ${SEFM_RANKING_RESULTS:+--benchmark-ranking-results ${SEFM_RANKING_RESULTS}} --participant-label=${participant} --output_dir $ROOT_BIDSINPUT || exit 1
+    fi
+    stage_complete sefm
 fi
 
 # Fix all json extra data errors
-for j in ${TempSubjectDir}/BIDS_unprocessed/${SUB}/${VISIT}/*/*.json; do
-    mv ${j} ${j}.temp
-    # print only the valid part of the json back into the original json
-    jq '.' ${j}.temp > ${j}
-    rm ${j}.temp
-done
-
+if stage_needed json_repair; then
+    for j in ${TempSubjectDir}/BIDS_unprocessed/${SUB}/${VISIT}/*/*.json; do
+        mv ${j} ${j}.temp || exit 1
+        # print only the valid part of the json back into the original json
+        jq '.' ${j}.temp > ${j} || exit 1
+        rm ${j}.temp
+    done
 
-rm ${TempSubjectDir}/BIDS_unprocessed/${SUB}/${VISIT}/fmap/*dir-both* 2> /dev/null || true
+    rm ${TempSubjectDir}/BIDS_unprocessed/${SUB}/${VISIT}/fmap/*dir-both* 2> /dev/null || true
+    stage_complete json_repair
+fi
 
+if stage_needed publish; then
 # rename EventRelatedInformation
 srcdata_dir=${TempSubjectDir}/BIDS_unprocessed/sourcedata/${SUB}/${VISIT}/func
 if ls ${TempSubjectDir}/DCMs/${SUB}/${VISIT}/func/*EventRelatedInformation.txt > /dev/null 2>&1; then
     echo `date`" :COPY AND RENAME SOURCE DATA"
-    mkdir -p ${srcdata_dir}
+    mkdir -p ${srcdata_dir} || exit 1
     MID_evs=`ls ${TempSubjectDir}/DCMs/${SUB}/${VISIT}/func/*MID*EventRelatedInformation.txt 2>/dev/null`
     SST_evs=`ls ${TempSubjectDir}/DCMs/${SUB}/${VISIT}/func/*SST*EventRelatedInformation.txt 2>/dev/null`
     nBack_evs=`ls ${TempSubjectDir}/DCMs/${SUB}/${VISIT}/func/*nBack*EventRelatedInformation.txt 2>/dev/null`
@@ -188,26 +325,34 @@ if ls ${TempSubjectDir}/DCMs/${SUB}/${VISIT}/func/*EventRelatedInformation.txt >
     if [ `echo ${MID_evs} | wc -w` -eq 2 ]; then
         i=1
         for ev in ${MID_evs}; do
-            cp ${ev} ${srcdata_dir}/${SUB}_${VISIT}_task-MID_run-0${i}_bold_EventRelatedInformation.txt
+            cp ${ev} ${srcdata_dir}/${SUB}_${VISIT}_task-MID_run-0${i}_bold_EventRelatedInformation.txt || exit 1
             ((i++))
         done
     fi
     if [ `echo ${SST_evs} | wc -w` -eq 2 ]; then
         i=1
         for ev in ${SST_evs}; do
-            cp ${ev} ${srcdata_dir}/${SUB}_${VISIT}_task-SST_run-0${i}_bold_EventRelatedInformation.txt
+            cp ${ev} ${srcdata_dir}/${SUB}_${VISIT}_task-SST_run-0${i}_bold_EventRelatedInformation.txt || exit 1
             ((i++))
         done
     fi
     if [ `echo ${nBack_evs} | wc -w` -eq 2 ]; then
         i=1
         for ev in ${nBack_evs}; do
-            cp ${ev} ${srcdata_dir}/${SUB}_${VISIT}_task-nback_run-0${i}_bold_EventRelatedInformation.txt
+            cp ${ev} ${srcdata_dir}/${SUB}_${VISIT}_task-nback_run-0${i}_bold_EventRelatedInformation.txt || exit 1
             ((i++))
         done
     fi
 fi
 
+# index large 4D NIfTIs so readers can seek straight to any volume
+if [ -n "${GZIP_INDEX_MIN_SIZE}" ]; then
+    echo `date`" :INDEXING LARGE 4D NIFTIS"
+    ${ABCD2BIDS_DIR}/src/gzip_index.py build ${TempSubjectDir}/BIDS_unprocessed --min-size ${GZIP_INDEX_MIN_SIZE} || exit 1
+    mkdir -p ${ROOT_BIDSINPUT}
+    grep -qxF '*.gzidx' ${ROOT_BIDSINPUT}/.bidsignore 2> /dev/null || echo '*.gzidx' >> ${ROOT_BIDSINPUT}/.bidsignore
+fi
+
 echo `date`" :COPYING BIDS DATA BACK: ${ROOT_BIDSINPUT}"
 
 TEMPBIDSINPUT=${TempSubjectDir}/BIDS_unprocessed/${SUB}
@@ -216,7 +361,7 @@ if [ -d ${TEMPBIDSINPUT} ] ; then
     chmod g+rw -R ${TEMPBIDSINPUT} || true
     echo `date`" :COPY BIDS INPUT"
     mkdir -p ${ROOT_BIDSINPUT}
-    cp -r ${TEMPBIDSINPUT} ${ROOT_BIDSINPUT}/
+    cp -r ${TEMPBIDSINPUT} ${ROOT_BIDSINPUT}/ || exit 1
 fi
 
 ROOT_SRCDATA=${ROOT_BIDSINPUT}/sourcedata
@@ -226,7 +371,19 @@ if [ -d ${TEMPSRCDATA} ] ; then
     chmod g+rw -R ${TEMPSRCDATA} || true
     echo `date`" :COPY SOURCEDATA"
     mkdir -p ${ROOT_SRCDATA}
-    cp -r ${TEMPSRCDATA} ${ROOT_SRCDATA}/
+    cp -r ${TEMPSRCDATA} ${ROOT_SRCDATA}/ || exit 1
+fi
+
+# add the published session to the output dataset's file index, so later
+# steps can list its files without walking the whole dataset
+if [ -d ${TEMPBIDSINPUT} ] ; then
+    echo `date`" :INDEXING BIDS INPUT"
+    ${ABCD2BIDS_DIR}/src/bids_index.py update ${ROOT_BIDSINPUT} --session ${SUB}/${VISIT} || exit 1
+    grep -qxF '.bids_index.sqlite' ${ROOT_BIDSINPUT}/.bidsignore 2> /dev/null || echo '.bids_index.sqlite' >> ${ROOT_BIDSINPUT}/.bidsignore
+fi
+# only mark the session as published once every copy and the index update
+# above succeeded, since the wrapper deletes published sessions' temp files
+stage_complete publish
 fi
 
 echo `date`" :UNPACKING AND SETUP COMPLETE: ${SUB}/${VISIT}"
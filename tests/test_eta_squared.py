@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+
+"""
+Check that the NumPy eta squared engine in sefm_eval_and_json_editor.py gives
+the reference eta squared values of small synthetic images, within
+ETA_TOLERANCE. The reference values are exact, so they can be worked out by
+hand from Cohen et al. (2008). If the ABCD_MRE_DIR environment variable
+points to a MATLAB Runtime directory, the compiled MATLAB eta_squared
+function is also checked against the same values.
+
+Usage:
+  python3 -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import nibabel
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
+import sefm_eval_and_json_editor as sefm  # noqa: E402
+
+# Template image: the values 1 to 8 on a 2x2x2 grid
+TEMPLATE = np.arange(1, 9, dtype=np.int16).reshape(2, 2, 2)
+
+# Each image compared with TEMPLATE, and its reference eta squared value.
+# E.g. for TEMPLATE + 1, the mean of each voxel is 0.5 away from both values,
+# so SS within is 16 * 0.25 = 4, and SS total around the grand mean of 5 is
+# 44 + 44 = 88, giving 1 - 4 / 88 = 21 / 22
+REFERENCE_ETAS = {
+    "identical": (TEMPLATE, 1.0),
+    "shifted": (TEMPLATE + 1, 21 / 22),
+    "reversed": (9 - TEMPLATE, 0.0),
+    "scaled": (TEMPLATE * 2, 63 / 97),
+}
+
+
+class TestEtaSquared(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.template_path = self.save_nifti("template", TEMPLATE)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def save_nifti(self, name, data):
+        path = os.path.join(self.temp_dir, name + ".nii.gz")
+        nibabel.save(nibabel.Nifti1Image(data, np.eye(4)), path)
+        return path
+
+    def test_arrays_match_reference(self):
+        for name, (data, expected) in REFERENCE_ETAS.items():
+            with self.subTest(image=name):
+                eta = sefm.eta_squared_arrays(data.astype(np.float64),
+                                              TEMPLATE.astype(np.float64))
+                self.assertLessEqual(abs(eta - expected), sefm.ETA_TOLERANCE)
+
+    def test_niftis_match_reference(self):
+        for name, (data, expected) in REFERENCE_ETAS.items():
+            with self.subTest(image=name):
+                eta = sefm.eta_squared(self.save_nifti(name, data),
+                                       self.template_path)
+                self.assertLessEqual(abs(eta - expected), sefm.ETA_TOLERANCE)
+
+    @unittest.skipUnless(os.environ.get("ABCD_MRE_DIR"),
+                         "ABCD_MRE_DIR is not set to a MATLAB Runtime "
+                         "directory")
+    def test_matlab_matches_reference(self):
+        names = list(REFERENCE_ETAS)
+        etas = sefm.matlab_eta_squared(
+            os.environ["ABCD_MRE_DIR"],
+            [self.save_nifti(name, REFERENCE_ETAS[name][0])
+             for name in names],
+            self.template_path
+        )
+        for name, eta in zip(names, etas):
+            with self.subTest(image=name):
+                self.assertLessEqual(abs(eta - REFERENCE_ETAS[name][1]),
+                                     sefm.ETA_TOLERANCE)
+
+
+if __name__ == "__main__":
+    unittest.main()